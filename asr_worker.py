@@ -0,0 +1,186 @@
+import argparse
+import json
+import socket
+import socketserver
+import threading
+
+import numpy as np
+
+DEFAULT_ADDRESS = "127.0.0.1:18765"
+
+# Protocol, one request per round trip on a persistent connection:
+#   client -> worker: one JSON header line, then header["nbytes"] bytes of float32 little-endian audio
+#                     {"op": "recognize", "audio_fs": 16000, "lengths": [n, ...], "batched": false, "nbytes": 4 * sum(lengths)}
+#                     {"op": "ping", "nbytes": 0}
+#   worker -> client: one JSON line, {"result": rec_result or [rec_result, ...]}, {"model": ..., "revision": ...}
+#                     for ping, or {"error": "message"}
+# Anything that speaks this, e.g. serve() with a fake pipeline, can stand in for the real worker.
+
+
+def parse_address(address):
+    if address.startswith("unix:"):
+        # Windows has no unix domain sockets in the socket module
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError(f"unix socket addresses are not supported on this platform, use host:port: {address}")
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def to_json(obj):
+    # modelscope results may hold numpy scalars/arrays
+    return json.dumps(obj, ensure_ascii=False, default=lambda o: o.tolist() if hasattr(o, "tolist") else str(o))
+
+
+def send_message(wfile, header, payload=b""):
+    header = dict(header, nbytes=len(payload))
+    wfile.write(to_json(header).encode("utf-8") + b"\n")
+    wfile.write(payload)
+    wfile.flush()
+
+
+def recv_message(rfile):
+    # ConnectionError when the peer closed between messages, ValueError for a malformed or truncated message
+    line = rfile.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    header = json.loads(line)
+    if not isinstance(header, dict):
+        raise ValueError(f"message header is not a JSON object: {line[:200]!r}")
+    payload = rfile.read(header.get("nbytes", 0))
+    if len(payload) != header.get("nbytes", 0):
+        raise ValueError(f"message payload ended after {len(payload)} of {header.get('nbytes', 0)} bytes")
+    return header, payload
+
+
+class ASRClient:
+    """
+    Stand-in for the modelscope pipeline that forwards every call to a running asr_worker.py,
+    so the model is loaded once by the worker instead of once per run.
+    """
+
+    def __init__(self, address, timeout=None):
+        family, target = parse_address(address)
+        self.address = address
+        # one request at a time on the connection, also when recognize_long calls from several threads
+        self.lock = threading.Lock()
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(target)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+
+    def request(self, header, payload=b""):
+        with self.lock:
+            send_message(self.wfile, header, payload)
+            response, _ = recv_message(self.rfile)
+        if "error" in response:
+            raise RuntimeError(f"asr worker {self.address}: {response['error']}")
+        return response
+
+    def ping(self):
+        return self.request({"op": "ping"})
+
+    def __call__(self, audio_in, audio_fs=16000):
+        batched = isinstance(audio_in, list)
+        audios = [np.asarray(audio, dtype="<f4") for audio in (audio_in if batched else [audio_in])]
+        header = {"op": "recognize", "audio_fs": audio_fs, "lengths": [len(audio) for audio in audios], "batched": batched}
+        return self.request(header, b"".join(audio.tobytes() for audio in audios))["result"]
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+
+def connect(address, model=None, model_revision=None, timeout=2.0):
+    """
+    Connect to the worker at address, or return None if none is running there or it serves
+    a different model than requested, so the caller can fall back to loading the pipeline.
+    An address that cannot be used on this platform raises ValueError instead.
+    """
+    parse_address(address)
+    try:
+        client = ASRClient(address, timeout=timeout)
+        info = client.ping()
+    except (OSError, ValueError, ConnectionError):
+        return None
+    if (model, model_revision) != (None, None) and (info.get("model"), info.get("revision")) != (model, model_revision):
+        print(f"asr worker {address} serves {info.get('model')}@{info.get('revision')}, not {model}@{model_revision}; ignored")
+        client.close()
+        return None
+    # recognition of a long batch may take much longer than the connect timeout
+    client.sock.settimeout(None)
+    return client
+
+
+class ASRHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                header, payload = recv_message(self.rfile)
+            except ConnectionError:
+                return
+            except ValueError as e:
+                # the framing of the connection can't be trusted after a bad message: answer, then drop it
+                try:
+                    send_message(self.wfile, {"error": f"bad request: {e}"})
+                except OSError:
+                    pass
+                return
+            try:
+                if header["op"] == "ping":
+                    response = {"model": self.server.model, "revision": self.server.model_revision}
+                elif header["op"] == "recognize":
+                    if 4 * sum(header["lengths"]) != len(payload):
+                        raise ValueError(f"lengths {header['lengths']} do not match the {len(payload)} byte payload")
+                    samples = np.frombuffer(payload, dtype="<f4")
+                    audios = np.split(samples, np.cumsum(header["lengths"])[:-1]) if header["lengths"] else []
+                    # the pipeline is not thread-safe; connections share it one call at a time
+                    with self.server.lock:
+                        if header["batched"]:
+                            result = self.server.inference_pipeline(audio_in=audios, audio_fs=header["audio_fs"])
+                        else:
+                            result = self.server.inference_pipeline(audio_in=audios[0], audio_fs=header["audio_fs"])
+                    response = {"result": result}
+                else:
+                    response = {"error": f"unknown op {header['op']!r}"}
+            except Exception as e:
+                response = {"error": repr(e)}
+            send_message(self.wfile, response)
+
+
+def serve(inference_pipeline, address=DEFAULT_ADDRESS, model=None, model_revision=None):
+    # returns the bound server, call serve_forever() on it; with a fake pipeline in a thread it stubs the worker
+    family, target = parse_address(address)
+    if family == socket.AF_INET:
+        server = socketserver.ThreadingTCPServer(target, ASRHandler, bind_and_activate=False)
+        server.allow_reuse_address = True
+    else:
+        server = socketserver.ThreadingUnixStreamServer(target, ASRHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.server_bind()
+    server.server_activate()
+    server.inference_pipeline = inference_pipeline
+    server.model = model
+    server.model_revision = model_revision
+    server.lock = threading.Lock()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the ASR model loaded and serve recognition to subfix_create_dataset.py runs")
+    parser.add_argument("--address", type=str, default=DEFAULT_ADDRESS, help=f"host:port or unix:/path/to/socket, Default: {DEFAULT_ADDRESS}")
+    args = parser.parse_args()
+
+    from subfix_create_dataset import ASR_MODEL, ASR_MODEL_REVISION, load_pipeline
+
+    server = serve(load_pipeline(), args.address, ASR_MODEL, ASR_MODEL_REVISION)
+    print(f"asr worker ready on {args.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
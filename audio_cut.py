@@ -1,11 +1,77 @@
 import os
 import argparse
-import librosa
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import soundfile as sf
 
+from memory_budget import estimate_decoded_bytes, measured_call, parse_size
+from stage_manifest import audio_entry, write_manifest
+from stage_metrics import StageMetrics
+from work_queue import WorkQueue, job_name
+
+# 计划模式下的片段清单文件名，位于输出文件夹内，每行一个JSON片段
+PLAN_MANIFEST = "plan.jsonl"
+
+# 计算能量包络时每批处理的帧数；整段与流式两条路径按相同批次计算，保证结果逐位一致
+# 每批约需帧数*hop_length*24字节的临时内存（float32缓冲区与float64的平方、前缀和），1024帧时约12MB，流式处理的内存主要在这里
+RMS_FRAME_CHUNK = 1024
+
+# 低谷结构化数组的字段：起始采样点、结束采样点、持续时间（秒）
+VALLEY_DTYPE = np.dtype([('start', np.int64), ('end', np.int64), ('duration', np.float64)])
+
+# 在能量包络上用游程编码查找低谷，全部为数组运算
+def find_valleys_from_energy(energy, sr, hop_length=512, energy_threshold=0.1, min_valley_duration=0.3, as_array=False):
+    """
+    在RMS能量包络上查找低谷（低于阈值的连续帧），不逐帧循环
+    :param energy: 一维RMS能量包络
+    :param sr: 采样率
+    :param hop_length: 帧移
+    :param energy_threshold: 能量低于最大能量的百分比视为低谷
+    :param min_valley_duration: 低谷最小持续时间（秒）
+    :param as_array: 为True时返回VALLEY_DTYPE结构化数组，否则返回元组列表
+    :return: [(start_sample, end_sample, duration_sec), ...] 或结构化数组
+    """
+    energy = np.asarray(energy)
+    threshold = np.max(energy) * energy_threshold
+    below = energy < threshold
+    # 前后各补一个False，差分后+1为低谷起点，-1为低谷终点（开区间）
+    edges = np.diff(np.concatenate(([False], below, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    durations = (ends - starts) * hop_length / sr
+    keep = durations >= min_valley_duration
+    valleys = np.empty(int(np.count_nonzero(keep)), dtype=VALLEY_DTYPE)
+    valleys['start'] = starts[keep] * hop_length
+    valleys['end'] = ends[keep] * hop_length
+    valleys['duration'] = durations[keep]
+    if as_array:
+        return valleys
+    return [(int(s), int(e), float(d)) for s, e, d in zip(valleys['start'], valleys['end'], valleys['duration'])]
+
+# 用前缀和计算已补零音频开头n_frames帧的RMS
+def _rms_frames(padded, n_frames, frame_length=2048, hop_length=512):
+    csum = np.zeros(len(padded) + 1, dtype=np.float64)
+    np.cumsum(np.square(padded, dtype=np.float64), out=csum[1:])
+    starts = np.arange(n_frames) * hop_length
+    power = (csum[starts + frame_length] - csum[starts]) / frame_length
+    return np.sqrt(np.maximum(power, 0.0)).astype(np.float32)
+
+# 计算整段音频的RMS能量包络，分帧方式与librosa.feature.rms(center=True)相同
+def rms_envelope(y, frame_length=2048, hop_length=512):
+    pad = frame_length // 2
+    padded = np.pad(np.asarray(y, dtype=np.float32), (pad, pad))
+    n_frames = 1 + len(y) // hop_length
+    parts = []
+    for first in range(0, n_frames, RMS_FRAME_CHUNK):
+        k = min(RMS_FRAME_CHUNK, n_frames - first)
+        chunk = padded[first * hop_length:(first + k - 1) * hop_length + frame_length]
+        parts.append(_rms_frames(chunk, k, frame_length, hop_length))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
 # 查找音频能量低谷，返回低谷的起止帧和持续时间
-def find_valleys(y, sr, frame_length=2048, hop_length=512, energy_threshold=0.1, min_valley_duration=0.3):
+def find_valleys(y, sr, frame_length=2048, hop_length=512, energy_threshold=0.1, min_valley_duration=0.3, as_array=False):
     """
     查找音频能量低谷，返回低谷的起止帧和持续时间
     :param y: 音频波形
@@ -14,64 +80,50 @@ def find_valleys(y, sr, frame_length=2048, hop_length=512, energy_threshold=0.1,
     :param hop_length: 帧移
     :param energy_threshold: 能量低于最大能量的百分比视为低谷
     :param min_valley_duration: 低谷最小持续时间（秒）
-    :return: [(start_sample, end_sample, duration_sec), ...]
-    """
-    energy = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
-    max_energy = np.max(energy)
-    threshold = max_energy * energy_threshold
-    valleys = []
-    in_valley = False
-    start = 0
-    for i, e in enumerate(energy):
-        if e < threshold:
-            if not in_valley:
-                in_valley = True
-                start = i
-        else:
-            if in_valley:
-                in_valley = False
-                end = i
-                duration = (end - start) * hop_length / sr
-                if duration >= min_valley_duration:
-                    valleys.append((start * hop_length, end * hop_length, duration))
-    # 处理结尾处的低谷
-    if in_valley:
-        end = len(energy)
-        duration = (end - start) * hop_length / sr
-        if duration >= min_valley_duration:
-            valleys.append((start * hop_length, end * hop_length, duration))
-    return valleys
+    :param as_array: 为True时返回VALLEY_DTYPE结构化数组，可直接传给segment_audio_by_valley_duration
+    :return: [(start_sample, end_sample, duration_sec), ...] 或结构化数组
+    """
+    energy = rms_envelope(y, frame_length=frame_length, hop_length=hop_length)
+    return find_valleys_from_energy(energy, sr, hop_length=hop_length, energy_threshold=energy_threshold,
+                                    min_valley_duration=min_valley_duration, as_array=as_array)
 
 # 根据低谷持续时间判断一句话是否结束，优先在长低谷处分割
-def segment_audio_by_valley_duration(y, sr, valleys, max_len=28.0):
+def segment_audio_by_valley_duration(y, sr, valleys, max_len=28.0, audio_len=None):
     """
     根据低谷持续时间判断一句话是否结束，优先在长低谷处分割
-    :param y: 音频波形
+    :param y: 音频波形，仅用于获取长度；流式处理时可为None并传入audio_len
     :param sr: 采样率
-    :param valleys: 低谷列表 (start_sample, end_sample, duration_sec)
+    :param valleys: 低谷列表 (start_sample, end_sample, duration_sec) 或VALLEY_DTYPE结构化数组
     :param max_len: 最大片段长度（秒）
+    :param audio_len: 音频总采样点数，默认为len(y)
     :return: [(start_sample, end_sample), ...]
     """
+    if not isinstance(valleys, np.ndarray):
+        valleys = np.array(valleys, dtype=VALLEY_DTYPE).reshape(-1)
+    v_ends = valleys['end']
+    v_durs = valleys['duration']
+    n_valleys = len(valleys)
     segments = []
     start_sample = 0
-    audio_len = len(y)
+    if audio_len is None:
+        audio_len = len(y)
     max_samples = int(max_len * sr)
     valley_idx = 0
     while start_sample < audio_len:
         # 查找下一个低谷，且该低谷距离start_sample不超过max_len
-        best_valley = None
-        best_duration = 0
-        while valley_idx < len(valleys):
-            v_start, v_end, v_dur = valleys[valley_idx]
-            if v_end - start_sample > max_samples:
-                break
-            if v_dur > best_duration and v_end > start_sample:
-                best_valley = (v_start, v_end, v_dur)
-                best_duration = v_dur
-            valley_idx += 1
-        if best_valley:
+        # 低谷按结束位置有序，可二分出候选区间 [lo, hi)
+        hi = max(valley_idx, int(np.searchsorted(v_ends, start_sample + max_samples, side='right')))
+        lo = max(valley_idx, int(np.searchsorted(v_ends, start_sample, side='right')))
+        best = None
+        if lo < hi:
+            # argmax取第一个最大值，与逐个比较“严格大于”的结果一致
+            best = lo + int(np.argmax(v_durs[lo:hi]))
+            if v_durs[best] <= 0:
+                best = None
+        valley_idx = min(hi, n_valleys)
+        if best is not None:
             # 在最长低谷处分割
-            cut_point = best_valley[1]
+            cut_point = int(v_ends[best])
             segments.append((start_sample, cut_point))
             start_sample = cut_point
         else:
@@ -146,66 +198,476 @@ def merge_short_segments(segments, sr, merge_thresh=10.0, max_len=28.0, min_fina
             i += 1
     return final_segments
 
+# 由能量包络得到最终片段：查找低谷、按低谷分割、合并短片段
+def plan_segments(energy, n_samples, sr, hop_length=512, energy_threshold=0.1, min_valley_duration=0.3, max_len=28.0, merge_thresh=10.0):
+    """
+    只依赖能量包络和音频长度计算切分结果，不需要音频波形
+    :param energy: RMS能量包络
+    :param n_samples: 音频总采样点数
+    :param sr: 采样率
+    :param hop_length: 帧移
+    :param energy_threshold: 能量低于最大能量的百分比视为低谷
+    :param min_valley_duration: 低谷最小持续时间（秒）
+    :param max_len: 最大片段长度（秒）
+    :param merge_thresh: 合并阈值（秒）
+    :return: (合并后的片段列表, 合并前的片段列表, 低谷结构化数组)
+    """
+    valleys = find_valleys_from_energy(energy, sr, hop_length=hop_length, energy_threshold=energy_threshold,
+                                       min_valley_duration=min_valley_duration, as_array=True)
+    raw_segments = segment_audio_by_valley_duration(None, sr, valleys, max_len=max_len, audio_len=n_samples)
+    segments = merge_short_segments(raw_segments, sr, merge_thresh=merge_thresh, max_len=max_len, min_final_len=3.0)
+    return segments, raw_segments, valleys
+
+# 流式计算RMS能量包络，与rms_envelope逐位一致
+def stream_rms_envelope(audio_file, frame_length=2048, hop_length=512, blocksize=65536):
+    """
+    按块读取音频并计算RMS能量包络，内存只占用一个块加一批帧
+    :param audio_file: 音频文件路径（需soundfile可读）
+    :param frame_length: 帧长
+    :param hop_length: 帧移
+    :param blocksize: 每次读取的采样点数
+    :return: (energy, n_samples, sr)
+    """
+    info = sf.info(audio_file)
+    n_samples = info.frames
+    n_frames = 1 + n_samples // hop_length
+    pad = frame_length // 2
+    chunk_len = (RMS_FRAME_CHUNK - 1) * hop_length + frame_length
+    # buf保存尚未被完整帧消费的（已居中补零的）采样点
+    buf = np.zeros(pad, dtype=np.float32)
+    parts = []
+    done = 0
+
+    def consume(buf, final=False):
+        nonlocal done
+        # 与rms_envelope按相同的批次边界计算，只有最后一批可以不满
+        while done < n_frames and (len(buf) >= chunk_len or final):
+            k = min(RMS_FRAME_CHUNK, n_frames - done)
+            parts.append(_rms_frames(buf[:(k - 1) * hop_length + frame_length], k, frame_length, hop_length))
+            done += k
+            buf = buf[k * hop_length:]
+        return buf
+
+    for block in sf.blocks(audio_file, blocksize=blocksize, dtype='float32', always_2d=True):
+        buf = consume(np.concatenate((buf, _to_mono(block))))
+    consume(np.concatenate((buf, np.zeros(pad, dtype=np.float32))), final=True)
+    energy = np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+    return energy, n_samples, info.samplerate
+
+# 多声道转为单声道，与librosa.to_mono一致
+def _to_mono(block):
+    if block.shape[1] == 1:
+        return block[:, 0]
+    return np.mean(block, axis=1)
+
+# 按块把源文件的[start, end)区间写入新文件，不整段载入内存
+def stream_write_segment(src, out_file, start, end, blocksize=65536):
+    """
+    从已打开的soundfile.SoundFile中按块读取指定区间并写入输出文件
+    :param src: 已打开的源音频SoundFile
+    :param out_file: 输出文件路径
+    :param start: 起始采样点
+    :param end: 结束采样点（不含）
+    :param blocksize: 每次读取的采样点数
+    """
+    src.seek(start)
+    with sf.SoundFile(out_file, 'w', samplerate=src.samplerate, channels=1) as dst:
+        remaining = end - start
+        while remaining > 0:
+            block = src.read(min(blocksize, remaining), dtype='float32', always_2d=True)
+            if len(block) == 0:
+                break
+            dst.write(_to_mono(block))
+            remaining -= len(block)
+
+# 只读取[start, end)区间并重采样后写出，内存占用只与片段长度有关
+def resample_write_segment(src, out_file, start, end, sr):
+    """
+    :param src: 已打开的源音频SoundFile
+    :param out_file: 输出文件路径
+    :param start: 起始采样点（源文件采样率）
+    :param end: 结束采样点（不含）
+    :param sr: 输出采样率
+    """
+    import librosa
+    src.seek(start)
+    y = _to_mono(src.read(end - start, dtype='float32', always_2d=True))
+    sf.write(out_file, librosa.resample(y, orig_sr=src.samplerate, target_sr=sr), sr)
+
+# 能量包络缓存的文件路径，由文件内容哈希与分帧参数共同决定
+def envelope_cache_path(cache_dir, audio_file, frame_length=2048, hop_length=512, sr=None):
+    """
+    计算能量包络缓存文件路径，包络只依赖音频内容、采样率与分帧参数，与阈值等切分参数无关
+    :param cache_dir: 缓存文件夹
+    :param audio_file: 音频文件路径
+    :param frame_length: 帧长
+    :param hop_length: 帧移
+    :param sr: 目标采样率，None表示原始采样率
+    :return: 缓存文件路径
+    """
+    digest = hashlib.sha1()
+    with open(audio_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    sr_tag = 'native' if sr is None else str(sr)
+    # rms2：前缀和实现的包络，与早先librosa计算的缓存区分开
+    return os.path.join(cache_dir, f"{digest.hexdigest()}_{frame_length}_{hop_length}_{sr_tag}_rms2.npz")
+
+# 读取能量包络缓存，命中时刷新修改时间用于LRU淘汰
+def envelope_cache_get(cache_path):
+    """
+    :param cache_path: 缓存文件路径
+    :return: (energy, n_samples, sr)，未命中返回None
+    """
+    try:
+        with np.load(cache_path) as data:
+            cached = data['energy'], int(data['n_samples']), int(data['sr'])
+        os.utime(cache_path)
+        return cached
+    except (OSError, KeyError, ValueError):
+        return None
+
+# 写入能量包络缓存，总大小超过上限时按最久未使用淘汰
+def envelope_cache_put(cache_path, energy, n_samples, sr, max_bytes=2 << 30):
+    """
+    :param cache_path: 缓存文件路径
+    :param energy: RMS能量包络
+    :param n_samples: 音频总采样点数
+    :param sr: 采样率
+    :param max_bytes: 缓存文件夹大小上限（字节）
+    """
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # 先写临时文件再原子替换，避免多进程同时写入时读到半个文件
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, energy=energy, n_samples=n_samples, sr=sr)
+    os.replace(tmp_path, cache_path)
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npz') or '.tmp.' in name:
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.join(cache_dir, name) == cache_path:
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# 解码整段音频为单声道float32
+def load_audio(audio_file, sr=None):
+    """
+    librosa（连带numba、scipy）导入耗时数秒，只在需要重采样或soundfile无法解码时才导入
+    :param audio_file: 音频文件路径
+    :param sr: 目标采样率，None表示与输入音频一致
+    :return: (y, sr)
+    """
+    if not _stream_readable(audio_file):
+        import librosa
+        return librosa.load(audio_file, sr=sr)
+    y = _to_mono(sf.read(audio_file, dtype='float32', always_2d=True)[0])
+    file_sr = sf.info(audio_file).samplerate
+    if sr is None or sr == file_sr:
+        return y, file_sr
+    import librosa
+    return librosa.resample(y, orig_sr=file_sr, target_sr=sr), sr
+
+# 判断文件能否被soundfile按块读取
+def _stream_readable(audio_file):
+    try:
+        sf.info(audio_file)
+        return True
+    except Exception:
+        return False
+
+# 只计算能量包络，不保留音频波形；优先读取缓存，其次按块流式计算
+def compute_envelope(audio_file, sr=None, blocksize=65536, cache_dir=None, cache_max_bytes=2 << 30):
+    """
+    :param audio_file: 音频文件路径
+    :param sr: 采样率，None表示与输入音频一致
+    :param blocksize: 流式计算时每次读取的采样点数
+    :param cache_dir: 能量包络缓存文件夹，None表示不使用缓存
+    :param cache_max_bytes: 能量包络缓存大小上限（字节）
+    :return: (energy, n_samples, sr)
+    """
+    cache_path = envelope_cache_path(cache_dir, audio_file, sr=sr) if cache_dir else None
+    cached = envelope_cache_get(cache_path) if cache_path else None
+    if cached is not None:
+        return cached
+    if sr is None and _stream_readable(audio_file):
+        energy, n_samples, sr_to_use = stream_rms_envelope(audio_file, blocksize=blocksize)
+    else:
+        y, sr_to_use = load_audio(audio_file, sr=sr)
+        energy, n_samples = rms_envelope(y), len(y)
+    if cache_path:
+        envelope_cache_put(cache_path, energy, n_samples, sr_to_use, max_bytes=cache_max_bytes)
+    return energy, n_samples, sr_to_use
+
+# 处理单个音频文件，返回分段数和输出文件数；可在子进程中运行，不依赖全局args
+def process_audio_file(audio_file, out_dir, max_len=28.0, sr=None, merge_thresh=10.0, min_split_len=30.0, stream=False, blocksize=65536,
+                       cache_dir=None, cache_max_bytes=2 << 30, plan=False, max_memory=None):
+    """
+    处理单个音频文件
+    流式模式下先按块扫描一遍得到能量包络（阈值依赖整段最大能量），确定全部切点后再逐段按块写出，
+    峰值内存与音频总长度无关；命中能量包络缓存时跳过整段解码，只按块读取需要写出的片段；
+    计划模式只记录片段在源文件中的采样点区间，不写出任何音频；
+    按文件头估算的整段解码内存超过max_memory时自动改为流式模式，指定了采样率时按原采样率切分，逐段读取后重采样
+    :param audio_file: 音频文件路径
+    :param out_dir: 输出文件夹
+    :param max_len: 最大片段长度（秒）
+    :param sr: 采样率，None表示与输入音频一致
+    :param merge_thresh: 合并阈值（秒）
+    :param min_split_len: 小于等于该时长的片段直接复制（秒）
+    :param stream: 是否按块流式读写
+    :param blocksize: 流式模式下每次读取的采样点数
+    :param cache_dir: 能量包络缓存文件夹，None表示不使用缓存
+    :param cache_max_bytes: 能量包络缓存大小上限（字节）
+    :param plan: 计划模式，只返回片段清单而不写出音频
+    :param max_memory: 单个文件的内存预算（字节），None表示不限制
+    :return: (分段数, 输出文件数, 片段列表, 音频时长秒)，计划模式下为计划片段，否则为输出文件的清单条目
+    """
+    # 不重采样且soundfile可读时，可以只按块读取需要的区间
+    seekable = _stream_readable(audio_file)
+    if plan:
+        # 清单中的区间供下游用soundfile按帧读取，必须是源文件原始采样率下的位置
+        if not seekable:
+            raise ValueError(f"计划模式需要soundfile可读取的音频，请先转换格式: {audio_file}")
+        sr = None
+    # 超出内存预算时不整段解码；需要重采样的在原采样率下切分，只有输出片段被重采样
+    out_sr = None
+    estimate = estimate_decoded_bytes(audio_file, sr) if max_memory and not plan else None
+    if estimate is not None and estimate > max_memory:
+        print(f"整段解码约需{estimate / (1 << 20):.0f}MB，超过内存预算{max_memory / (1 << 20):.0f}MB，改为流式处理: {audio_file}")
+        stream = True
+        out_sr, sr = sr, None
+    seekable = seekable and sr is None
+    if stream and not seekable:
+        print(f"流式模式不支持该文件或指定了采样率，改为整段载入: {audio_file}")
+    cache_path = envelope_cache_path(cache_dir, audio_file, sr=sr) if cache_dir else None
+    cached = envelope_cache_get(cache_path) if cache_path else None
+    y = None
+    if cached is not None and seekable:
+        energy, n_samples, sr_to_use = cached
+    elif (stream or plan) and seekable:
+        energy, n_samples, sr_to_use = stream_rms_envelope(audio_file, blocksize=blocksize)
+    else:
+        # 若未指定采样率，则与输入音频一致
+        y, sr_to_use = load_audio(audio_file, sr=sr)
+        n_samples = len(y)
+        energy = cached[0] if cached is not None else rms_envelope(y)
+    if cache_path and cached is None:
+        envelope_cache_put(cache_path, energy, n_samples, sr_to_use, max_bytes=cache_max_bytes)
+
+    entries = []
+
+    def write(out_file, start, end):
+        if plan:
+            entries.append({"source_path": os.path.abspath(audio_file), "start_sample": int(start),
+                            "end_sample": int(end), "sr": int(sr_to_use)})
+        else:
+            if y is not None:
+                sf.write(out_file, y[start:end], sr_to_use)
+            elif out_sr is not None and out_sr != sr_to_use:
+                resample_write_segment(src, out_file, start, end, out_sr)
+            else:
+                stream_write_segment(src, out_file, start, end, blocksize=blocksize)
+            entries.append(audio_entry(out_file, (end - start) / sr_to_use, out_sr or sr_to_use))
+
+    base_name = os.path.splitext(os.path.basename(audio_file))[0]
+    duration_sec = n_samples / sr_to_use
+    src = sf.SoundFile(audio_file) if y is None and not plan else None
+    action = "计划" if plan else "保存"
+    try:
+        if duration_sec <= 30.0:
+            # 不超过30秒，直接复制到输出文件夹
+            out_file = os.path.join(out_dir, f"{base_name}.wav")
+            write(out_file, 0, n_samples)
+            print(f"音频未超过30秒，直接{'计划' if plan else '复制'}: {out_file} ({duration_sec:.2f}秒)")
+            return 0, 1, entries, duration_sec
+        segments = plan_segments(energy, n_samples, sr_to_use, max_len=max_len, merge_thresh=merge_thresh)[0]
+        for idx, (start, end) in enumerate(segments):
+            duration = (end - start) / sr_to_use
+            out_file = os.path.join(out_dir, f"{base_name}{idx+1:02d}.wav")
+            write(out_file, start, end)
+            # 判断是否需要分割
+            if duration <= min_split_len and not plan:
+                print(f"音频片段时长 {duration:.2f}s <= {min_split_len}s，已直接复制到 {out_file}")
+            else:
+                print(f"{action}片段: {out_file} ({duration:.2f}秒)")
+        return len(segments), len(segments), entries, duration_sec
+    finally:
+        if src is not None:
+            src.close()
+
+# 输出处理单个文件时进程的峰值内存；预算针对单个文件，只有处理该文件时内存的增长超出预算才提示
+def log_peak(audio_file, peak_mb, growth_mb, max_memory):
+    budget_mb = max_memory / (1 << 20)
+    if growth_mb > budget_mb:
+        print(f"警告：处理时内存增长{growth_mb:.0f}MB超过预算{budget_mb:.0f}MB（峰值{peak_mb:.0f}MB）: {audio_file}")
+    else:
+        print(f"峰值内存{peak_mb:.0f}MB（增长{growth_mb:.0f}MB）: {audio_file}")
+
+# 写出输出文件夹的清单：计划模式为片段清单，否则为输出文件清单
+def write_outputs(out_dir, entries, plan=False, update=True):
+    if plan:
+        manifest_path = os.path.join(out_dir, PLAN_MANIFEST)
+        entries = sorted(entries, key=lambda e: (e["source_path"], e["start_sample"]))
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        print(f"片段清单已写入: {manifest_path}")
+    else:
+        # 下游按清单读取输出文件，不再遍历文件夹；保留此前运行输出的条目
+        write_manifest(out_dir, entries, update=update)
+
+# 列出输入文件夹下的音频文件，按文件名排序；segment_sweep.py、subfix_pipeline.py共用同一规则
+def list_audio_files(input_path):
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, file) for file in os.listdir(input_path)
+                      if file.lower().endswith((".wav", ".mp3", ".flac", ".ogg", ".m4a")))
+    return [input_path]
+
 # 批量处理文件夹下的音频文件
-def process_audio_files(input_path, out_dir, max_len=28.0, sr=16000, merge_thresh=10.0):
+def process_audio_files(input_path, out_dir, max_len=28.0, sr=None, merge_thresh=10.0, min_split_len=30.0, stream=False, blocksize=65536, workers=1,
+                        cache_dir=None, cache_max_bytes=2 << 30, plan=False, max_memory=None, metrics=None):
     """
     批量处理文件夹下的音频文件
     :param input_path: 输入音频文件夹或单个文件
     :param out_dir: 输出文件夹
     :param max_len: 最大片段长度（秒）
-    :param sr: 采样率
+    :param sr: 采样率，None表示与输入音频一致
     :param merge_thresh: 合并阈值（秒）
+    :param min_split_len: 小于等于该时长的片段直接复制（秒）
+    :param stream: 是否按块流式读写，适合超长音频
+    :param blocksize: 流式模式下每次读取的采样点数
+    :param workers: 并行处理的进程数，1为串行
+    :param cache_dir: 能量包络缓存文件夹，None表示不使用缓存
+    :param cache_max_bytes: 能量包络缓存大小上限（字节）
+    :param plan: 计划模式，只在输出文件夹写出片段清单PLAN_MANIFEST，不写出音频；否则写出输出文件清单stage_manifest.MANIFEST_NAME
+    :param max_memory: 单个文件的内存预算（字节），超出的文件改为流式处理，并输出每个文件的峰值内存；None表示不限制
+    :param metrics: stage_metrics.StageMetrics，记录"cut"阶段的耗时、音频时长和逐文件耗时与峰值内存，None表示不记录
+    :return: 处理失败的文件列表 [(audio_file, error), ...]
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    audio_files = []
-    if os.path.isdir(input_path):
-        for file in os.listdir(input_path):
-            if file.lower().endswith((".wav", ".mp3", ".flac", ".ogg", ".m4a")):
-                audio_files.append(os.path.join(input_path, file))
-    else:
-        audio_files.append(input_path)
+    audio_files = list_audio_files(input_path)
     input_file_count = len(audio_files)
     split_file_count = 0
     total_split_segments = 0
     output_file_count = 0
-    for audio_file in audio_files:
-        # 若未指定采样率，则与输入音频一致
-        y, file_sr = librosa.load(audio_file, sr=args.sr)
-        sr_to_use = file_sr
-        duration_sec = len(y) / sr_to_use
-        if duration_sec <= 30.0:
-            # 不超过30秒，直接复制到输出文件夹
-            base_name = os.path.splitext(os.path.basename(audio_file))[0]
-            out_file = os.path.join(out_dir, f"{base_name}.wav")
-            sf.write(out_file, y, sr_to_use)
-            print(f"音频未超过30秒，直接复制: {out_file} ({duration_sec:.2f}秒)")
-            output_file_count += 1
-            continue
-        valleys = find_valleys(y, sr_to_use)
-        segments = segment_audio_by_valley_duration(y, sr_to_use, valleys, max_len=args.max_len)
-        segments = merge_short_segments(segments, sr_to_use, merge_thresh=args.merge_thresh, max_len=args.max_len, min_final_len=3.0)
-        base_name = os.path.splitext(os.path.basename(audio_file))[0]
-        if len(segments) > 1:
+    failures = []
+    kwargs = dict(max_len=max_len, sr=sr, merge_thresh=merge_thresh, min_split_len=min_split_len, stream=stream, blocksize=blocksize,
+                  cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, plan=plan, max_memory=max_memory)
+    plan_entries = []
+    manifest_entries = []
+    # the peak is only sampled when it is checked against a budget or traced
+    watch_memory = bool(max_memory) or (metrics is not None and metrics.trace_file is not None)
+    if metrics is not None:
+        metrics.start("cut")
+
+    def collect(audio_file, result, seconds, peak_mb, growth_mb):
+        nonlocal split_file_count, total_split_segments, output_file_count
+        n_segments, n_outputs, entries, duration_sec = result
+        if metrics is not None:
+            metrics.add("cut", seconds, duration_sec, path=audio_file, peak_mb=peak_mb, growth_mb=growth_mb)
+        if max_memory:
+            log_peak(audio_file, peak_mb, growth_mb, max_memory)
+        if n_segments > 1:
             split_file_count += 1
-        total_split_segments += len(segments)
-        for idx, (start, end) in enumerate(segments):
-            segment = y[start:end]
-            # 读取音频
-            duration = len(segment) / sr_to_use
-            # 判断是否需要分割
-            if duration <= args.min_split_len:
-                # 直接复制到输出目录
-                out_file = os.path.join(out_dir, f"{base_name}{idx+1:02d}.wav")
-                sf.write(out_file, segment, sr_to_use)
-                print(f"音频片段时长 {duration:.2f}s <= {args.min_split_len}s，已直接复制到 {out_file}")
-                output_file_count += 1
-                continue
-            out_file = os.path.join(out_dir, f"{base_name}{idx+1:02d}.wav")
-            sf.write(out_file, segment, sr_to_use)
-            print(f"保存片段: {out_file} ({(end-start)/sr_to_use:.2f}秒)")
-            output_file_count += 1
+        total_split_segments += n_segments
+        output_file_count += n_outputs
+        (plan_entries if plan else manifest_entries).extend(entries)
+
+    if workers > 1 and len(audio_files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(measured_call, process_audio_file, audio_file, out_dir, watch_memory=watch_memory, **kwargs): audio_file for audio_file in audio_files}
+            for future in as_completed(futures):
+                try:
+                    collect(futures[future], *future.result())
+                except Exception as e:
+                    failures.append((futures[future], repr(e)))
+    else:
+        for audio_file in audio_files:
+            try:
+                collect(audio_file, *measured_call(process_audio_file, audio_file, out_dir, watch_memory=watch_memory, **kwargs))
+            except Exception as e:
+                failures.append((audio_file, repr(e)))
+    write_outputs(out_dir, plan_entries if plan else manifest_entries, plan)
+    if metrics is not None:
+        metrics.stop("cut")
     print(f"\n输入{input_file_count}个文件，其中{split_file_count}个文件共被拆分为{total_split_segments}个片段，输出{output_file_count}个文件。\n")
+    if failures:
+        print(f"{len(failures)}个文件处理失败：")
+        for audio_file, error in sorted(failures):
+            print(f"  {audio_file}: {error}")
+    return failures
+
+# 多台机器共享一个队列文件夹，各自领取单个文件的裁剪任务
+def process_audio_queue(queue_dir, input_path, out_dir, lease_seconds=300.0, max_attempts=3, poll_seconds=5.0, metrics=None, **kwargs):
+    """
+    队列模式：每个进程（可在不同机器上）都把输入文件登记为任务（重复登记会被忽略），再逐个领取处理，
+    直到队列中没有等待和进行中的任务；领取后崩溃的任务在租约过期后由其他进程重试。
+    最后由其中一个进程按全部完成的任务写出输出文件夹的清单
+    :param queue_dir: 队列文件夹，所有进程需使用同一路径（共享存储）
+    :param input_path: 输入音频文件夹或单个文件，各进程的相对路径需一致
+    :param out_dir: 输出文件夹
+    :param lease_seconds: 租约时长（秒），超过该时间未续约的任务视为进程已退出
+    :param max_attempts: 每个任务最多尝试次数，之后记为失败
+    :param poll_seconds: 其他进程仍在处理时的等待间隔（秒）
+    :param metrics: stage_metrics.StageMetrics，记录本进程处理的文件，None表示不记录
+    :param kwargs: 传给process_audio_file的参数
+    :return: 处理失败的文件列表 [(audio_file, error), ...]
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    queue = WorkQueue(queue_dir, lease_seconds, max_attempts)
+    added = sum(queue.add(job_name("cut", os.path.normpath(audio_file)), {"audio_file": audio_file})
+                for audio_file in list_audio_files(input_path))
+    print(f"登记{added}个新任务，队列: {queue_dir}")
+    processed = 0
+    watch_memory = bool(kwargs.get("max_memory")) or (metrics is not None and metrics.trace_file is not None)
+    if metrics is not None:
+        metrics.start("cut")
+    try:
+        for name, job in queue.jobs("cut.", poll_seconds):
+            try:
+                result, seconds, peak_mb, growth_mb = measured_call(process_audio_file, job["audio_file"], out_dir, watch_memory=watch_memory, **kwargs)
+            except Exception as e:
+                print(f"{job['audio_file']} 处理失败: {e!r}")
+                queue.fail(name, job, repr(e))
+                continue
+            queue.complete(name, job, result[2])
+            processed += 1
+            if metrics is not None:
+                metrics.add("cut", seconds, result[3], path=job["audio_file"], peak_mb=peak_mb, growth_mb=growth_mb)
+            if kwargs.get("max_memory"):
+                log_peak(job["audio_file"], peak_mb, growth_mb, kwargs["max_memory"])
+    finally:
+        queue.close()
+        if metrics is not None:
+            metrics.stop("cut")
+    print(f"本进程处理{processed}个文件，队列已全部完成")
+    release = queue.merge_lock("cut.")
+    if release is not None:
+        try:
+            entries = [entry for job in queue.results("done", "cut.").values() for entry in job["result"]]
+            write_outputs(out_dir, entries, kwargs.get("plan", False), update=False)
+        finally:
+            release()
+    failures = [(job["audio_file"], job["error"]) for job in queue.results("failed", "cut.").values()]
+    if failures:
+        print(f"{len(failures)}个文件处理失败：")
+        for audio_file, error in failures:
+            print(f"  {audio_file}: {error}")
+    return failures
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="根据波形低谷长度裁剪音频，优先在长低谷处分割，支持短片段合并，合并阈值最大14秒，最终片段大于3秒。")
@@ -215,10 +677,37 @@ if __name__ == "__main__":
     parser.add_argument('--sr', type=int, default=None, help='采样率，默认与输入音频一致')
     parser.add_argument('--merge_thresh', type=float, default=10.0, help='合并阈值（秒），最大14秒')
     parser.add_argument('--min_split_len', type=float, default=30.0, help='音频分割阈值（单位：秒），小于等于该时长的音频将直接复制而不分割，默认30秒')
+    parser.add_argument('--stream', action='store_true', help='流式模式：按块读取和写出，峰值内存与音频长度无关，适合数小时的长音频')
+    parser.add_argument('--blocksize', type=int, default=65536, help='流式模式下每次读取的采样点数，默认65536')
+    parser.add_argument('--workers', type=int, default=1, help='并行处理文件的进程数，默认1（串行）')
+    parser.add_argument('--cache_dir', type=str, default=None, help='能量包络缓存文件夹，调整切分参数后重新裁剪可跳过整段解码，默认不缓存')
+    parser.add_argument('--cache_max_mb', type=float, default=2048, help='能量包络缓存大小上限（MB），超出后淘汰最久未使用的缓存，默认2048')
+    parser.add_argument('--plan', action='store_true', help='计划模式：只在输出文件夹写出片段清单plan.jsonl（源文件与采样点区间），不写出音频，由subfix_create_dataset.py按区间读取')
+    parser.add_argument('--report', type=str, default=None, help='将耗时、实时率、吞吐和峰值内存报告保存为JSON文件')
+    parser.add_argument('--trace', type=str, default=None, help='逐文件耗时追加写入该JSONL文件，用于排查异常慢的文件')
+    parser.add_argument('--queue', type=str, default=None, help='队列文件夹（共享存储），多台机器各自运行本脚本并指定同一队列，按文件领取任务，完成后合并清单')
+    parser.add_argument('--lease_seconds', type=float, default=300.0, help='队列模式下任务租约时长（秒），超时未续约的任务交给其他进程重试，默认300')
+    parser.add_argument('--max_attempts', type=int, default=3, help='队列模式下每个任务最多尝试次数，默认3')
+    parser.add_argument('--max_memory', type=parse_size, default=None, help='单个文件的内存预算，如2G、512M（纯数字为MB），按文件头估算整段解码超出预算的文件自动改为流式处理，并输出每个文件的峰值内存和内存增长；默认不限制')
     parser.add_argument('--fragment_name', type=str, required=False, default='displace', help='fragment子文件夹名称，默认displace')
     args = parser.parse_args()
     if args.out_dir:
         out_dir = args.out_dir
     else:
         out_dir = os.path.join('./fragment', args.fragment_name)
-    process_audio_files(args.audio, out_dir, max_len=args.max_len, sr=args.sr, merge_thresh=args.merge_thresh)
\ No newline at end of file
+    metrics = StageMetrics(args.trace)
+    if args.queue:
+        process_audio_queue(args.queue, args.audio, out_dir, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts,
+                            metrics=metrics, max_len=args.max_len, sr=args.sr, merge_thresh=args.merge_thresh,
+                            min_split_len=args.min_split_len, stream=args.stream, blocksize=args.blocksize,
+                            cache_dir=args.cache_dir, cache_max_bytes=int(args.cache_max_mb * 1024 * 1024), plan=args.plan,
+                            max_memory=args.max_memory)
+        metrics.write(args.report)
+        metrics.close()
+        raise SystemExit(0)
+    process_audio_files(args.audio, out_dir, max_len=args.max_len, sr=args.sr, merge_thresh=args.merge_thresh,
+                        min_split_len=args.min_split_len, stream=args.stream, blocksize=args.blocksize, workers=args.workers,
+                        cache_dir=args.cache_dir, cache_max_bytes=int(args.cache_max_mb * 1024 * 1024), plan=args.plan,
+                        max_memory=args.max_memory, metrics=metrics)
+    metrics.write(args.report)
+    metrics.close()
\ No newline at end of file
@@ -0,0 +1,480 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+import audio_cut
+from stage_metrics import StageMetrics
+
+
+# 旧版逐帧循环实现，仅作为基准对照
+def find_valleys_loop(energy, sr, hop_length=512, energy_threshold=0.1, min_valley_duration=0.3):
+    threshold = np.max(energy) * energy_threshold
+    valleys = []
+    in_valley = False
+    start = 0
+    for i, e in enumerate(energy):
+        if e < threshold:
+            if not in_valley:
+                in_valley = True
+                start = i
+        else:
+            if in_valley:
+                in_valley = False
+                end = i
+                duration = (end - start) * hop_length / sr
+                if duration >= min_valley_duration:
+                    valleys.append((start * hop_length, end * hop_length, duration))
+    if in_valley:
+        end = len(energy)
+        duration = (end - start) * hop_length / sr
+        if duration >= min_valley_duration:
+            valleys.append((start * hop_length, end * hop_length, duration))
+    return valleys
+
+
+def synthetic_energy(hours, sr, hop_length, seed=0):
+    """
+    生成模拟语音的RMS包络：随机长度的“说话”段与静音段交替
+    """
+    rng = np.random.default_rng(seed)
+    n_frames = int(hours * 3600 * sr / hop_length)
+    frames_per_sec = sr / hop_length
+    energy = np.empty(n_frames, dtype=np.float32)
+    pos = 0
+    speaking = True
+    while pos < n_frames:
+        if speaking:
+            length = int(rng.uniform(1.0, 12.0) * frames_per_sec)
+            energy[pos:pos + length] = rng.uniform(0.2, 1.0, size=len(energy[pos:pos + length]))
+        else:
+            length = int(rng.uniform(0.05, 1.5) * frames_per_sec)
+            energy[pos:pos + length] = rng.uniform(0.0, 0.05, size=len(energy[pos:pos + length]))
+        pos += length
+        speaking = not speaking
+    return energy
+
+
+def timed(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        cost = time.perf_counter() - t0
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+def bench_valleys(args):
+    energy = synthetic_energy(args.hours, args.sr, args.hop_length)
+    print(f"合成包络：{args.hours}小时，采样率{args.sr}，共{len(energy)}帧")
+    t_loop, v_loop = timed(lambda: find_valleys_loop(energy, args.sr, hop_length=args.hop_length), args.repeat)
+    t_vec, v_vec = timed(lambda: audio_cut.find_valleys_from_energy(energy, args.sr, hop_length=args.hop_length), args.repeat)
+    t_arr, v_arr = timed(lambda: audio_cut.find_valleys_from_energy(energy, args.sr, hop_length=args.hop_length, as_array=True), args.repeat)
+    assert v_loop == v_vec, "向量化结果与逐帧循环结果不一致"
+    y_stub = np.empty(len(energy) * args.hop_length, dtype=np.int8)
+    t_seg_list, s_list = timed(lambda: audio_cut.segment_audio_by_valley_duration(y_stub, args.sr, v_loop), args.repeat)
+    t_seg_arr, s_arr = timed(lambda: audio_cut.segment_audio_by_valley_duration(y_stub, args.sr, v_arr), args.repeat)
+    assert s_list == s_arr, "结构化数组与元组列表的分段结果不一致"
+    print(f"低谷数：{len(v_vec)}，片段数：{len(s_arr)}")
+    print(f"find_valleys 逐帧循环:   {t_loop * 1000:9.1f} ms")
+    print(f"find_valleys 向量化列表: {t_vec * 1000:9.1f} ms  ({t_loop / t_vec:.1f}x)")
+    print(f"find_valleys 结构化数组: {t_arr * 1000:9.1f} ms  ({t_loop / t_arr:.1f}x)")
+    print(f"segment 元组列表输入:    {t_seg_list * 1000:9.1f} ms")
+    print(f"segment 结构化数组输入:  {t_seg_arr * 1000:9.1f} ms")
+
+
+# 解析 python -X importtime 的输出，返回 {模块名: (自身耗时us, 累计耗时us, 缩进层级)}
+def parse_importtime(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if m:
+            modules[m.group(4)] = (int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2)
+    return modules
+
+
+def bench_startup(args):
+    totals = []
+    modules = {}
+    for _ in range(args.repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", args.code],
+                              capture_output=True, text=True, check=True)
+        modules = parse_importtime(proc.stderr)
+        totals.append(sum(cum for _, cum, level in modules.values() if level == 0) / 1000)
+    best = min(totals)
+    print(f"{args.code}")
+    print(f"导入耗时: 最快 {best:.1f} ms，中位 {sorted(totals)[len(totals) // 2]:.1f} ms（{args.repeat}次）")
+    print("自身耗时最多的模块：")
+    for name, (self_us, cum_us, _) in sorted(modules.items(), key=lambda kv: -kv[1][0])[:args.top]:
+        print(f"  {name:40s} self {self_us / 1000:7.1f} ms  cumulative {cum_us / 1000:7.1f} ms")
+    failed = False
+    heavy = [name for name in args.forbid.split(',') if name and name in modules]
+    if heavy:
+        print(f"回归：启动时导入了重量级模块 {heavy}")
+        failed = True
+    if args.max_ms and best > args.max_ms:
+        print(f"回归：启动耗时 {best:.1f} ms 超过上限 {args.max_ms} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def synthetic_corpus(out_dir, n_files, sr, channels=1, min_sec=3.0, max_sec=25.0, seed=0):
+    """
+    生成确定性的合成语料：一个说话人子文件夹，音调片段与静音交替
+    :return: 语料总时长（秒）
+    """
+    rng = np.random.default_rng(seed)
+    speaker_dir = os.path.join(out_dir, "speaker")
+    os.makedirs(speaker_dir, exist_ok=True)
+    total = 0.0
+    for i in range(n_files):
+        duration = rng.uniform(min_sec, max_sec)
+        t = np.arange(int(duration * sr)) / sr
+        tone = 0.3 * np.sin(2 * np.pi * rng.uniform(120, 400) * t) * (np.sin(2 * np.pi * 0.5 * t) > -0.3)
+        data = np.repeat(tone[:, None], channels, axis=1).astype(np.float32)
+        sf.write(os.path.join(speaker_dir, f"{i:06d}.wav"), data, sr)
+        total += duration
+    return total
+
+
+def bench_resample(args):
+    import subfix_create_dataset
+
+    backends = args.backends.split(',')
+    if "ffmpeg" in backends and shutil.which("ffmpeg") is None:
+        print("未安装ffmpeg，跳过ffmpeg后端")
+        backends.remove("ffmpeg")
+    with tempfile.TemporaryDirectory() as tmp:
+        origin = os.path.join(tmp, "origin")
+        total = synthetic_corpus(origin, args.files, args.src_sr, channels=args.channels)
+        print(f"合成语料：{args.files}个文件，{total:.1f}秒，{args.src_sr}Hz {args.channels}声道 -> {args.dst_sr}Hz")
+        for backend in backends:
+            target = os.path.join(tmp, f"resample_{backend}")
+            t0 = time.perf_counter()
+            failures = subfix_create_dataset.resample_audios(origin, target, args.dst_sr, workers=args.workers, resampler=backend)
+            cost = time.perf_counter() - t0
+            print(f"{backend:8s} {cost:8.2f} s  {args.files / cost:8.1f} files/s  实时率 {cost / total:.4f}  失败 {len(failures)}")
+
+
+# 旧版写出方式：先np.concatenate拼接再写，仅作为基准对照
+class ConcatWriter:
+    def write(self, path, parts, sample_rate):
+        sf.write(path, np.concatenate(parts), sample_rate)
+
+
+def synthetic_sentences(seconds, seed=0):
+    # 模拟ASR结果：0.5~4秒的句子，约三分之一以句号结尾
+    rng = np.random.default_rng(seed)
+    sentences = []
+    t = 0.0
+    while True:
+        length = rng.uniform(0.5, 4.0)
+        if t + length > seconds:
+            break
+        text = "测试" + ("。" if rng.random() < 0.35 else "，")
+        sentences.append({"start": int(t * 1000), "end": int((t + length) * 1000), "text": text})
+        t += length + rng.uniform(0.1, 0.6)
+    return {"sentences": sentences}
+
+
+def bench_slicewrite(args):
+    import subfix_create_dataset
+
+    n = int(args.minutes * 60 * args.sr)
+    data = (0.1 * np.random.default_rng(0).standard_normal(n)).astype(np.float32)
+    rec_result = synthetic_sentences(args.minutes * 60)
+    print(f"合成输入：{args.minutes}分钟，{args.sr}Hz，{len(rec_result['sentences'])}句")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, writer in [("np.concatenate", ConcatWriter()), ("SoundFile流式", None)]:
+            out_dir = os.path.join(tmp, "concat" if writer is not None else "stream")
+            os.makedirs(out_dir)
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            lines, _ = subfix_create_dataset.slice_source(data, rec_result, args.sr, out_dir, "speaker", "ZH", 0,
+                                                          args.max_seconds, True, writer=writer)
+            cost = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{name:14s} 峰值分配 {peak / 2 ** 20:8.2f} MiB  耗时 {cost:6.2f} s  输出 {len(lines)} 条")
+
+
+def synthetic_speech(seconds, sr, rng, burst=(0.8, 6.0), gap=(0.1, 1.2)):
+    """
+    模拟语音的波形：随机音高的音调片段（带音节起伏）与长度可控的近似静音间隔交替
+    :param burst: 音调片段时长范围（秒）
+    :param gap: 静音间隔时长范围（秒）
+    """
+    n = int(seconds * sr)
+    data = (0.001 * rng.standard_normal(n)).astype(np.float32)
+    pos = int(rng.uniform(*gap) * sr)
+    while pos < n:
+        length = min(int(rng.uniform(*burst) * sr), n - pos)
+        t = np.arange(length) / sr
+        syllables = 0.6 + 0.4 * np.sin(2 * np.pi * rng.uniform(3.0, 6.0) * t)
+        data[pos:pos + length] += (0.3 * syllables * np.sin(2 * np.pi * rng.uniform(120, 400) * t)).astype(np.float32)
+        pos += length + int(rng.uniform(*gap) * sr)
+    return data
+
+
+def synthetic_speech_corpus(out_dir, n_files, sr, min_sec=40.0, max_sec=240.0, burst=(0.8, 6.0), gap=(0.1, 1.2), seed=0):
+    """
+    生成确定性的端到端合成语料：n_files个长音频，超过30秒的会被audio_cut切分
+    :return: 语料总时长（秒）
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    total = 0.0
+    for i in range(n_files):
+        duration = rng.uniform(min_sec, max_sec)
+        sf.write(os.path.join(out_dir, f"{i:06d}.wav"), synthetic_speech(duration, sr, rng, burst, gap), sr)
+        total += duration
+    return total
+
+
+class StubASR:
+    """
+    代替modelscope识别管线：按能量把每段发声识别为一句，文本长度与时长相当，约三分之一以句号结尾；
+    rtf>0时按音频时长休眠，模拟识别耗时。默认与真实管线一样支持单条或列表输入，list_input=False时模拟不支持列表输入的管线；
+    batches按调用顺序记录每次调用的输入形状（各条音频的采样点数），用于检查批处理效率
+    """
+
+    def __init__(self, rtf=0.0, list_input=True):
+        self.rtf = rtf
+        self.list_input = list_input
+        self.batches = []
+
+    def recognize(self, audio, audio_fs):
+        energy = audio_cut.rms_envelope(np.asarray(audio, dtype=np.float32), frame_length=400, hop_length=160)
+        if self.rtf > 0:
+            time.sleep(self.rtf * len(audio) / audio_fs)
+        voiced = np.concatenate([[False], energy > 0.1 * (energy.max() if len(energy) else 0.0), [False]])
+        edges = np.flatnonzero(voiced[1:] != voiced[:-1])
+        sentences = []
+        for i, (start, end) in enumerate(zip(edges[::2], edges[1::2])):
+            start_ms, end_ms = int(start * 10), int(end * 10)
+            if end_ms - start_ms < 200:
+                continue
+            text = "测试" * max(1, (end_ms - start_ms) // 600) + ("。" if i % 3 == 2 else "，")
+            sentences.append({"start": start_ms, "end": end_ms, "text": text})
+        return {"text": "".join(s["text"] for s in sentences), "sentences": sentences}
+
+    def __call__(self, audio_in, audio_fs=16000):
+        if isinstance(audio_in, list):
+            if not self.list_input:
+                raise TypeError("audio_in must be a single waveform")
+            self.batches.append([len(audio) for audio in audio_in])
+            return [self.recognize(audio, audio_fs) for audio in audio_in]
+        self.batches.append([len(audio_in)])
+        return self.recognize(audio_in, audio_fs)
+
+
+def run_stage(stage, work_dir, options):
+    """
+    在独立的子进程中运行一个阶段，返回该阶段的StageMetrics报告；子进程的峰值内存即该阶段的峰值内存
+    """
+    import subfix_create_dataset
+
+    metrics = StageMetrics()
+    # 各阶段逐文件的输出（包括进程池子进程的输出）对基准没有意义，整个子进程的标准输出都丢弃
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if stage == "cut":
+            audio_cut.process_audio_files(os.path.join(work_dir, "origin"), os.path.join(work_dir, "fragment", "speaker"),
+                                          workers=options["workers"], metrics=metrics)
+        elif stage == "resample":
+            subfix_create_dataset.resample_audios(os.path.join(work_dir, "fragment"), os.path.join(work_dir, "fragment_resample"),
+                                                  options["dst_sr"], workers=options["workers"], resampler=options["resampler"], metrics=metrics)
+        elif stage == "dataset":
+            subfix_create_dataset.create_dataset(os.path.join(work_dir, "fragment_resample"), os.path.join(work_dir, "dataset"),
+                                                 options["dst_sr"], "ZH", StubASR(options["asr_rtf"]), options["max_seconds"], True,
+                                                 asr_batch_size=options["asr_batch_size"], decode_workers=options["decode_workers"],
+                                                 write_workers=options["write_workers"], metrics=metrics)
+    return metrics.report()
+
+
+def per_call(func, repeat):
+    # 像timeit一样自动选择调用次数，使每轮至少0.2秒，返回多轮中最快的单次耗时；毫秒级的函数也能稳定比较
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench_micro(hours, sr, hop_length=512, repeat=3):
+    # 切分核心函数的单独计时：在合成包络上查找低谷，以及合并短片段
+    energy = synthetic_energy(hours, sr, hop_length)
+    n_samples = len(energy) * hop_length
+    valleys = audio_cut.find_valleys_from_energy(energy, sr, hop_length=hop_length, as_array=True)
+    raw_segments = audio_cut.segment_audio_by_valley_duration(None, sr, valleys, audio_len=n_samples)
+    t_valleys = per_call(lambda: audio_cut.find_valleys_from_energy(energy, sr, hop_length=hop_length, as_array=True), repeat)
+    t_merge = per_call(lambda: audio_cut.merge_short_segments(raw_segments, sr), repeat)
+    audio_seconds = n_samples / sr
+    return {name: {"wall_seconds": seconds, "audio_seconds": audio_seconds, "rtf": seconds / audio_seconds, "micro": True}
+            for name, seconds in [("find_valleys", t_valleys), ("merge_short_segments", t_merge)]}
+
+
+def stage_peak_mb(stage):
+    # 裁剪、重采样在进程池子进程中运行，阶段的峰值内存取主进程与子进程中较大的一个
+    peaks = [stage.get(key) for key in ("peak_rss_mb", "children_peak_rss_mb") if stage.get(key)]
+    return max(peaks) if peaks else None
+
+
+def compare_results(results, baseline, max_slowdown=0.15, max_memory_growth=0.2, min_seconds=0.05):
+    """
+    与基线逐阶段比较耗时（墙钟时间，子阶段用累计忙碌时间）和峰值内存
+    :return: 超过阈值的回归说明列表
+    """
+    regressions = []
+    print(f"{'stage':22s} {'base s':>9s} {'now s':>9s} {'change':>8s} {'base MB':>8s} {'now MB':>8s}")
+    for name, stage in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        key = "wall_seconds" if base.get("wall_seconds") else "busy_seconds"
+        before, now = base.get(key) or 0.0, stage.get(key) or 0.0
+        change = now / before - 1 if before else 0.0
+        base_peak, peak = stage_peak_mb(base), stage_peak_mb(stage)
+        print(f"{name:22s} {before:9.4f} {now:9.4f} {change:+8.1%} {base_peak or 0:8.0f} {peak or 0:8.0f}")
+        # 太短的流水线阶段计时噪声大，不参与判断；单独计时的函数已多次调用取最快，不受此限制
+        if change > max_slowdown and (stage.get("micro") or max(before, now) >= min_seconds):
+            regressions.append(f"{name}: {key} {before:.4f}s -> {now:.4f}s ({change:+.1%}, 阈值 {max_slowdown:+.0%})")
+        if base_peak and peak:
+            growth = peak / base_peak - 1
+            if growth > max_memory_growth:
+                regressions.append(f"{name}: 峰值内存 {base_peak:.0f}MB -> {peak:.0f}MB ({growth:+.1%}, 阈值 {max_memory_growth:+.0%})")
+    return regressions
+
+
+def bench_pipeline(args):
+    options = {"workers": args.workers, "dst_sr": args.dst_sr, "resampler": args.resampler or "inproc", "max_seconds": args.max_seconds,
+               "asr_rtf": args.asr_rtf, "asr_batch_size": args.asr_batch_size, "decode_workers": args.decode_workers,
+               "write_workers": args.write_workers}
+    # 语料与参数都记录在结果中，只有相同配置的结果才能比较
+    config = dict(options, files=args.files, min_sec=args.min_sec, max_sec=args.max_sec, src_sr=args.src_sr, seed=args.seed,
+                  micro_hours=args.micro_hours)
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        origin = os.path.join(tmp, "origin")
+        total = synthetic_speech_corpus(origin, args.files, args.src_sr, args.min_sec, args.max_sec, seed=args.seed)
+        print(f"合成语料：{args.files}个文件，{total / 60:.1f}分钟，{args.src_sr}Hz -> {args.dst_sr}Hz")
+        for run in range(args.repeat):
+            work_dir = os.path.join(tmp, f"run{run}")
+            os.makedirs(work_dir)
+            os.symlink(origin, os.path.join(work_dir, "origin"))
+            for stage in ("cut", "resample", "dataset"):
+                # spawn出的全新进程，峰值内存不受前面阶段影响
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    report = executor.submit(run_stage, stage, work_dir, options).result()
+                for name, stage_report in report.items():
+                    # 多次运行取最快的一次
+                    best = stages.get(name)
+                    if best is None or (stage_report["wall_seconds"] or stage_report["busy_seconds"]) < (best["wall_seconds"] or best["busy_seconds"]):
+                        stages[name] = stage_report
+            shutil.rmtree(work_dir)
+    stages.update(bench_micro(args.micro_hours, args.dst_sr, repeat=max(3, args.repeat)))
+    results = {"config": config, "python": platform.python_version(), "platform": platform.platform(), "stages": stages}
+    print(f"{'stage':22s} {'wall s':>9s} {'busy s':>9s} {'RTF':>8s} {'files/s':>8s} {'peak MB':>8s}")
+    for name, stage in stages.items():
+        print(f"{name:22s} {stage['wall_seconds']:9.4f} {stage.get('busy_seconds', 0.0):9.3f} {stage['rtf'] or 0:8.5f} "
+              f"{stage.get('files_per_sec') or 0:8.1f} {stage_peak_mb(stage) or 0:8.0f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            print(f"未找到基线 {args.baseline}，请先用 --output {args.baseline} 保存一次结果")
+            sys.exit(2)
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"基线配置不同，无法比较：{baseline['config']}")
+            sys.exit(2)
+        regressions = compare_results(results, baseline, args.max_slowdown, args.max_memory_growth, args.min_seconds)
+        if regressions:
+            print("回归：")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("未发现超过阈值的回归")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="音频处理流程的性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_valleys = sub.add_parser("valleys", help="对比find_valleys逐帧循环与向量化实现")
+    p_valleys.add_argument('--hours', type=float, default=3.0, help='合成信号时长（小时），默认3')
+    p_valleys.add_argument('--sr', type=int, default=48000, help='采样率，默认48000')
+    p_valleys.add_argument('--hop_length', type=int, default=512, help='帧移，默认512')
+    p_valleys.add_argument('--repeat', type=int, default=3, help='重复次数，取最快一次，默认3')
+    p_valleys.set_defaults(func=bench_valleys)
+
+    p_startup = sub.add_parser("startup", help="用python -X importtime统计裁剪工具的启动耗时")
+    # librosa的子模块是懒加载的，只import不调用会低估启动耗时，因此默认再做一次最小的低谷查找
+    p_startup.add_argument('--code', type=str,
+                           default="import numpy as np, audio_cut; audio_cut.find_valleys(np.ones(48000, dtype=np.float32), 16000)",
+                           help='在新进程中执行并统计导入耗时的代码，默认导入audio_cut并查找一次低谷')
+    p_startup.add_argument('--repeat', type=int, default=5, help='重复次数，默认5')
+    p_startup.add_argument('--top', type=int, default=10, help='列出自身耗时最多的模块数，默认10')
+    p_startup.add_argument('--forbid', type=str, default='librosa,numba,scipy', help='启动时不应导入的模块，逗号分隔')
+    p_startup.add_argument('--max_ms', type=float, default=None, help='启动耗时上限（毫秒），超过则以非零状态退出')
+    p_startup.set_defaults(func=bench_startup)
+
+    p_resample = sub.add_parser("resample", help="在同一份合成语料上对比各重采样后端")
+    p_resample.add_argument('--backends', type=str, default='ffmpeg,inproc,librosa', help='参与对比的后端，逗号分隔')
+    p_resample.add_argument('--files', type=int, default=40, help='合成文件数，默认40')
+    p_resample.add_argument('--src_sr', type=int, default=44100, help='源采样率，默认44100')
+    p_resample.add_argument('--dst_sr', type=int, default=48000, help='目标采样率，默认48000')
+    p_resample.add_argument('--channels', type=int, default=2, help='声道数，默认2')
+    p_resample.add_argument('--workers', type=int, default=os.cpu_count(), help='并发数，默认CPU核数')
+    p_resample.set_defaults(func=bench_resample)
+
+    p_slicewrite = sub.add_parser("slicewrite", help="用tracemalloc对比多段切分写出时拼接与流式写入的峰值内存")
+    p_slicewrite.add_argument('--minutes', type=float, default=30.0, help='合成输入时长（分钟），默认30')
+    p_slicewrite.add_argument('--sr', type=int, default=48000, help='采样率，默认48000')
+    p_slicewrite.add_argument('--max_seconds', type=int, default=15, help='单条最大时长（秒），默认15')
+    p_slicewrite.set_defaults(func=bench_slicewrite)
+
+    p_pipeline = sub.add_parser("pipeline", help="在合成语料上端到端运行裁剪、重采样和生成数据集（识别用StubASR代替），可与基线比较")
+    p_pipeline.add_argument('--files', type=int, default=12, help='合成长音频文件数，默认12')
+    p_pipeline.add_argument('--min_sec', type=float, default=40.0, help='单个文件最短时长（秒），默认40')
+    p_pipeline.add_argument('--max_sec', type=float, default=240.0, help='单个文件最长时长（秒），默认240')
+    p_pipeline.add_argument('--src_sr', type=int, default=44100, help='源采样率，默认44100')
+    p_pipeline.add_argument('--dst_sr', type=int, default=48000, help='目标采样率，默认48000')
+    p_pipeline.add_argument('--seed', type=int, default=0, help='随机种子，相同种子生成相同语料，默认0')
+    p_pipeline.add_argument('--workers', type=int, default=2, help='裁剪和重采样的进程数，默认2')
+    p_pipeline.add_argument('--resampler', type=str, default=None, help='重采样后端，默认inproc（不依赖ffmpeg，结果可比）')
+    p_pipeline.add_argument('--max_seconds', type=int, default=15, help='单条最大时长（秒），默认15')
+    p_pipeline.add_argument('--asr_rtf', type=float, default=0.0, help='StubASR模拟的识别实时率，0为不休眠，默认0')
+    p_pipeline.add_argument('--asr_batch_size', type=int, default=1, help='每次识别调用合并的片段数，默认1')
+    p_pipeline.add_argument('--decode_workers', type=int, default=2, help='解码线程数，默认2')
+    p_pipeline.add_argument('--write_workers', type=int, default=2, help='写出线程数，默认2')
+    p_pipeline.add_argument('--micro_hours', type=float, default=1.0, help='find_valleys和merge_short_segments单独计时用的合成包络时长（小时），默认1')
+    p_pipeline.add_argument('--repeat', type=int, default=1, help='重复运行次数，每个阶段取最快一次，默认1')
+    p_pipeline.add_argument('--output', type=str, default=None, help='将结果保存为JSON，也可作为之后比较的基线')
+    p_pipeline.add_argument('--baseline', type=str, default=None, help='与该JSON基线比较，超过阈值时以非零状态退出')
+    p_pipeline.add_argument('--max_slowdown', type=float, default=0.15, help='允许的耗时增长比例，默认0.15')
+    p_pipeline.add_argument('--max_memory_growth', type=float, default=0.2, help='允许的峰值内存增长比例，默认0.2')
+    p_pipeline.add_argument('--min_seconds', type=float, default=0.05, help='耗时低于该值（秒）的阶段不判断回归，默认0.05')
+    p_pipeline.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,39 +1,49 @@
 import os
 import shutil
 
+from stage_manifest import read_manifest
+
 def copy_file(src, dst):
     os.makedirs(os.path.dirname(dst), exist_ok=True)
     shutil.copy2(src, dst)
 
-def copy_folder_files(src_folder, dst_folder):
-    os.makedirs(dst_folder, exist_ok=True)
-    for filename in os.listdir(src_folder):
-        src_path = os.path.join(src_folder, filename)
-        dst_path = os.path.join(dst_folder, filename)
-        if os.path.isfile(src_path):
-            shutil.copy2(src_path, dst_path)
+def final_names(speaker_id, index):
+    # 最终输出的音频和文本文件名
+    audio_name = f"{index:04d}"
+    return f"{speaker_id}_{audio_name}.mp3", f"{speaker_id}_{audio_name}.normalized.txt"
+
+def pair_files(src_dataset, src_txts):
+    """
+    音频与文本一一配对，按音频路径排序
+    有txts清单时按其中记录的wav_path配对（网页中分割、合并产生的片段不在dataset的清单中），
+    否则遍历两个文件夹，按文件名（不含扩展名）配对；音频与文本数量不一致时报错，不输出错配的数据
+    :return: [(音频路径, 文本路径), ...]
+    """
+    entries = read_manifest(src_txts)
+    if entries is not None:
+        dataset_dir = os.path.abspath(src_dataset)
+        pairs = sorted((entry["wav_path"], os.path.join(src_txts, entry["path"])) for entry in entries
+                       if os.path.dirname(os.path.abspath(entry["wav_path"])) == dataset_dir)
+        missing = [wav_path for wav_path, _ in pairs if not os.path.isfile(wav_path)]
+        if missing:
+            raise ValueError(f"{len(missing)}个文本对应的音频不存在，例如 {missing[0]}，请重新运行list2txt.py")
+        return pairs
+    wav_files = {os.path.splitext(f)[0]: f for f in os.listdir(src_dataset) if f.lower().endswith('.wav')}
+    txt_files = {os.path.splitext(f)[0]: f for f in os.listdir(src_txts) if f.lower().endswith('.txt')}
+    if wav_files.keys() != txt_files.keys():
+        raise ValueError(f"{src_dataset}下有{len(wav_files)}个音频，{src_txts}下有{len(txt_files)}个文本，"
+                         f"{len(wav_files.keys() ^ txt_files.keys())}个文件无法配对，请重新运行list2txt.py")
+    return [(os.path.join(src_dataset, wav_files[name]), os.path.join(src_txts, txt_files[name])) for name in sorted(wav_files)]
 
-def rename_files_in_folder(folder, speaker_id):
-    # 收集所有wav和txt文件
-    wav_files = [f for f in os.listdir(folder) if f.lower().endswith('.wav')]
-    txt_files = [f for f in os.listdir(folder) if f.lower().endswith('.txt')]
-    # 按文件名排序，确保一一对应
-    wav_files.sort()
-    txt_files.sort()
-    count = 0
-    for wav_file, txt_file in zip(wav_files, txt_files):
-        audio_name = f"{count:04d}"
-        mp3_filename = f"{speaker_id}_{audio_name}.mp3"
-        txt_filename = f"{speaker_id}_{audio_name}.normalized.txt"
-        wav_src = os.path.join(folder, wav_file)
-        txt_src = os.path.join(folder, txt_file)
-        mp3_dst = os.path.join(folder, mp3_filename)
-        txt_dst = os.path.join(folder, txt_filename)
+def copy_pairs(pairs, dst_folder, speaker_id):
+    # 按配对顺序复制并直接以最终文件名写出
+    os.makedirs(dst_folder, exist_ok=True)
+    for count, (wav_src, txt_src) in enumerate(pairs):
+        mp3_filename, txt_filename = final_names(speaker_id, count)
         # wav重命名为mp3后缀（如需转换可自行添加转换代码）
-        os.rename(wav_src, mp3_dst)
-        os.rename(txt_src, txt_dst)
-        count += 1
-    print(f"已完成重命名 {count} 对文件。")
+        shutil.copy2(wav_src, os.path.join(dst_folder, mp3_filename))
+        shutil.copy2(txt_src, os.path.join(dst_folder, txt_filename))
+    print(f"已完成重命名 {len(pairs)} 对文件。")
 
 if __name__ == "__main__":
     # 1. 移动 demo.list
@@ -54,23 +64,18 @@ if __name__ == "__main__":
     target_folder_name = subfolders[0]  # 取第一个子文件夹名
     print(f"目标子文件夹名: {target_folder_name}")
 
-    # 3. 移动 dataset\funina 和 txts 下的所有文件
+    # 3. dataset\funina 和 txts 下的文件
     src_dataset = os.path.join("./dataset", target_folder_name)
     src_txts = "./txts"
     dst_subfolder = os.path.join("./_Final_Output", target_folder_name)
 
-    if os.path.exists(src_dataset):
-        copy_folder_files(src_dataset, dst_subfolder)
-        print(f"已复制 {src_dataset} 下所有文件到 {dst_subfolder}")
-    else:
+    if not os.path.exists(src_dataset):
         print(f"未找到 {src_dataset}")
-
-    if os.path.exists(src_txts):
-        copy_folder_files(src_txts, dst_subfolder)
-        print(f"已复制 {src_txts} 下所有文件到 {dst_subfolder}")
-    else:
+        exit(1)
+    if not os.path.exists(src_txts):
         print(f"未找到 {src_txts}")
-
-    # 4. 重命名新子文件夹下的文件
+        exit(1)
+    # 4. 按音频与文本的配对复制到新子文件夹并重命名
     speaker_id = target_folder_name
-    rename_files_in_folder(dst_subfolder, speaker_id)
\ No newline at end of file
+    copy_pairs(pair_files(src_dataset, src_txts), dst_subfolder, speaker_id)
+    print(f"已复制 {src_dataset} 和 {src_txts} 下的文件到 {dst_subfolder}")
@@ -1,22 +1,39 @@
 import os
 
+from stage_manifest import write_manifest
+
 input_list = r'demo.list'
 output_dir = 'txts'
 
-os.makedirs(output_dir, exist_ok=True)
-
-with open(input_list, 'r', encoding='utf-8') as f:
-    for line in f:
-        line = line.strip()
-        if not line:
-            continue
-        parts = line.split('|')
-        if len(parts) < 4:
-            continue
-        wav_path = parts[0]
-        text = parts[3]
-        base_name = os.path.splitext(os.path.basename(wav_path))[0]
-        out_path = os.path.join(output_dir, base_name + '.txt')
-        with open(out_path, 'w', encoding='utf-8') as fout:
-            fout.write(text)
-print(f'已完成，将所有文本写入 {output_dir} 文件夹。')
\ No newline at end of file
+
+def read_list(list_path):
+    # (音频路径, 文本)，跳过空行和字段不全的行
+    items = []
+    with open(list_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split('|')
+            if len(parts) < 4:
+                continue
+            items.append((parts[0], parts[3]))
+    return items
+
+
+def write_txt(output_dir, wav_path, text):
+    # 写出与音频同名的文本文件，返回清单条目
+    base_name = os.path.splitext(os.path.basename(wav_path))[0]
+    out_path = os.path.join(output_dir, base_name + '.txt')
+    with open(out_path, 'w', encoding='utf-8') as fout:
+        fout.write(text)
+    # 记录文本对应的音频，copy_to_final_output.py据此配对，无需遍历文件夹
+    return {"path": base_name + '.txt', "wav_path": wav_path, "bytes": os.path.getsize(out_path)}
+
+
+if __name__ == "__main__":
+    os.makedirs(output_dir, exist_ok=True)
+    entries = [write_txt(output_dir, wav_path, text) for wav_path, text in read_list(input_list)]
+    # 列表是全部文本的来源，清单只保留本次写出的文本，网页中删除、合并掉的行不会残留
+    write_manifest(output_dir, entries)
+    print(f'已完成，将所有文本写入 {output_dir} 文件夹。')
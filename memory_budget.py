@@ -0,0 +1,119 @@
+import os
+import re
+import threading
+import time
+
+import soundfile
+
+from stage_metrics import peak_rss_mb
+
+# bytes per decoded sample: every tool decodes to float32
+SAMPLE_BYTES = 4
+
+
+def parse_size(text):
+    """
+    "2G", "512M", "1.5g", "800K" or a plain number of MB, as given to --max_memory.
+    :return: bytes, or None for no budget
+    """
+    if text is None or str(text).strip() in ("", "0"):
+        return None
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kKmMgG]?)[bB]?\s*", str(text))
+    if not m:
+        raise ValueError(f"cannot parse memory size {text!r}, use e.g. 2G or 512M")
+    scale = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}.get(m.group(2).lower(), 1 << 20)
+    return int(float(m.group(1)) * scale)
+
+
+def estimate_decoded_bytes(path, sr=None):
+    """
+    Memory a whole-file decode needs, from the header alone: the decoded float32 frames of all
+    channels, their mono mix and, when sr differs from the file's rate, the resampled copy.
+    :return: bytes, or None when soundfile cannot read the header (the tools then fall back to librosa)
+    """
+    try:
+        info = soundfile.info(path)
+    except Exception:
+        return None
+    frames = info.frames
+    resampled = sr is not None and sr != info.samplerate
+    out_frames = int(frames * sr / info.samplerate) + 1 if resampled else 0
+    mono = frames if info.channels > 1 else 0
+    return (frames * info.channels + mono + out_frames) * SAMPLE_BYTES
+
+
+def over_budget(path, max_bytes, sr=None):
+    # False when there is no budget or the size cannot be told from the header
+    if not max_bytes:
+        return False
+    estimate = estimate_decoded_bytes(path, sr)
+    return estimate is not None and estimate > max_bytes
+
+
+def current_rss_mb():
+    # resident set size right now; /proc on Linux, elsewhere only the peak so far is known
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()[0]
+
+
+class MemoryWatch:
+    """
+    Samples the resident set size of this process on a background thread, so the peak
+    while one file was being processed can be logged next to it; take() returns the peak
+    since the previous take().
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = current_rss_mb() or 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss_mb() or 0.0
+            with self.lock:
+                self.peak = max(self.peak, rss)
+
+    def take(self):
+        rss = current_rss_mb() or 0.0
+        with self.lock:
+            peak, self.peak = max(self.peak, rss), rss
+        return peak
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def measured_call(func, *args, watch_memory=True, **kwargs):
+    """
+    Like stage_metrics.timed_call, plus the peak RSS of this process during the call and how far
+    that peak rose above the RSS at the start of the call. The growth is what the call itself
+    needed and is what a per-file budget should be held against; calls running side by side in
+    other threads of the same process are counted in it too.
+    With watch_memory=False no sampler thread is started and both memory figures are None.
+    :return: (result, seconds, peak MB, growth MB)
+    """
+    if not watch_memory:
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        return result, time.perf_counter() - t0, None, None
+    with MemoryWatch() as watch:
+        baseline = watch.peak
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - t0
+        peak = watch.take()
+        return result, seconds, peak, max(peak - baseline, 0.0)
@@ -0,0 +1,114 @@
+import os
+import argparse
+import itertools
+import json
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from audio_cut import compute_envelope, list_audio_files, plan_segments
+
+# 子进程中共享的能量包络列表 [(audio_file, energy, n_samples, sr), ...]
+_envelopes = []
+
+def _init_worker(envelopes):
+    global _envelopes
+    _envelopes = envelopes
+
+# 按终端显示宽度右对齐，中文字符占两列
+def _rjust(text, width):
+    display = sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+    return " " * max(0, width - display) + text
+
+# 在内存中的能量包络上评估一组切分参数
+def evaluate_setting(setting, bins):
+    """
+    :param setting: 参数字典，包含energy_threshold、min_valley_duration、max_len、merge_thresh
+    :param bins: 片段时长直方图的边界（秒）
+    :return: 该参数下的统计结果
+    """
+    lengths = []
+    forced_cuts = 0
+    for audio_file, energy, n_samples, sr in _envelopes:
+        if n_samples / sr <= 30.0:
+            # 与audio_cut一致，不超过30秒的音频不切分
+            lengths.append(n_samples / sr)
+            continue
+        segments, raw_segments, valleys = plan_segments(energy, n_samples, sr, **setting)
+        # 切点不在任何低谷结束位置上，说明是按max_len强制裁剪的
+        cut_points = np.array([end for _, end in raw_segments[:-1]], dtype=np.int64)
+        forced_cuts += int(np.count_nonzero(~np.isin(cut_points, valleys['end'])))
+        lengths.extend((end - start) / sr for start, end in segments)
+    lengths = np.array(lengths)
+    hist, _ = np.histogram(lengths, bins=bins)
+    return {
+        **setting,
+        "segments": len(lengths),
+        "forced_cuts": forced_cuts,
+        "under_3s": int(np.count_nonzero(lengths < 3.0)),
+        "mean_len": float(lengths.mean()) if len(lengths) else 0.0,
+        "max_len_seen": float(lengths.max()) if len(lengths) else 0.0,
+        "histogram": hist.tolist(),
+    }
+
+def _parse_floats(text):
+    return [float(x) for x in text.split(',') if x.strip()]
+
+def _load_envelope(audio_file, cache_dir):
+    energy, n_samples, sr = compute_envelope(audio_file, cache_dir=cache_dir)
+    return audio_file, energy, n_samples, sr
+
+# 每个文件只解码一次，在内存中并行评估参数网格
+def sweep(input_path, grid, bins, workers=1, cache_dir=None):
+    """
+    :param input_path: 输入音频文件夹或单个文件
+    :param grid: 参数网格 {参数名: [取值, ...]}
+    :param bins: 片段时长直方图的边界（秒）
+    :param workers: 并行进程数
+    :param cache_dir: 能量包络缓存文件夹
+    :return: 每组参数的统计结果列表
+    """
+    audio_files = list_audio_files(input_path)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        envelopes = list(executor.map(_load_envelope, audio_files, itertools.repeat(cache_dir)))
+    total_sec = sum(n_samples / sr for _, _, n_samples, sr in envelopes)
+    print(f"已计算{len(envelopes)}个文件的能量包络，总时长{total_sec / 3600:.2f}小时")
+    keys = list(grid)
+    settings = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(envelopes,)) as executor:
+        return list(executor.map(evaluate_setting, settings, itertools.repeat(bins), chunksize=max(1, len(settings) // (workers * 4))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="切分参数扫描：每个文件只解码一次，在内存中评估多组参数，输出片段时长分布、强制裁剪数和小于3秒的片段数")
+    parser.add_argument('--audio', type=str, default='./origin', help='输入音频文件夹或单个音频文件路径，默认./origin')
+    parser.add_argument('--energy_threshold', type=str, default='0.05,0.1,0.15', help='能量阈值取值，逗号分隔')
+    parser.add_argument('--min_valley_duration', type=str, default='0.2,0.3,0.5', help='低谷最小持续时间（秒）取值，逗号分隔')
+    parser.add_argument('--max_len', type=str, default='28', help='最大片段长度（秒）取值，逗号分隔')
+    parser.add_argument('--merge_thresh', type=str, default='6,10,14', help='合并阈值（秒）取值，逗号分隔')
+    parser.add_argument('--bins', type=str, default='0,3,5,10,15,20,25,30', help='片段时长直方图边界（秒），逗号分隔')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='并行进程数，默认CPU核数')
+    parser.add_argument('--cache_dir', type=str, default=None, help='能量包络缓存文件夹，与audio_cut.py共用')
+    parser.add_argument('--output', type=str, default=None, help='将结果保存为JSON文件')
+    args = parser.parse_args()
+
+    grid = {
+        "energy_threshold": _parse_floats(args.energy_threshold),
+        "min_valley_duration": _parse_floats(args.min_valley_duration),
+        "max_len": _parse_floats(args.max_len),
+        "merge_thresh": _parse_floats(args.merge_thresh),
+    }
+    bins = _parse_floats(args.bins) + [float('inf')]
+    results = sweep(args.audio, grid, bins, workers=args.workers, cache_dir=args.cache_dir)
+    labels = [f"{lo:g}-{hi:g}" for lo, hi in zip(bins[:-1], bins[1:])]
+    # 表头与数据行使用相同的列宽
+    widths = [8, 8, 8, 8, 10, 12, 8]
+    header = ["阈值", "低谷", "最大", "合并", "片段数", "强制裁剪", "<3秒"]
+    print(" ".join(_rjust(name, width) for name, width in zip(header, widths)) + f"  时长分布({', '.join(labels)})")
+    for r in results:
+        print(f"{r['energy_threshold']:>8g} {r['min_valley_duration']:>8g} {r['max_len']:>8g} {r['merge_thresh']:>8g} "
+              f"{r['segments']:>10} {r['forced_cuts']:>12} {r['under_3s']:>8}  {r['histogram']}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"bins": labels, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
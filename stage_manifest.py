@@ -0,0 +1,72 @@
+import json
+import os
+
+# Each stage writes one manifest per speaker folder it fills (fragment/<name>, fragment_resample/<speaker>,
+# dataset/<speaker>, txts), one JSON line per produced file. Later stages and the statistics read it
+# instead of listing the folder, which is slow on network filesystems with many files.
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def manifest_name(shard=None):
+    # shards writing into the same folder keep separate manifests until merge_manifests
+    if shard is None:
+        return MANIFEST_NAME
+    return f"manifest.shard{shard[0]}-{shard[1]}.jsonl"
+
+
+def audio_entry(path, duration, sr, **extra):
+    return {"path": os.path.basename(path), "duration": round(float(duration), 6), "sr": int(sr),
+            "bytes": os.path.getsize(path), **extra}
+
+
+def read_manifest(folder, name=MANIFEST_NAME):
+    """
+    :return: list of entries, or None if the folder has no manifest and has to be listed instead
+    """
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def list_entries(folder, name=MANIFEST_NAME):
+    # manifest entries, or bare {"path": ...} entries from listing the folder when it has no manifest
+    entries = read_manifest(folder, name)
+    if entries is None:
+        entries = [{"path": f} for f in sorted(os.listdir(folder)) if not f.startswith('.') and not f.startswith("manifest")]
+    return entries
+
+
+def write_manifest(folder, entries, name=MANIFEST_NAME, update=False):
+    """
+    Write entries sorted by path, via a temp file so a crash never leaves a truncated manifest.
+    With update=True, entries of an existing manifest that are not rewritten here are kept.
+    """
+    by_path = {}
+    if update:
+        for entry in read_manifest(folder, name) or []:
+            by_path[entry["path"]] = entry
+    for entry in entries:
+        by_path[entry["path"]] = entry
+    path = os.path.join(folder, name)
+    tmp_path = os.path.join(folder, "." + name)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for key in sorted(by_path):
+            f.write(json.dumps(by_path[key], ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+def merge_manifests(folder, names, name=MANIFEST_NAME):
+    # combine per-shard manifests; missing ones (a shard that had nothing in this folder) are skipped
+    entries = []
+    for part in names:
+        entries.extend(read_manifest(folder, part) or [])
+    return write_manifest(folder, entries, name)
+
+
+def summarize(entries):
+    return {"files": len(entries),
+            "duration": sum(entry.get("duration", 0.0) for entry in entries),
+            "bytes": sum(entry.get("bytes", 0) for entry in entries)}
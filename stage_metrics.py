@@ -0,0 +1,115 @@
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then left out of the report
+    resource = None
+
+
+def timed_call(func, *args, **kwargs):
+    # module level so it can wrap work submitted to a process pool; returns (result, seconds)
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size so far in MB, of this process and of its finished child processes
+    (e.g. process pool workers), or (None, None) where the resource module is missing.
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1 / (1 << 20) if sys.platform == "darwin" else 1 / (1 << 10)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class StageMetrics:
+    """
+    Per-stage counters for a pipeline run. Each stage keeps its wall time (summed over its
+    start/stop spans), the summed busy time of its per-file calls (which exceeds wall
+    time when files run in parallel), audio seconds and file count. report() derives the
+    real-time factor (wall / audio seconds) and files/s; with trace_path set, every file
+    also gets one JSON line for finding outliers.
+    """
+
+    def __init__(self, trace_path=None):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.trace_file = open(trace_path, "a", encoding="utf-8") if trace_path else None
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {"wall_seconds": 0.0, "busy_seconds": 0.0, "audio_seconds": 0.0, "files": 0})
+
+    def start(self, name):
+        with self.lock:
+            self._stage(name)["_started"] = time.perf_counter()
+
+    def stop(self, name):
+        with self.lock:
+            stage = self._stage(name)
+            stage["wall_seconds"] += time.perf_counter() - stage.pop("_started")
+            stage["peak_rss_mb"], stage["children_peak_rss_mb"] = peak_rss_mb()
+
+    def add(self, name, seconds, audio_seconds=0.0, files=1, path=None, peak_mb=None, growth_mb=None):
+        # peak_mb / growth_mb: peak RSS while this file was processed and its rise over the RSS before it
+        # (memory_budget.measured_call), traced only
+        with self.lock:
+            stage = self._stage(name)
+            stage["busy_seconds"] += seconds
+            stage["audio_seconds"] += audio_seconds
+            stage["files"] += files
+            if self.trace_file is not None and path is not None:
+                line = {"stage": name, "path": path, "seconds": round(seconds, 6), "audio_seconds": round(audio_seconds, 3)}
+                if peak_mb is not None:
+                    line["peak_rss_mb"] = round(peak_mb, 1)
+                if growth_mb is not None:
+                    line["rss_growth_mb"] = round(growth_mb, 1)
+                self.trace_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+                self.trace_file.flush()
+
+    def merge(self, stages):
+        # fold in the stages of another process, e.g. one --jobs worker
+        with self.lock:
+            for name, other in stages.items():
+                stage = self._stage(name)
+                for key in ("busy_seconds", "audio_seconds", "files"):
+                    stage[key] += other[key]
+                # the workers ran side by side, so the stage took as long as the slowest one
+                stage["wall_seconds"] = max(stage["wall_seconds"], other["wall_seconds"])
+                for key in ("peak_rss_mb", "children_peak_rss_mb"):
+                    if other.get(key) is not None:
+                        stage[key] = max(stage.get(key) or 0.0, other[key])
+
+    def report(self):
+        report = {}
+        for name, stage in self.stages.items():
+            stage = {key: value for key, value in stage.items() if not key.startswith("_")}
+            wall = stage["wall_seconds"]
+            stage["rtf"] = wall / stage["audio_seconds"] if stage["audio_seconds"] else None
+            stage["busy_rtf"] = stage["busy_seconds"] / stage["audio_seconds"] if stage["audio_seconds"] else None
+            stage["files_per_sec"] = stage["files"] / wall if wall else None
+            report[name] = stage
+        return report
+
+    def write(self, report_path=None):
+        report = self.report()
+        print(f"{'stage':10s} {'wall s':>9s} {'busy s':>9s} {'audio s':>10s} {'RTF':>8s} {'busy RTF':>8s} {'files/s':>8s} {'peak MB':>8s}")
+        for name, stage in report.items():
+            print(f"{name:10s} {stage['wall_seconds']:9.2f} {stage['busy_seconds']:9.2f} {stage['audio_seconds']:10.1f} "
+                  f"{stage['rtf'] or 0:8.4f} {stage['busy_rtf'] or 0:8.4f} {stage['files_per_sec'] or 0:8.1f} {stage.get('peak_rss_mb') or 0:8.0f}")
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"report written to {report_path}")
+        return report
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
@@ -0,0 +1,212 @@
+import argparse
+import gc
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+import numpy as np
+import soundfile as sf
+
+import asr_worker
+from benchmark import StubASR, synthetic_speech
+from subfix_create_dataset import ASR_SAMPLE_RATE, CachedASRPipeline, create_dataset, recognize, recognize_long, recognize_sources
+
+# 用StubASR代替识别模型的快速检查，不需要modelscope：python stub_checks.py [检查名 ...]
+SAMPLE_RATE = 16000
+
+
+def speech_fragments(n, min_sec=2.0, max_sec=12.0, seed=0):
+    # 时长不一的确定性合成片段
+    rng = np.random.default_rng(seed)
+    return [synthetic_speech(rng.uniform(min_sec, max_sec), SAMPLE_RATE, rng) for _ in range(n)]
+
+
+def check_asr_batching():
+    # 片段按时长分桶合并为多条输入的调用，结果按原顺序对应到每个片段，与逐条识别一致
+    datas = speech_fragments(10)
+    sources = [f"f{i}" for i in range(len(datas))]
+    single = StubASR()
+    expected = [rec for _, _, rec in recognize_sources(list(zip(sources, datas)), SAMPLE_RATE, single, preloaded=True)]
+    batched = StubASR()
+    results = list(recognize_sources(list(zip(sources, datas)), SAMPLE_RATE, batched, asr_batch_size=4, preloaded=True))
+    assert [source for source, _, _ in results] == sources
+    assert [rec for _, _, rec in results] == expected
+    assert len(single.batches) == 10
+    assert [len(batch) for batch in batched.batches] == [4, 4, 2], batched.batches
+    # 同一批内的片段时长相近：每批都是按时长排序后的连续一段
+    lengths = sorted(len(data) * ASR_SAMPLE_RATE // SAMPLE_RATE for data in datas)
+    assert [length for batch in batched.batches for length in batch] == lengths
+    # 不支持列表输入的管线：给出警告后逐条识别，不中断
+    unbatched = StubASR(list_input=False)
+    results = list(recognize_sources(list(zip(sources, datas)), SAMPLE_RATE, unbatched, asr_batch_size=4, preloaded=True))
+    assert [rec for _, _, rec in results] == expected
+    assert [len(batch) for batch in unbatched.batches] == [1] * 10
+    # 该管线被回收后，新管线即使复用了同一内存地址也按批识别
+    freed = id(unbatched)
+    del unbatched
+    gc.collect()
+    candidates = [StubASR() for _ in range(1000)]
+    batched = next((stub for stub in candidates if id(stub) == freed), candidates[0])
+    list(recognize_sources(list(zip(sources, datas)), SAMPLE_RATE, batched, asr_batch_size=4, preloaded=True))
+    assert [len(batch) for batch in batched.batches] == [4, 4, 2], batched.batches
+
+
+def check_injectable_pipeline():
+    # create_dataset只依赖传入的管线：任何接受(audio_in, audio_fs)并返回sentences的可调用对象都可以代替模型
+    datas = speech_fragments(3, 8.0, 20.0)
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_dir = os.path.join(work_dir, "fragment_resample", "spk")
+        os.makedirs(source_dir)
+        for i, data in enumerate(datas):
+            sf.write(os.path.join(source_dir, f"{i:02d}.wav"), data, SAMPLE_RATE)
+        stub = StubASR()
+        lines = create_dataset(os.path.dirname(source_dir), os.path.join(work_dir, "dataset"), SAMPLE_RATE, "ZH", stub, 15, True)
+        # 每个源文件只识别一次，识别的是完整的16kHz音频
+        assert sorted(batch[0] for batch in stub.batches) == sorted(len(data) for data in datas)
+        assert lines and all(line.split("|")[1:3] == ["spk", "ZH"] for line in lines)
+        for line in lines:
+            path, _, _, text = line.split("|")
+            assert os.path.exists(path) and text.startswith("测试"), line
+
+
+def check_asr_cache():
+    # 只有缓存中没有的输入才交给管线，管线在第一次未命中时才创建；结果与直接识别一致
+    datas = speech_fragments(4)
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_path = os.path.join(work_dir, "asr_cache.sqlite")
+        stubs = []
+
+        def factory():
+            stubs.append(StubASR())
+            return stubs[-1]
+
+        cached = CachedASRPipeline(factory, cache_path)
+        expected = [StubASR()(data, ASR_SAMPLE_RATE) for data in datas]
+        assert cached(datas[0], ASR_SAMPLE_RATE) == expected[0]
+        assert (cached.hits, cached.misses, len(stubs)) == (0, 1, 1)
+        # 批量输入中只有未命中的部分组成一次调用
+        assert cached(datas[:3], ASR_SAMPLE_RATE) == expected[:3]
+        assert (cached.hits, cached.misses) == (1, 3)
+        assert stubs[0].batches == [[len(datas[0])], [len(datas[1]), len(datas[2])]]
+        cached.close()
+        # 重新打开后全部命中，不创建管线
+        stubs.clear()
+        cached = CachedASRPipeline(factory, cache_path)
+        assert cached(datas[:3], ASR_SAMPLE_RATE) == expected[:3]
+        assert (cached.hits, cached.misses, len(stubs)) == (3, 0, 0)
+        # 模型版本不同时不使用旧结果
+        other = CachedASRPipeline(factory, cache_path, model_revision="other")
+        assert other(datas[0], ASR_SAMPLE_RATE) == expected[0] and (other.hits, other.misses) == (0, 1)
+        cached.close()
+        other.close()
+        # 管线对列表输入只返回一个结果或结果条数不足时，recognize_batch改为逐条识别，不写入错误的结果
+        sources = [f"f{i}" for i in range(len(datas))]
+        expected = [rec for _, _, rec in recognize_sources(list(zip(sources, datas)), SAMPLE_RATE, StubASR(), preloaded=True)]
+        for name, answer in (("one", lambda results: results[0]), ("short", lambda results: results[:-1])):
+            stub = StubASR()
+
+            def partial(audio_in, audio_fs=ASR_SAMPLE_RATE, stub=stub, answer=answer):
+                results = stub(audio_in, audio_fs)
+                return answer(results) if isinstance(audio_in, list) else results
+
+            cached = CachedASRPipeline(lambda: partial, os.path.join(work_dir, f"{name}.sqlite"))
+            results = list(recognize_sources(list(zip(sources, datas)), SAMPLE_RATE, cached, asr_batch_size=4, preloaded=True))
+            assert [rec for _, _, rec in results] == expected, name
+            cached.close()
+
+
+def check_asr_worker():
+    # 经过常驻识别进程的协议往返一次，结果与直接调用管线一致；格式错误的请求得到错误回复而不是断开
+    datas = speech_fragments(3)
+    stub = StubASR()
+    server = asr_worker.serve(stub, "127.0.0.1:0", "model", "rev")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    address = f"127.0.0.1:{server.server_address[1]}"
+    try:
+        assert asr_worker.connect(address, "other", "rev") is None
+        client = asr_worker.connect(address, "model", "rev")
+        expected = [StubASR()(data, ASR_SAMPLE_RATE) for data in datas]
+        assert client(datas[0], ASR_SAMPLE_RATE) == expected[0]
+        assert client(datas, ASR_SAMPLE_RATE) == expected
+        assert stub.batches == [[len(datas[0])], [len(data) for data in datas]]
+        client.close()
+        for request in (b"not json\n", json.dumps({"op": "recognize", "nbytes": 8}).encode("utf-8") + b"\n\0\0\0\0"):
+            with socket.create_connection(server.server_address) as sock:
+                sock.sendall(request)
+                sock.shutdown(socket.SHUT_WR)
+                response = json.loads(sock.makefile("rb").readline())
+            assert "bad request" in response.get("error", ""), response
+        # 请求格式正确但内容有误时，连接保持可用
+        client = asr_worker.connect(address)
+        try:
+            client.request({"op": "recognize", "audio_fs": ASR_SAMPLE_RATE, "lengths": [3], "batched": False}, b"\0" * 4)
+            raise AssertionError("mismatched lengths were accepted")
+        except RuntimeError as e:
+            assert "do not match" in str(e)
+        assert client(datas[1], ASR_SAMPLE_RATE) == expected[1]
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def check_long_windows():
+    # 长音频按重叠窗口识别再拼接，得到与整段识别相同的句子（StubASR按窗口内序号加标点，只比较去掉标点的文本）
+    data = synthetic_speech(300.0, SAMPLE_RATE, np.random.default_rng(3))
+    whole = recognize(StubASR(), data, SAMPLE_RATE)["sentences"]
+    for workers in (1, 3):
+        stitched = recognize_long(StubASR(), data, SAMPLE_RATE, window_seconds=60.0, overlap_seconds=5.0, workers=workers)
+        sentences = stitched["sentences"]
+        assert len(sentences) == len(whole), (len(sentences), len(whole))
+        for a, b in zip(sentences, whole):
+            # 窗口内的能量阈值与整段不同，边界允许相差几帧
+            assert abs(a["start"] - b["start"]) <= 20 and abs(a["end"] - b["end"]) <= 20, (a, b)
+            assert a["text"][:-1] == b["text"][:-1], (a, b)
+        assert stitched["text"] == "".join(sentence["text"] for sentence in sentences)
+    # 多线程识别窗口时，CachedASRPipeline对被包装的管线一次只发起一个调用
+    stub = StubASR(rtf=0.002)
+    active = []
+
+    def exclusive(audio_in, audio_fs=ASR_SAMPLE_RATE):
+        active.append(1)
+        try:
+            assert len(active) == 1, "pipeline called from several threads at once"
+            return stub(audio_in, audio_fs)
+        finally:
+            active.pop()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        cached = CachedASRPipeline(lambda: exclusive, os.path.join(work_dir, "asr_cache.sqlite"))
+        stitched = recognize_long(cached, data, SAMPLE_RATE, window_seconds=60.0, overlap_seconds=5.0, workers=3)
+        cached.close()
+    assert len(stitched["sentences"]) == len(whole) and len(stub.batches) > 1
+
+
+CHECKS = {
+    "injectable_pipeline": check_injectable_pipeline,
+    "asr_batching": check_asr_batching,
+    "asr_cache": check_asr_cache,
+    "asr_worker": check_asr_worker,
+    "long_windows": check_long_windows,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="用StubASR代替识别模型检查识别相关的流程")
+    parser.add_argument("checks", nargs="*", help=f"要运行的检查，默认全部：{', '.join(CHECKS)}")
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"未知的检查: {', '.join(unknown)}")
+    failed = 0
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name]()
+            print(f"ok    {name}")
+        except Exception as e:
+            failed += 1
+            print(f"FAIL  {name}: {e!r}")
+    sys.exit(1 if failed else 0)
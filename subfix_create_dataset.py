@@ -1,14 +1,38 @@
 import argparse
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import math
 import os
 import re
+import shutil
+import sqlite3
 import subprocess
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import librosa
 import numpy as np
 import soundfile
 
-from modelscope.pipelines import pipeline
-from modelscope.utils.constant import Tasks
+import asr_worker
+from audio_cut import PLAN_MANIFEST, compute_envelope, find_valleys, plan_segments
+from memory_budget import estimate_decoded_bytes, measured_call, parse_size
+from stage_manifest import MANIFEST_NAME, audio_entry, list_entries, manifest_name, merge_manifests, read_manifest, summarize, write_manifest
+from stage_metrics import StageMetrics, timed_call
+from work_queue import WorkQueue, job_name, job_prefix
+
+ASR_MODEL = 'damo/speech_paraformer-large-vad-punc_asr_nat-zh-cn-16k-common-vocab8404-pytorch'
+ASR_MODEL_REVISION = "v1.2.4"
+ASR_SAMPLE_RATE = 16000
+# batched ASR buckets durations inside a window of this many batches
+ASR_BUCKET_WINDOW = 4
+# default ASR cache file, kept next to the output list so runs from another working directory share it
+ASR_CACHE_NAME = "asr_cache.sqlite"
 
 
 def get_sub_dirs(source_dir):
@@ -23,145 +47,945 @@ def is_sentence_ending(sentence):
     return False
 
 
-def resample_audios(origin_dir, resample_dir, sample_rate):
+def load_plan(plan_path):
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_plan_segment(entry):
+    # frame-range read of [start_sample, end_sample) from the source, at the source sample rate
+    data = soundfile.read(entry['source_path'], start=entry['start_sample'], stop=entry['end_sample'],
+                          dtype='float32', always_2d=True)[0]
+    return data[:, 0] if data.shape[1] == 1 else np.mean(data, axis=1)
+
+
+def resample_with_ffmpeg(file_path, target_path, sample_rate):
+    process = subprocess.run(["ffmpeg", "-y", "-i", file_path, "-ar", f"{sample_rate}", "-ac", "1", "-v", "error", target_path],
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {process.stderr.strip()[-500:]}")
+
+
+@functools.lru_cache(maxsize=None)
+def polyphase_filter(src_sr, dst_sr):
+    # same Kaiser-windowed low-pass resample_poly designs by default, built once per rate pair and process
+    from scipy.signal import firwin
+    g = math.gcd(src_sr, dst_sr)
+    up, down = dst_sr // g, src_sr // g
+    max_rate = max(up, down)
+    return up, down, firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+
+
+def resample_array(data, src_sr, dst_sr):
+    if src_sr == dst_sr:
+        return data
+    from scipy.signal import resample_poly
+    up, down, h = polyphase_filter(src_sr, dst_sr)
+    return resample_poly(data, up, down, window=h).astype(np.float32)
+
+
+def resample_with_inproc(file_path, target_path, sample_rate):
+    try:
+        data, src_sr = soundfile.read(file_path, dtype='float32', always_2d=True)
+    except Exception:
+        # formats libsndfile cannot decode still go through librosa/audioread
+        return resample_with_librosa(file_path, target_path, sample_rate)
+    data = data[:, 0] if data.shape[1] == 1 else np.mean(data, axis=1)
+    soundfile.write(target_path, resample_array(data, src_sr, sample_rate), sample_rate)
+
+
+def resample_in_blocks(file_path, target_path, sample_rate, block_frames=1 << 22):
+    """
+    Polyphase resampling of a file too large to decode at once, block_frames source frames at a
+    time. Blocks start at multiples of the decimation factor and are read with a margin covering
+    the filter on both sides, so each block's output equals the matching slice of resample_array
+    on the whole file.
+    """
+    with soundfile.SoundFile(file_path) as src:
+        src_sr, n = src.samplerate, src.frames
+        if src_sr == sample_rate:
+            up = down = 1
+            margin = 0
+        else:
+            up, down, h = polyphase_filter(src_sr, sample_rate)
+            margin = -(-(len(h) // up + 2) // down) * down
+        block_frames = max(down, block_frames // down * down)
+        with soundfile.SoundFile(target_path, 'w', samplerate=sample_rate, channels=1) as dst:
+            for start in range(0, n, block_frames):
+                left = min(margin, start)
+                src.seek(start - left)
+                data = src.read(min(block_frames, n - start) + left + margin, dtype='float32', always_2d=True)
+                data = data[:, 0] if data.shape[1] == 1 else np.mean(data, axis=1)
+                out = resample_array(data, src_sr, sample_rate)
+                skip = left * up // down
+                count = -(-min(block_frames, n - start) * up // down) if start + block_frames >= n else block_frames * up // down
+                dst.write(out[skip:skip + count])
+
+
+def split_over_budget(sources, sample_rate, max_memory):
+    """
+    Replace every source file whose whole decode at sample_rate (estimated from its header)
+    would exceed max_memory bytes by plan entries, as audio_cut.py --plan writes them:
+    valley-aligned ranges that each fit the budget and are read one at a time. The energy
+    envelope for the cuts is computed block by block.
+    """
+    bounded = []
+    for source in sources:
+        estimate = estimate_decoded_bytes(source, sample_rate) if max_memory and not isinstance(source, dict) else None
+        if estimate is None or estimate <= max_memory:
+            bounded.append(source)
+            continue
+        energy, n_samples, src_sr = compute_envelope(source)
+        range_seconds = max(1.0, n_samples / src_sr * max_memory / estimate)
+        segments = plan_segments(energy, n_samples, src_sr, max_len=range_seconds)[0]
+        print(f"{source}: about {estimate / (1 << 20):.0f} MB decoded, over the {max_memory / (1 << 20):.0f} MB budget, "
+              f"read as {len(segments)} ranges of up to {range_seconds:.0f}s")
+        bounded.extend({'source_path': source, 'start_sample': int(start), 'end_sample': int(end), 'sr': int(src_sr)}
+                       for start, end in segments)
+    return bounded
+
+
+def source_key(source):
+    if isinstance(source, dict):
+        return f"{source['source_path']}[{source['start_sample']}:{source['end_sample']}]"
+    return source
+
+
+def source_stem(source):
+    # output clips of a source are named after it, so names don't depend on processing order
+    if isinstance(source, dict):
+        return f"{os.path.splitext(os.path.basename(source['source_path']))[0]}_{source['start_sample']}"
+    return os.path.splitext(os.path.basename(source))[0]
+
+
+def parse_shard(text):
+    try:
+        index, total = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {text!r}")
+    if not 0 <= index < total:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {total}), got {index}")
+    return index, total
+
+
+def in_shard(speaker_name, name, shard):
+    # stable across machines and runs: hash of speaker/file name relative to the source dir
+    if shard is None:
+        return True
+    index, total = shard
+    digest = hashlib.md5(f"{speaker_name}/{name}".encode("utf-8")).hexdigest()
+    return int(digest, 16) % total == index
+
+
+def shard_list_path(output_list, shard):
+    root, ext = os.path.splitext(output_list)
+    return f"{root}.shard{shard[0]}-{shard[1]}{ext}"
+
+
+def merge_shard_manifests(target_dir, shards, shard=None):
+    # per speaker folder, fold the manifests of the given shards into the one of `shard` (None: the final manifest)
+    for speaker_name in get_sub_dirs(target_dir):
+        merge_manifests(os.path.join(target_dir, speaker_name), [manifest_name(part) for part in shards], manifest_name(shard))
+
+
+def stage_summary(stage_dir, name=MANIFEST_NAME):
+    # totals over the speaker folders of a stage, from their manifests (plan manifests count their segments)
+    entries = []
+    for speaker_name in get_sub_dirs(stage_dir):
+        folder = os.path.join(stage_dir, speaker_name)
+        if os.path.exists(os.path.join(folder, PLAN_MANIFEST)):
+            entries.extend({"duration": (entry["end_sample"] - entry["start_sample"]) / entry["sr"]}
+                           for entry in load_plan(os.path.join(folder, PLAN_MANIFEST)))
+        else:
+            entries.extend(read_manifest(folder, name) or [])
+    return summarize(entries)
+
+
+def merge_lists(list_paths, output_list):
+    # lines are ordered by clip path, so the merged list is the same for any shard count
+    lines = []
+    for list_path in list_paths:
+        with open(list_path, 'r', encoding='utf-8') as f:
+            lines.extend(line.strip() for line in f if line.strip())
+    lines.sort(key=lambda line: line.split('|', 1)[0])
+    with open(output_list, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+    print(f"merged {len(list_paths)} lists into {output_list}: {len(lines)} lines")
+    return lines
+
+
+def load_source(source, sample_rate):
+    # decode a source file or plan entry exactly once, as mono float32 at sample_rate
+    if isinstance(source, dict):
+        return resample_array(read_plan_segment(source), source['sr'], sample_rate)
+    try:
+        data, src_sr = soundfile.read(source, dtype='float32', always_2d=True)
+    except Exception:
+        return librosa.load(source, sr=sample_rate, mono=True)[0]
+    data = data[:, 0] if data.shape[1] == 1 else np.mean(data, axis=1)
+    return resample_array(data, src_sr, sample_rate)
+
+
+def recognize(inference_pipeline, data, sample_rate):
+    """
+    ASR adapter working on in-memory audio: hands the pipeline a 16 kHz view of data.
+    Any callable accepting (audio_in=ndarray, audio_fs=int) and returning a dict with
+    'sentences' can stand in for the modelscope pipeline.
+    """
+    asr_audio = resample_array(data, sample_rate, ASR_SAMPLE_RATE)
+    return inference_pipeline(audio_in=asr_audio, audio_fs=ASR_SAMPLE_RATE) # dict_keys(['text', 'text_postprocessed', 'time_stamp', 'sentences'])
+
+
+def resample_with_librosa(file_path, target_path, sample_rate):
+    data, sample_rate = librosa.load(file_path, sr=sample_rate, mono=True)
+    soundfile.write(target_path, data, sample_rate)
+
+
+def resample_one(resampler, file_path, target_path, sample_rate):
+    # write to a hidden temp name and rename, so a killed run never leaves a truncated
+    # target that the skip-if-exists check would then keep forever
+    partial_path = os.path.join(os.path.dirname(target_path), "." + os.path.basename(target_path))
+    try:
+        resampler(file_path, partial_path, sample_rate)
+        os.replace(partial_path, target_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+RESAMPLERS = {
+    "ffmpeg": resample_with_ffmpeg,
+    "inproc": resample_with_inproc,
+    "librosa": resample_with_librosa,
+}
+
+
+def pick_resampler(resampler=None):
+    ffmpeg_installed = shutil.which("ffmpeg") is not None
+    if resampler is None:
+        return "ffmpeg" if ffmpeg_installed else "inproc"
+    if resampler == "ffmpeg" and not ffmpeg_installed:
+        print("ERROR! ffmpeg is not installed. use inproc.")
+        return "inproc"
+    return resampler
+
+
+def resample_executor(resampler, workers):
+    # ffmpeg runs in its own process, so threads are enough; the in-process backends need processes
+    executor_class = ThreadPoolExecutor if resampler == "ffmpeg" else ProcessPoolExecutor
+    return executor_class(max_workers=max(1, workers))
+
+
+def resample_audios(origin_dir, resample_dir, sample_rate, workers=1, resampler=None, shard=None, metrics=None, max_memory=None):
     print("start resample audios")
     os.makedirs(resample_dir, exist_ok=True)
     dirs = get_sub_dirs(origin_dir)
 
-    try:
-        subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True)
-        ffmpeg_installed = True
-        print("ffmpeg installed. use ffmpeg.")
-    except Exception as e:
-        ffmpeg_installed = False
-        print("ERROR! ffmpeg is not installed. use librosa.")
+    resampler = pick_resampler(resampler)
+    print(f"resampler: {resampler}")
 
+    jobs = []
+    # per target folder, the manifest entries of what it holds; written out at the end
+    produced = {}
     for dir in dirs:
         source_dir = os.path.join(origin_dir, dir)
         target_dir = os.path.join(resample_dir, dir)
         os.makedirs(target_dir, exist_ok=True)
-        listdir = list(os.listdir(source_dir))
-        listdir_len = len(listdir)
-        for index, f in enumerate(listdir, start=1):
-            if f.endswith(".wav") or f.endswith(".mp3"):
+        plan_path = os.path.join(source_dir, PLAN_MANIFEST)
+        if os.path.exists(plan_path):
+            # plan manifests are resampled lazily when create_dataset reads each range
+            shutil.copyfile(plan_path, os.path.join(target_dir, PLAN_MANIFEST))
+            continue
+        # entries of the previous run count only while their file is still there; deleted ones are resampled again
+        previous = {entry["path"]: entry for entry in read_manifest(target_dir, manifest_name(shard)) or []
+                    if os.path.exists(os.path.join(target_dir, entry["path"]))}
+        produced[target_dir] = list(previous.values())
+        # audio_cut.py's manifest saves listing the fragment folder
+        for entry in list_entries(source_dir):
+            f = entry["path"]
+            if (f.endswith(".wav") or f.endswith(".mp3")) and not f.startswith('.'):
                 file_path = os.path.join(source_dir, f)
                 target_path = os.path.join(target_dir, f)
                 target_path = os.path.splitext(target_path)[0] + '.wav'
+                if os.path.basename(target_path) in previous or not in_shard(dir, os.path.basename(target_path), shard):
+                    continue
                 if os.path.exists(target_path):
+                    # resampled by a run that wrote no manifest
+                    info = soundfile.info(target_path)
+                    produced[target_dir].append(audio_entry(target_path, info.duration, info.samplerate))
                     continue
-                if ffmpeg_installed:
-                    process = subprocess.run(["ffmpeg", "-y", "-i", file_path, "-ar", f"{sample_rate}", "-ac", "1", "-v", "quiet", target_path])
+                jobs.append((file_path, target_path))
+    # ffmpeg streams on its own; the in-process backends resample files over the budget in blocks
+    over_budget = {file_path for file_path, _ in jobs
+                   if resampler != "ffmpeg" and max_memory and (estimate_decoded_bytes(file_path, sample_rate) or 0) > max_memory}
+    # a block, its multi-channel read, mono mix and resampled copy take ~32 bytes per frame
+    blocks_resampler = functools.partial(resample_in_blocks, block_frames=max(1 << 16, (max_memory or 0) // 32))
+
+    failures = []
+    done = 0
+    start_time = time.perf_counter()
+    # the per-file peak only goes to the trace
+    watch_memory = metrics is not None and metrics.trace_file is not None
+    if metrics is not None:
+        metrics.start("resample")
+    with resample_executor(resampler, workers) as executor:
+        futures = {executor.submit(measured_call, resample_one, blocks_resampler if file_path in over_budget else RESAMPLERS[resampler],
+                                   file_path, target_path, sample_rate, watch_memory=watch_memory): (file_path, target_path)
+                   for file_path, target_path in jobs}
+        for future in as_completed(futures):
+            file_path, target_path = futures[future]
+            try:
+                _, seconds, peak_mb, growth_mb = future.result()
+                info = soundfile.info(target_path)
+                produced[os.path.dirname(target_path)].append(audio_entry(target_path, info.duration, info.samplerate))
+                if metrics is not None:
+                    metrics.add("resample", seconds, info.duration, path=file_path, peak_mb=peak_mb, growth_mb=growth_mb)
+            except Exception as e:
+                failures.append((file_path, e))
+            done += 1
+            elapsed = time.perf_counter() - start_time
+            print(f"\rresampled {done}/{len(jobs)} files, {done / elapsed if elapsed > 0 else 0:.1f} files/s", end="", flush=True)
+    if jobs:
+        print()
+    for target_dir, entries in produced.items():
+        write_manifest(target_dir, entries, manifest_name(shard))
+    if metrics is not None:
+        metrics.stop("resample")
+    for file_path, e in sorted(failures, key=lambda x: x[0]):
+        print(f"{file_path} convert fail: {e!r}")
+    if failures:
+        print(f"{len(failures)}/{len(jobs)} files failed to resample.")
+    return failures
+
+
+def write_clip(path, parts, sample_rate):
+    # stream the slice views into the file one after another instead of concatenating them first
+    with soundfile.SoundFile(path, 'w', samplerate=sample_rate, channels=1) as f:
+        for part in parts:
+            f.write(part)
+
+
+def clip_name(count, index, name_prefix=None):
+    # global running number by default, "<source stem>_<index within source>" with --naming source
+    if name_prefix is not None:
+        return f"{name_prefix}_{str(index).zfill(4)}"
+    return f"{str(count).zfill(6)}"
+
+
+def slice_source(data, rec_result, sample_rate, slice_dir, speaker_name, language, count, max_seconds, multi_split=True, audio_path="",
+                 writer=None, name_prefix=None):
+    # cut one recognized source into output clips; returns the list lines and the next count
+    write = writer.write if writer is not None else write_clip
+    first_count = count
+    lines = []
+    sentence_list = []
+    audio_list = []
+    time_length = 0
+    if multi_split:
+        for sentence in rec_result['sentences']:
+            text = sentence['text'].strip()
+            if (text == ""):
+                continue
+            start = int((sentence['start'] / 1000) * sample_rate)
+            end = int((sentence['end'] / 1000) * sample_rate)
+
+            if time_length > 0 and time_length + ((sentence['end'] - sentence['start']) / 1000) > max_seconds:
+                sliced_audio_name = clip_name(count, count - first_count, name_prefix)
+                sliced_audio_path = os.path.join(slice_dir, sliced_audio_name+".wav")
+                s_sentence = "".join(sentence_list)
+                if not re.search(r"[。！？]$", s_sentence):
+                    sentence_end = s_sentence[-1]
+                    s_sentence = s_sentence[:-1] + '。' if sentence_end != '。' else s_sentence
+                if time_length > max_seconds:
+                    print(f"[too long voice]:{sliced_audio_path}, voice_length:{time_length} seconds")
+                write(sliced_audio_path, audio_list, sample_rate)
+                lines.append(
+                    f"{sliced_audio_path}|{speaker_name}|{language}|{s_sentence}"
+                )
+                sentence_list = []
+                audio_list = []
+                time_length = 0
+                count = count + 1
+
+            sentence_list.append(text)
+            audio_list.append(data[start:end])
+            time_length = time_length + ((sentence['end'] - sentence['start']) / 1000)
+            
+            if ( is_sentence_ending(text) ):
+                sliced_audio_name = clip_name(count, count - first_count, name_prefix)
+                sliced_audio_path = os.path.join(slice_dir, sliced_audio_name+".wav")
+                s_sentence = "".join(sentence_list)
+                write(sliced_audio_path, audio_list, sample_rate)
+                lines.append(
+                    f"{sliced_audio_path}|{speaker_name}|{language}|{s_sentence}"
+                )
+                sentence_list = []
+                audio_list = []
+                time_length = 0
+                count = count + 1
+    else:
+        # 不进行多段切分，整段输出
+        full_text = "".join([s['text'].strip() for s in rec_result['sentences'] if s['text'].strip() != ""])
+        if len(full_text) > 0:
+            sliced_audio_name = clip_name(count, count - first_count, name_prefix)
+            sliced_audio_path = os.path.join(slice_dir, sliced_audio_name+".wav")
+            write(sliced_audio_path, [data], sample_rate)
+            lines.append(
+                f"{sliced_audio_path}|{speaker_name}|{language}|{full_text}"
+            )
+            count = count + 1
+        else:
+            print(f"[Warning] full_text 为空，未输出音频：{audio_path}")
+    return lines, count
+
+
+def duration_batches(durations, batch_size, max_batch_seconds):
+    # bucket by duration: similar lengths share a batch, each batch capped by count and total seconds
+    order = sorted(range(len(durations)), key=lambda i: durations[i])
+    batches = []
+    batch = []
+    total = 0.0
+    for i in order:
+        if batch and (len(batch) >= batch_size or total + durations[i] > max_batch_seconds):
+            batches.append(batch)
+            batch = []
+            total = 0.0
+        batch.append(i)
+        total += durations[i]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# pipelines found not to take list input; they get one call per fragment from then on.
+# Weak references, so a new pipeline that reuses a collected one's memory is not mistaken for it
+UNBATCHED_PIPELINES = weakref.WeakSet()
+
+
+def recognize_batch(inference_pipeline, datas, sample_rate):
+    """
+    Batched form of recognize: one pipeline call with a list of 16 kHz arrays, returning
+    a list of rec_result dicts in the same order. A pipeline that rejects the list, or
+    does not answer with one result per input, is warned about once and then called
+    once per fragment, as with --asr_batch_size 1.
+    """
+    asr_audios = [resample_array(data, sample_rate, ASR_SAMPLE_RATE) for data in datas]
+    if inference_pipeline not in UNBATCHED_PIPELINES:
+        try:
+            results = inference_pipeline(audio_in=asr_audios, audio_fs=ASR_SAMPLE_RATE)
+        except Exception as e:
+            results = e
+        if isinstance(results, list) and len(results) == len(datas):
+            return results
+        UNBATCHED_PIPELINES.add(inference_pipeline)
+        print(f"Warning: inference pipeline does not support list input ({results!r:.200}), "
+              f"recognizing one fragment per call; use --asr_batch_size 1 to skip this check")
+    return [inference_pipeline(audio_in=asr_audio, audio_fs=ASR_SAMPLE_RATE) for asr_audio in asr_audios]
+
+
+def load_source_timed(source, sample_rate, metrics=None):
+    if metrics is None:
+        return load_source(source, sample_rate)
+    data, seconds, peak_mb, growth_mb = measured_call(load_source, source, sample_rate, watch_memory=metrics.trace_file is not None)
+    metrics.add("decode", seconds, len(data) / sample_rate, path=source_key(source), peak_mb=peak_mb, growth_mb=growth_mb)
+    return data
+
+
+def prefetch_sources(sources, sample_rate, workers=0, depth=8, metrics=None):
+    """
+    Yield (source, data) in the original order while up to `depth` sources are decoded
+    ahead on `workers` threads; the bounded look-ahead is the backpressure that keeps
+    decoded audio in memory limited.
+    """
+    if workers <= 0:
+        for source in sources:
+            yield source, load_source_timed(source, sample_rate, metrics)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        iterator = iter(sources)
+        for source in itertools.islice(iterator, max(1, depth)):
+            pending.append((source, executor.submit(load_source_timed, source, sample_rate, metrics)))
+        while pending:
+            source, future = pending.popleft()
+            for next_source in itertools.islice(iterator, 1):
+                pending.append((next_source, executor.submit(load_source_timed, next_source, sample_rate, metrics)))
+            yield source, future.result()
+
+
+def recognize_window(window, sample_rate, inference_pipeline, asr_batch_size, asr_max_batch_seconds, metrics=None):
+    results = [None] * len(window)
+    durations = [len(data) / sample_rate for _, data in window]
+    for batch in duration_batches(durations, asr_batch_size, asr_max_batch_seconds):
+        batch_results, seconds = timed_call(recognize_batch, inference_pipeline, [window[i][1] for i in batch], sample_rate)
+        if metrics is not None:
+            metrics.add("asr", seconds, sum(durations[i] for i in batch), files=len(batch),
+                        path=f"{source_key(window[batch[0]][0])} (+{len(batch) - 1})")
+        for i, rec_result in zip(batch, batch_results):
+            results[i] = rec_result
+    for (source, data), rec_result in zip(window, results):
+        yield source, data, rec_result
+
+
+def plan_long_windows(data, sample_rate, window_seconds=60.0, overlap_seconds=5.0):
+    """
+    Split a long source into overlapping ASR windows [(start, end), ...] in samples.
+    Each cut goes to the middle of the longest energy valley in the second half of the
+    nominal window, so a cut rarely lands inside a word; the window then runs on for
+    overlap_seconds past the cut, which is where the next window starts.
+    """
+    n = len(data)
+    window = int(window_seconds * sample_rate)
+    overlap = int(overlap_seconds * sample_rate)
+    valleys = find_valleys(data, sample_rate, as_array=True)
+    centers = (valleys['start'] + valleys['end']) // 2
+    windows = []
+    start = 0
+    while n - start > window:
+        target = start + window
+        candidates = np.flatnonzero((centers > start + window // 2) & (centers <= target))
+        if len(candidates):
+            cut = int(centers[candidates[np.argmax(valleys['duration'][candidates])]])
+        else:
+            cut = target
+        windows.append((start, min(cut + overlap, n)))
+        start = cut
+    windows.append((start, n))
+    return windows
+
+
+def stitch_sentences(windows, results, sample_rate):
+    """
+    Merge per-window rec_results into one rec_result on the source timeline.
+    Sentence times (ms, relative to their window) are shifted by the window start. In the
+    overlaps the same speech is recognized twice: of two sentences overlapping by more than
+    half of the shorter one, the one farther from its window's edges is kept, since the
+    other is likely cut off, and its span is widened to cover both. Overlaps should be longer
+    than the longest sentence. Works with any recognizer returning {'sentences': [...]}.
+    """
+    candidates = []
+    for k, ((start, end), rec_result) in enumerate(zip(windows, results)):
+        offset = start * 1000 // sample_rate
+        # the outer ends of the first and last window are real file ends, not cuts
+        left = start * 1000 / sample_rate if k > 0 else -math.inf
+        right = end * 1000 / sample_rate if k < len(windows) - 1 else math.inf
+        for sentence in rec_result.get('sentences', []):
+            sentence = dict(sentence, start=sentence['start'] + offset, end=sentence['end'] + offset)
+            if 'timestamp' in sentence:
+                sentence['timestamp'] = [[ts[0] + offset, ts[1] + offset] for ts in sentence['timestamp']]
+            margin = min(sentence['start'] - left, right - sentence['end'])
+            candidates.append((sentence, margin))
+    candidates.sort(key=lambda c: (c[0]['start'], c[0]['end']))
+    kept = []
+    for sentence, margin in candidates:
+        if kept:
+            last, last_margin = kept[-1]
+            shared = min(last['end'], sentence['end']) - max(last['start'], sentence['start'])
+            shorter = min(last['end'] - last['start'], sentence['end'] - sentence['start'])
+            if shared > 0.5 * max(shorter, 1):
+                best, best_margin = (sentence, margin) if margin > last_margin else (last, last_margin)
+                # a sentence longer than the overlap is cut off in both windows, keep the union of the spans
+                best = dict(best, start=min(last['start'], sentence['start']), end=max(last['end'], sentence['end']))
+                kept[-1] = (best, best_margin)
+                continue
+        kept.append((sentence, margin))
+    sentences = [sentence for sentence, _ in kept]
+    return {'text': "".join(sentence['text'] for sentence in sentences), 'sentences': sentences}
+
+
+def recognize_long(inference_pipeline, data, sample_rate, window_seconds=60.0, overlap_seconds=5.0, workers=1):
+    """
+    Recognize a long source as overlapping valley-aligned windows (plan_long_windows) on
+    `workers` threads and stitch the results (stitch_sentences). Concurrent calls need a
+    pipeline that tolerates them: CachedASRPipeline and the asr worker client make one model
+    call at a time, a bare in-process model (--asr_cache "") is called from all threads.
+    """
+    windows = plan_long_windows(data, sample_rate, window_seconds, overlap_seconds)
+    if workers > 1 and len(windows) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda w: recognize(inference_pipeline, data[w[0]:w[1]], sample_rate), windows))
+    else:
+        results = [recognize(inference_pipeline, data[start:end], sample_rate) for start, end in windows]
+    return stitch_sentences(windows, results, sample_rate)
+
+
+def recognize_sources(sources, sample_rate, inference_pipeline, asr_batch_size=1, asr_max_batch_seconds=300.0,
+                      decode_workers=0, prefetch=8, metrics=None, long_window=0.0, long_overlap=5.0, long_workers=1, preloaded=False):
+    """
+    Yield (source, data, rec_result) in the original order of sources.
+    With preloaded=True, sources already yields (source, data) pairs decoded upstream.
+    Decoding runs ahead on decode_workers threads (see prefetch_sources) while ASR runs here.
+    With asr_batch_size > 1, sources are taken in windows of ASR_BUCKET_WINDOW batches,
+    bucketed by duration inside the window and recognized batch by batch; only the
+    current window's decoded audio is held in memory.
+    With long_window > 0, sources longer than it go through recognize_long instead.
+    """
+    loaded = sources if preloaded else prefetch_sources(sources, sample_rate, decode_workers, prefetch, metrics)
+
+    def recognize_whole(source, data):
+        if long_window > 0 and len(data) > long_window * sample_rate:
+            rec_result, seconds = timed_call(recognize_long, inference_pipeline, data, sample_rate, long_window, long_overlap, long_workers)
+        else:
+            rec_result, seconds = timed_call(recognize, inference_pipeline, data, sample_rate)
+        if metrics is not None:
+            metrics.add("asr", seconds, len(data) / sample_rate, path=source_key(source))
+        return rec_result
+
+    if asr_batch_size <= 1:
+        for source, data in loaded:
+            yield source, data, recognize_whole(source, data)
+        return
+    window = []
+    window_seconds = 0.0
+    for source, data in loaded:
+        if long_window > 0 and len(data) > long_window * sample_rate:
+            # long sources skip batching; flush first to keep the order
+            if window:
+                yield from recognize_window(window, sample_rate, inference_pipeline, asr_batch_size, asr_max_batch_seconds, metrics)
+                window = []
+                window_seconds = 0.0
+            yield source, data, recognize_whole(source, data)
+            continue
+        window.append((source, data))
+        window_seconds += len(data) / sample_rate
+        if len(window) < asr_batch_size * ASR_BUCKET_WINDOW and window_seconds < asr_max_batch_seconds * ASR_BUCKET_WINDOW:
+            continue
+        yield from recognize_window(window, sample_rate, inference_pipeline, asr_batch_size, asr_max_batch_seconds, metrics)
+        window = []
+        window_seconds = 0.0
+    if window:
+        yield from recognize_window(window, sample_rate, inference_pipeline, asr_batch_size, asr_max_batch_seconds, metrics)
+
+
+class SliceWriter:
+    """
+    Writes output clips on a small thread pool so disk I/O overlaps decoding and ASR.
+    File names are chosen by the caller before submitting, so numbering stays deterministic;
+    at most max_pending clips (lists of views into the decoded source) wait in memory,
+    further writes block until one finishes.
+    """
+
+    def __init__(self, workers=0, max_pending=16, metrics=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.metrics = metrics
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.errors = []
+        self.submitted = []
+        # (folder, manifest entry) of every clip written
+        self.clips = []
+
+    def _done(self, future):
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+        self.slots.release()
+
+    def _write(self, path, parts, sample_rate):
+        _, seconds = timed_call(write_clip, path, parts, sample_rate)
+        duration = sum(len(part) for part in parts) / sample_rate
+        if self.metrics is not None:
+            self.metrics.add("write", seconds, duration, path=path)
+        clip = (os.path.dirname(path), audio_entry(path, duration, sample_rate))
+        self.clips.append(clip)
+        return clip
+
+    def write(self, path, parts, sample_rate):
+        if self.executor is None:
+            future = Future()
+            future.set_result(self._write(path, parts, sample_rate))
+            self.submitted.append(future)
+            return
+        self.slots.acquire()
+        future = self.executor.submit(self._write, path, parts, sample_rate)
+        future.add_done_callback(self._done)
+        self.submitted.append(future)
+
+    def take_submitted(self):
+        # futures of the writes submitted since the last call, so a caller can tell when a source is on disk;
+        # each resolves to the clip's (folder, manifest entry)
+        submitted, self.submitted = self.submitted, []
+        return submitted
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+
+def read_journal(path):
+    # the params header followed by one record per finished source
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a torn last line from a crash mid-append; everything before it is intact
+                break
+    return records
+
+
+class ListJournal:
+    """
+    Append-only, fsynced record of finished sources for create_dataset. Each record holds
+    the source key, its list lines, the manifest entries of its clips and the next count, and is
+    written only once all of that source's clips are on disk. Records stay in source order, so on --resume the last record
+    gives the count to continue from and every recorded source can be skipped.
+    """
+
+    def __init__(self, path, params, resume=False):
+        self.path = path
+        self.done = set()
+        self.lines = []
+        self.clips = []
+        self.count = 0
+        self.pending = collections.deque()
+        if resume and os.path.exists(path):
+            records = read_journal(path)
+            if records and records[0].get('params') != params:
+                raise ValueError(f"{path} was written with {records[0].get('params')}, cannot resume with {params}")
+            for record in records[1:]:
+                self.done.add(record['source'])
+                self.lines.extend(record['lines'])
+                self.clips.extend(tuple(clip) for clip in record['clips'])
+                self.count = record['count']
+            print(f"resume: {len(self.done)} sources already done, continuing from {str(self.count).zfill(6)}")
+            self.file = open(path, 'a', encoding='utf-8')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+            self._append({'params': params})
+
+    def _append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, source, lines, count, futures=()):
+        self.pending.append(({'source': source, 'lines': lines, 'clips': [], 'count': count}, list(futures)))
+        self._flush(wait=False)
+
+    def _flush(self, wait):
+        while self.pending:
+            record, futures = self.pending[0]
+            if not wait and not all(future.done() for future in futures):
+                break
+            record['clips'] = [future.result() for future in futures]
+            self.pending.popleft()
+            self._append(record)
+
+    def close(self):
+        try:
+            self._flush(wait=True)
+        finally:
+            self.file.close()
+
+
+class QueueJournal(ListJournal):
+    """
+    Stands in for ListJournal in queue mode: a finished source completes its job in the
+    work queue, with its list lines and clips as the result, instead of being appended to a
+    local file. jobs maps the source key of every claimed source to its (name, job).
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.jobs = {}
+        self.done = set()
+        self.lines = []
+        self.clips = []
+        self.count = 0
+        self.pending = collections.deque()
+
+    def _append(self, record):
+        name, job = self.jobs.pop(record['source'])
+        self.queue.complete(name, job, {'lines': record['lines'], 'clips': record['clips']})
+
+    def close(self):
+        self._flush(wait=True)
+
+
+def load_pipeline(model=ASR_MODEL, model_revision=ASR_MODEL_REVISION):
+    # modelscope is imported here, so runs served by the asr worker or the cache never pay for it
+    from modelscope.pipelines import pipeline
+    from modelscope.utils.constant import Tasks
+
+    return pipeline(
+        task=Tasks.auto_speech_recognition,
+        model=model,
+        model_revision=model_revision)
+
+
+def open_pipeline(worker_address=None):
+    # use a running asr_worker.py when there is one, otherwise load the model in this process
+    if worker_address:
+        client = asr_worker.connect(worker_address, ASR_MODEL, ASR_MODEL_REVISION)
+        if client is not None:
+            print(f"using asr worker at {worker_address}")
+            return client
+    return load_pipeline()
+
+
+def default_asr_cache(asr_cache, output_list):
+    # None is the default cache next to output_list; an empty string, which disables the cache, is kept
+    if asr_cache is None:
+        return os.path.join(os.path.dirname(os.path.abspath(output_list)), ASR_CACHE_NAME)
+    return asr_cache
+
+
+class CachedASRPipeline:
+    """
+    Drop-in wrapper around the ASR pipeline that stores every raw rec_result in SQLite,
+    keyed by the hash of the 16 kHz input audio plus model id and revision. Only inputs
+    missing from the cache reach the real pipeline, which is built on the first miss,
+    so re-splitting an already recognized corpus never loads the model.
+    """
+
+    def __init__(self, pipeline_factory, cache_path, model=ASR_MODEL, model_revision=ASR_MODEL_REVISION):
+        self.pipeline_factory = pipeline_factory
+        self.inference_pipeline = None
+        self.model = model
+        self.model_revision = model_revision
+        self.hits = 0
+        self.misses = 0
+        # recognize_long may call from several threads: the connection and counters are guarded by lock,
+        # the wrapped pipeline, which need not be thread-safe, by call_lock, so cache lookups still overlap
+        self.lock = threading.Lock()
+        self.call_lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS asr_result (key TEXT PRIMARY KEY, result TEXT NOT NULL)")
+        self.conn.commit()
+
+    def key(self, audio, audio_fs):
+        digest = hashlib.sha1(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+        digest.update(f"|{audio_fs}|{self.model}|{self.model_revision}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT result FROM asr_result WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, rec_result):
+        self.conn.execute("INSERT OR REPLACE INTO asr_result (key, result) VALUES (?, ?)", (key, asr_worker.to_json(rec_result)))
+
+    def __call__(self, audio_in, audio_fs=ASR_SAMPLE_RATE):
+        batched = isinstance(audio_in, list)
+        audios = audio_in if batched else [audio_in]
+        keys = [self.key(audio, audio_fs) for audio in audios]
+        with self.lock:
+            results = [self.get(key) for key in keys]
+            missing = [i for i, rec_result in enumerate(results) if rec_result is None]
+            self.hits += len(audios) - len(missing)
+            self.misses += len(missing)
+            if missing and self.inference_pipeline is None:
+                self.inference_pipeline = self.pipeline_factory()
+        if missing:
+            with self.call_lock:
+                if batched:
+                    fresh = self.inference_pipeline(audio_in=[audios[i] for i in missing], audio_fs=audio_fs)
                 else:
-                    try:
-                        print(f"{index}/{listdir_len} file")
-                        data, sample_rate = librosa.load(file_path, sr=sample_rate, mono=True)
-                        soundfile.write(target_path, data, sample_rate)
-                    except Exception as e:
-                        print(f"\n{file_path} convert fail.")
-                    finally:
-                        pass
-                    
-
-
-def create_dataset(source_dir, target_dir, sample_rate, language, inference_pipeline, max_seconds, multi_split=True):
+                    fresh = [self.inference_pipeline(audio_in=audios[0], audio_fs=audio_fs)]
+            # recognize_batch falls back to one call per fragment on this error, nothing is cached
+            if batched and (not isinstance(fresh, list) or len(fresh) != len(missing)):
+                raise ValueError(f"expected a list of {len(missing)} results, got {fresh!r:.200}")
+            with self.lock:
+                for i, rec_result in zip(missing, fresh):
+                    results[i] = rec_result
+                    # incomplete results are not cached so that they are retried next time
+                    if isinstance(rec_result, dict) and 'sentences' in rec_result:
+                        self.put(keys[i], rec_result)
+                self.conn.commit()
+        return results if batched else results[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def create_dataset(source_dir, target_dir, sample_rate, language, inference_pipeline, max_seconds, multi_split=True,
+                   asr_batch_size=1, asr_max_batch_seconds=300.0, decode_workers=0, write_workers=0, prefetch=8, journal=None,
+                   naming="count", shard=None, metrics=None, source_manifest=MANIFEST_NAME, long_window=0.0, long_overlap=5.0, long_workers=1,
+                   speaker_sources=None, max_memory=None):
     # source_dir, target_dir, sample_rate=44100, language = "ZH", inference_pipeline = None
+    # speaker_sources: {speaker_name: callable(keep) -> iterable of (source, data)} replaces reading source_dir,
+    # for sources decoded and cut in memory upstream (subfix_pipeline.py); keep(source) says which ones are still wanted
+    # max_memory: per-source budget in bytes, larger source files are read as valley-aligned ranges (split_over_budget)
+    if shard is not None and naming != "source":
+        raise ValueError("sharding needs --naming source, running numbers would collide across shards")
     
-    roles = get_sub_dirs(source_dir)
-    count = 0
-    result = []
-
-    for speaker_name in roles:
+    roles = get_sub_dirs(source_dir) if speaker_sources is None else list(speaker_sources)
+    count = journal.count if journal is not None else 0
+    result = list(journal.lines) if journal is not None else []
+    # decode threads -> ASR (this thread) -> writer threads; names and list order are fixed here
+    writer = SliceWriter(write_workers, max_pending=prefetch * 2, metrics=metrics)
+    if metrics is not None:
+        # decode, asr and write overlap, so they only report busy time; "dataset" is the wall clock of all three
+        metrics.start("dataset")
+    last_time = time.perf_counter()
+    try:
+        for speaker_name in roles:
 
-        source_audios = [f for f in os.listdir(os.path.join(source_dir, speaker_name)) if f.endswith(".wav")]
-        source_audios = [os.path.join(source_dir, speaker_name, filename) for filename in source_audios]
-        slice_dir = os.path.join(target_dir, speaker_name)
-        os.makedirs(slice_dir, exist_ok=True)
+            def keep(source, speaker_name=speaker_name):
+                return (in_shard(speaker_name, os.path.basename(source_key(source)), shard)
+                        and (journal is None or source_key(source) not in journal.done))
 
-        for audio_path in source_audios:
-            rec_result = inference_pipeline(audio_in=audio_path) # dict_keys(['text', 'text_postprocessed', 'time_stamp', 'sentences'])
-            if 'sentences' not in rec_result:
-                print(f"Warning: 推理结果缺少 'sentences' 字段，文件：{audio_path}，rec_result keys: {list(rec_result.keys())}")
-                continue
-            data, sample_rate = librosa.load(audio_path, sr=sample_rate, mono=True)
-
-            sentence_list = []
-            audio_list = []
-            time_length = 0
-            if multi_split:
-                for sentence in rec_result['sentences']:
-                    text = sentence['text'].strip()
-                    if (text == ""):
-                        continue
-                    start = int((sentence['start'] / 1000) * sample_rate)
-                    end = int((sentence['end'] / 1000) * sample_rate)
-
-                    if time_length > 0 and time_length + ((sentence['end'] - sentence['start']) / 1000) > max_seconds:
-                        sliced_audio_name = f"{str(count).zfill(6)}"
-                        sliced_audio_path = os.path.join(slice_dir, sliced_audio_name+".wav")
-                        s_sentence = "".join(sentence_list)
-                        if not re.search(r"[。！？]$", s_sentence):
-                            sentence_end = s_sentence[-1]
-                            s_sentence = s_sentence[:-1] + '。' if sentence_end != '。' else s_sentence
-                        audio_concat = np.concatenate(audio_list)
-                        if time_length > max_seconds:
-                            print(f"[too long voice]:{sliced_audio_path}, voice_length:{time_length} seconds")
-                        soundfile.write(sliced_audio_path, audio_concat, sample_rate)
-                        result.append(
-                            f"{sliced_audio_path}|{speaker_name}|{language}|{s_sentence}"
-                        )
-                        sentence_list = []
-                        audio_list = []
-                        time_length = 0
-                        count = count + 1
-
-                    sentence_list.append(text)
-                    audio_list.append(data[start:end])
-                    time_length = time_length + ((sentence['end'] - sentence['start']) / 1000)
-                    
-                    if ( is_sentence_ending(text) ):
-                        sliced_audio_name = f"{str(count).zfill(6)}"
-                        sliced_audio_path = os.path.join(slice_dir, sliced_audio_name+".wav")
-                        s_sentence = "".join(sentence_list)
-                        audio_concat = np.concatenate(audio_list)
-                        soundfile.write(sliced_audio_path, audio_concat, sample_rate)
-                        result.append(
-                            f"{sliced_audio_path}|{speaker_name}|{language}|{s_sentence}"
-                        )
-                        sentence_list = []
-                        audio_list = []
-                        time_length = 0
-                        count = count + 1
+            slice_dir = os.path.join(target_dir, speaker_name)
+            os.makedirs(slice_dir, exist_ok=True)
+            if speaker_sources is not None:
+                source_audios = speaker_sources[speaker_name](keep)
+            elif os.path.exists(os.path.join(source_dir, speaker_name, PLAN_MANIFEST)):
+                # segments planned by audio_cut.py --plan, read lazily from the original sources
+                source_audios = load_plan(os.path.join(source_dir, speaker_name, PLAN_MANIFEST))
             else:
-                # 不进行多段切分，整段输出
-                full_text = "".join([s['text'].strip() for s in rec_result['sentences'] if s['text'].strip() != ""])
-                if len(full_text) > 0:
-                    sliced_audio_name = f"{str(count).zfill(6)}"
-                    sliced_audio_path = os.path.join(slice_dir, sliced_audio_name+".wav")
-                    soundfile.write(sliced_audio_path, data, sample_rate)
-                    result.append(
-                        f"{sliced_audio_path}|{speaker_name}|{language}|{full_text}"
-                    )
-                    count = count + 1
+                # resample_audios' manifest saves listing the folder
+                source_audios = [entry["path"] for entry in list_entries(os.path.join(source_dir, speaker_name), source_manifest)]
+                source_audios = [f for f in source_audios if f.endswith(".wav") and not f.startswith('.')]
+                source_audios = [os.path.join(source_dir, speaker_name, filename) for filename in source_audios]
+            if speaker_sources is None:
+                # shard by the file, resume by the range: the ranges of a file depend on the budget only
+                source_audios = split_over_budget([source for source in source_audios if keep(source)], sample_rate, max_memory)
+                source_audios = [source for source in source_audios if journal is None or source_key(source) not in journal.done]
+
+            # one decode per source: the output-rate buffer is sliced, its 16 kHz view goes to ASR
+            for source, data, rec_result in recognize_sources(source_audios, sample_rate, inference_pipeline,
+                                                              asr_batch_size, asr_max_batch_seconds, decode_workers, prefetch, metrics,
+                                                              long_window, long_overlap, long_workers, speaker_sources is not None):
+                audio_path = source_key(source)
+                if metrics is not None:
+                    now = time.perf_counter()
+                    metrics.add("dataset", now - last_time, len(data) / sample_rate, path=audio_path)
+                    last_time = now
+                if 'sentences' not in rec_result:
+                    print(f"Warning: 推理结果缺少 'sentences' 字段，文件：{audio_path}，rec_result keys: {list(rec_result.keys())}")
+                    lines = []
                 else:
-                    print(f"[Warning] full_text 为空，未输出音频：{audio_path}")
+                    lines, count = slice_source(data, rec_result, sample_rate, slice_dir, speaker_name, language, count,
+                                                max_seconds, multi_split, audio_path, writer,
+                                                source_stem(source) if naming == "source" else None)
+                    result.extend(lines)
+                if journal is not None:
+                    journal.record(audio_path, lines, count, writer.take_submitted())
+    finally:
+        # a write error surfaces from writer.close(); the journal is still flushed, so --resume keeps every finished source
+        try:
+            writer.close()
+        finally:
+            try:
+                if journal is not None:
+                    journal.close()
+            finally:
+                if metrics is not None:
+                    metrics.stop("dataset")
+    clips = collections.defaultdict(list)
+    for folder, entry in (journal.clips if journal is not None else []) + writer.clips:
+        clips[folder].append(entry)
+    for folder, entries in clips.items():
+        write_manifest(folder, entries, manifest_name(shard), update=True)
     return result
 
 
-def create_list(source_dir, target_dir, resample_dir, sample_rate, language, output_list, max_seconds, multi_split=True):
-    resample_audios(source_dir, resample_dir, sample_rate)
-    inference_pipeline = pipeline(
-        task=Tasks.auto_speech_recognition,
-        model='damo/speech_paraformer-large-vad-punc_asr_nat-zh-cn-16k-common-vocab8404-pytorch',
-        model_revision="v1.2.4")
-    result =  create_dataset(resample_dir, target_dir, sample_rate = sample_rate, language = language, inference_pipeline = inference_pipeline, max_seconds = max_seconds, multi_split=multi_split)
-    # 输出统计信息
-    input_count = 0
-    for root, dirs, files in os.walk(resample_dir):
-        input_count += len([f for f in files if f.lower().endswith('.wav')])
-    output_count = 0
-    for root, dirs, files in os.walk(target_dir):
-        output_count += len([f for f in files if f.lower().endswith('.wav')])
-    print(f"从{resample_dir}输入{input_count}个文件，输出到{target_dir}{output_count}个文件")
+def write_list(output_list, result):
     with open(output_list, "w", encoding="utf-8") as file:
         for line in result:
             try:
@@ -170,6 +994,166 @@ def create_list(source_dir, target_dir, resample_dir, sample_rate, language, out
                 print("UnicodeEncodeError: Can't encode to ASCII:", e)
 
 
+def create_shard_list(resample_dir, target_dir, sample_rate, language, output_list, max_seconds, multi_split=True,
+                      asr_batch_size=1, asr_max_batch_seconds=300.0, asr_cache=None, decode_workers=0, write_workers=0, prefetch=8,
+                      resume=False, naming="count", shard=None, asr_worker_address=None, metrics=None, source_manifest=MANIFEST_NAME,
+                      long_window=0.0, long_overlap=5.0, long_workers=1, speaker_sources=None, max_memory=None):
+    # one create_dataset run with its own ASR pipeline and journal; also the body of each --jobs process
+    if asr_cache:
+        inference_pipeline = CachedASRPipeline(functools.partial(open_pipeline, asr_worker_address), asr_cache)
+    else:
+        inference_pipeline = open_pipeline(asr_worker_address)
+    # the journal next to the list lets a killed run continue with --resume
+    params = {'target_dir': target_dir, 'sample_rate': sample_rate, 'language': language,
+              'max_seconds': max_seconds, 'multi_split': multi_split, 'naming': naming, 'shard': shard and list(shard),
+              'long_window': long_window, 'long_overlap': long_overlap}
+    journal = ListJournal(output_list + ".journal", params, resume=resume)
+    result =  create_dataset(resample_dir, target_dir, sample_rate = sample_rate, language = language, inference_pipeline = inference_pipeline, max_seconds = max_seconds, multi_split=multi_split,
+                             asr_batch_size=asr_batch_size, asr_max_batch_seconds=asr_max_batch_seconds,
+                             decode_workers=decode_workers, write_workers=write_workers, prefetch=prefetch, journal=journal,
+                             naming=naming, shard=shard, metrics=metrics, source_manifest=source_manifest,
+                             long_window=long_window, long_overlap=long_overlap, long_workers=long_workers,
+                             speaker_sources=speaker_sources, max_memory=max_memory)
+    if asr_cache:
+        print(f"ASR cache: {inference_pipeline.hits} hits, {inference_pipeline.misses} misses ({asr_cache})")
+        inference_pipeline.close()
+    if naming == "source":
+        # same order as merge_lists, so a sharded run merges to exactly this list
+        result.sort(key=lambda line: line.split('|', 1)[0])
+    write_list(output_list, result)
+    return result
+
+
+def create_shard_list_job(trace_path, *args, **kwargs):
+    # --jobs worker: its own metrics, returned as plain stage counters for the parent to merge
+    metrics = StageMetrics(trace_path)
+    try:
+        create_shard_list(*args, metrics=metrics, **kwargs)
+    finally:
+        metrics.close()
+    return metrics.stages
+
+
+def claimed_sources(queue, journal, speaker_name, sample_rate, keep=None):
+    # claim the waiting jobs of one speaker as create_dataset asks for sources; keep is unused, the queue hands out each source once
+    while True:
+        claimed = queue.claim(job_prefix("dataset", speaker_name))
+        if claimed is None:
+            return
+        name, job = claimed
+        try:
+            data = load_source(job['source'], sample_rate)
+        except Exception as e:
+            print(f"{source_key(job['source'])} decode fail: {e!r}")
+            queue.fail(name, job, repr(e))
+            continue
+        journal.jobs[source_key(job['source'])] = (name, job)
+        yield job['source'], data
+
+
+def create_queue_list(queue_dir, source_dir, target_dir, sample_rate, language, output_list, max_seconds, multi_split=True,
+                      asr_cache=None, asr_worker_address=None, lease_seconds=300.0, max_attempts=3, poll_seconds=5.0, metrics=None,
+                      max_memory=None, **options):
+    """
+    Queue mode: every worker (on any host mounting queue_dir) adds one job per source of source_dir - adding is
+    idempotent - and then claims and processes jobs until none is waiting or running anywhere. Sources are read
+    from source_dir and resampled in memory, so there is no shared fragment_resample step. Clips are named
+    <source stem>_<index>; the worker that gets the merge lock writes output_list and the clip manifests
+    from the results of all jobs. Sources over max_memory are queued as ranges (split_over_budget).
+    options are passed on to create_dataset.
+    """
+    queue = WorkQueue(queue_dir, lease_seconds, max_attempts)
+    speakers = get_sub_dirs(source_dir)
+    added = 0
+    for speaker_name in speakers:
+        plan_path = os.path.join(source_dir, speaker_name, PLAN_MANIFEST)
+        if os.path.exists(plan_path):
+            sources = load_plan(plan_path)
+        else:
+            sources = [os.path.join(source_dir, speaker_name, entry["path"]) for entry in list_entries(os.path.join(source_dir, speaker_name))
+                       if entry["path"].endswith((".wav", ".mp3"))]
+        for source in split_over_budget(sources, sample_rate, max_memory):
+            added += queue.add(job_name("dataset", speaker_name, source_key(source)), {'speaker': speaker_name, 'source': source})
+    print(f"queued {added} new jobs in {queue_dir}")
+    if asr_cache:
+        inference_pipeline = CachedASRPipeline(functools.partial(open_pipeline, asr_worker_address), asr_cache)
+    else:
+        inference_pipeline = open_pipeline(asr_worker_address)
+    journal = QueueJournal(queue)
+    try:
+        while True:
+            create_dataset(None, target_dir, sample_rate, language, inference_pipeline, max_seconds, multi_split, journal=journal,
+                           naming="source", metrics=metrics, speaker_sources={
+                               speaker_name: functools.partial(claimed_sources, queue, journal, speaker_name, sample_rate)
+                               for speaker_name in speakers}, **options)
+            # other workers still hold leases: wait, their jobs come back here if they die
+            if queue.drained("dataset."):
+                break
+            time.sleep(poll_seconds)
+    finally:
+        queue.close()
+        if asr_cache:
+            inference_pipeline.close()
+    release = queue.merge_lock("dataset.")
+    if release is None:
+        print("another worker is merging the results")
+        return
+    try:
+        result = []
+        clips = collections.defaultdict(list)
+        for job in queue.results("done", "dataset.").values():
+            result.extend(job['result']['lines'])
+            for folder, entry in job['result']['clips']:
+                clips[folder].append(entry)
+        result.sort(key=lambda line: line.split('|', 1)[0])
+        write_list(output_list, result)
+        for folder, entries in clips.items():
+            write_manifest(folder, entries)
+    finally:
+        release()
+    failed = queue.results("failed", "dataset.")
+    for job in failed.values():
+        print(f"{source_key(job['source'])} failed {job['attempts']} times: {job['error']}")
+    print(f"merged {len(result)} lines into {output_list}" + (f", {len(failed)} sources failed" if failed else ""))
+
+
+def create_list(source_dir, target_dir, resample_dir, sample_rate, language, output_list, max_seconds, multi_split=True, resample_workers=1, resampler=None,
+                asr_batch_size=1, asr_max_batch_seconds=300.0, asr_cache=None, decode_workers=0, write_workers=0, prefetch=8, resume=False,
+                naming="count", shard=None, jobs=1, asr_worker_address=None, report=None, trace=None,
+                long_window=0.0, long_overlap=5.0, long_workers=1, max_memory=None):
+    metrics = StageMetrics(trace)
+    resample_audios(source_dir, resample_dir, sample_rate, workers=resample_workers, resampler=resampler, shard=shard, metrics=metrics,
+                    max_memory=max_memory)
+    if shard is not None:
+        output_list = shard_list_path(output_list, shard)
+    options = dict(multi_split=multi_split, asr_batch_size=asr_batch_size, asr_max_batch_seconds=asr_max_batch_seconds, asr_cache=asr_cache,
+                   decode_workers=decode_workers, write_workers=write_workers, prefetch=prefetch, resume=resume, naming=naming,
+                   asr_worker_address=asr_worker_address, source_manifest=manifest_name(shard),
+                   long_window=long_window, long_overlap=long_overlap, long_workers=long_workers, max_memory=max_memory)
+    if jobs > 1:
+        # split this machine's share into `jobs` sub-shards: h % (N*jobs) == i + N*j  <=>  h % N == i
+        index, total = shard if shard is not None else (0, 1)
+        sub_shards = [(index + total * j, total * jobs) for j in range(jobs)]
+        sub_lists = [shard_list_path(output_list, sub_shard) for sub_shard in sub_shards]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(create_shard_list_job, trace, resample_dir, target_dir, sample_rate, language, sub_list, max_seconds,
+                                       shard=sub_shard, **options)
+                       for sub_shard, sub_list in zip(sub_shards, sub_lists)]
+            for future in futures:
+                metrics.merge(future.result())
+        merge_lists(sub_lists, output_list)
+        merge_shard_manifests(target_dir, sub_shards, shard)
+    else:
+        create_shard_list(resample_dir, target_dir, sample_rate, language, output_list, max_seconds, shard=shard, metrics=metrics, **options)
+    # 输出统计信息，来自各阶段写出的清单，不再遍历文件夹
+    inputs = stage_summary(resample_dir, manifest_name(shard))
+    outputs = stage_summary(target_dir, manifest_name(shard))
+    print(f"从{resample_dir}输入{inputs['files']}个文件（{inputs['duration'] / 3600:.2f}小时），"
+          f"输出到{target_dir}{outputs['files']}个文件（{outputs['duration'] / 3600:.2f}小时，{outputs['bytes'] / (1 << 20):.1f}MB）")
+    metrics.write(report)
+    metrics.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--source_dir", type=str, default="fragment", help="Source directory path, Default: fragment")
@@ -179,7 +1163,59 @@ if __name__ == "__main__":
     parser.add_argument("--language", type=str, default="ZH", help="Language, Default: ZH")
     parser.add_argument("--output", type=str, default="demo.list", help="List file, Default: demo.list")
     parser.add_argument("--max_seconds", type=int, default=15, help="Max sliced voice length(seconds), Default: 15")
+    parser.add_argument("--resample_workers", type=int, default=os.cpu_count(), help="Concurrent resampling jobs, Default: number of CPUs")
+    parser.add_argument("--resampler", type=str, choices=sorted(RESAMPLERS), default=None, help="Resampling backend, Default: ffmpeg if installed, otherwise inproc")
+    parser.add_argument("--asr_batch_size", type=int, default=1, help="Fragments per ASR call, bucketed by duration, Default: 1 (no batching)")
+    parser.add_argument("--asr_max_batch_seconds", type=float, default=300.0, help="Max total audio seconds per ASR call, Default: 300")
+    parser.add_argument("--asr_cache", type=str, default=None,
+                        help=f"SQLite cache of raw ASR results, empty string disables it, Default: {ASR_CACHE_NAME} next to --output")
+    parser.add_argument("--asr_worker", type=str, default=asr_worker.DEFAULT_ADDRESS,
+                        help=f"Address of a running asr_worker.py, used when reachable, empty string disables it, Default: {asr_worker.DEFAULT_ADDRESS}")
+    parser.add_argument("--decode_workers", type=int, default=2, help="Threads decoding sources ahead of ASR, 0 decodes inline, Default: 2")
+    parser.add_argument("--write_workers", type=int, default=2, help="Threads writing output clips, 0 writes inline, Default: 2")
+    parser.add_argument("--prefetch", type=int, default=8, help="Max sources decoded ahead of ASR, Default: 8")
+    parser.add_argument("--resume", action="store_true", help="Continue a killed run from {output}.journal instead of starting over")
+    parser.add_argument("--naming", type=str, choices=["count", "source"], default="count",
+                        help="Clip names: global running number, or <source stem>_<index> independent of processing order, Default: count")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="Only process shard i of N (i/N, 0-based) and write <output stem>.shard<i>-<N>.list, implies --naming source")
+    parser.add_argument("--jobs", type=int, default=1, help="Local processes, each with its own ASR model, splitting the work by source file, implies --naming source")
+    parser.add_argument("--queue", type=str, default=None,
+                        help="Shared queue folder: every worker started with the same one claims sources one by one from --source_dir (resampled in memory), the last merges --output, implies --naming source")
+    parser.add_argument("--lease_seconds", type=float, default=300.0, help="With --queue, a job not renewed for this long goes back to the queue, Default: 300")
+    parser.add_argument("--max_attempts", type=int, default=3, help="With --queue, attempts per source before it is recorded as failed, Default: 3")
+    parser.add_argument("--merge_shards", type=int, default=None, help="Only merge the N shard lists of --output into --output and exit")
+    parser.add_argument("--long_window", type=float, default=0.0,
+                        help="Recognize sources longer than this many seconds as overlapping valley-aligned windows and stitch the sentences, 0 disables, Default: 0")
+    parser.add_argument("--long_overlap", type=float, default=5.0, help="Overlap between long-source windows in seconds, Default: 5")
+    parser.add_argument("--long_workers", type=int, default=1, help="Threads recognizing the windows of one long source; the cache and the asr worker still make one model call at a time, with --asr_cache \"\" the in-process model must allow concurrent calls, Default: 1")
+    parser.add_argument("--report", type=str, default=None, help="Save per-stage wall/busy time, real-time factor, files/s and peak RSS as JSON")
+    parser.add_argument("--trace", type=str, default=None, help="Append one JSON line per file and stage to this file, for profiling outliers")
+    parser.add_argument("--max_memory", type=parse_size, default=None,
+                        help="Per-file memory budget like 2G or 512M (plain numbers are MB); files whose decode would exceed it, "
+                             "estimated from the header, are resampled in blocks and recognized as valley-aligned ranges, Default: no budget")
     parser.add_argument("--multi_split", action="store_true", help="是否进行多段切分，添加该参数则多段切分，否则整段输出")
     args = parser.parse_args()
-    create_list(args.source_dir, args.target_dir, args.resample_dir, args.sample_rate, args.language, args.output, args.max_seconds, args.multi_split)
+    args.asr_cache = default_asr_cache(args.asr_cache, args.output)
+    if args.merge_shards:
+        merge_lists([shard_list_path(args.output, (i, args.merge_shards)) for i in range(args.merge_shards)], args.output)
+        merge_shard_manifests(args.target_dir, [(i, args.merge_shards) for i in range(args.merge_shards)])
+        raise SystemExit(0)
+    if args.queue:
+        metrics = StageMetrics(args.trace)
+        create_queue_list(args.queue, args.source_dir, args.target_dir, args.sample_rate, args.language, args.output, args.max_seconds, args.multi_split,
+                          asr_cache=args.asr_cache, asr_worker_address=args.asr_worker, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts,
+                          metrics=metrics, asr_batch_size=args.asr_batch_size, asr_max_batch_seconds=args.asr_max_batch_seconds,
+                          write_workers=args.write_workers, prefetch=args.prefetch,
+                          long_window=args.long_window, long_overlap=args.long_overlap, long_workers=args.long_workers,
+                          max_memory=args.max_memory)
+        metrics.write(args.report)
+        metrics.close()
+        raise SystemExit(0)
+    if args.shard is not None or args.jobs > 1:
+        args.naming = "source"
+    create_list(args.source_dir, args.target_dir, args.resample_dir, args.sample_rate, args.language, args.output, args.max_seconds, args.multi_split, args.resample_workers, args.resampler,
+                args.asr_batch_size, args.asr_max_batch_seconds, args.asr_cache, args.decode_workers, args.write_workers, args.prefetch,
+                args.resume, args.naming, args.shard, args.jobs, args.asr_worker, args.report, args.trace,
+                args.long_window, args.long_overlap, args.long_workers, args.max_memory)
     
@@ -0,0 +1,368 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import soundfile
+
+import asr_worker
+import audio_cut
+import list2txt
+from copy_to_final_output import final_names
+from stage_manifest import audio_entry, write_manifest
+from subfix_create_dataset import (ASR_CACHE_NAME, ASR_MODEL, ASR_MODEL_REVISION, RESAMPLERS, create_shard_list, default_asr_cache, pick_resampler,
+                                   prefetch_sources, read_journal, resample_executor, resample_one)
+
+STATE_FILE = ".subfix_make.json"
+
+
+def json_digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class BuildState:
+    """
+    What every stage built so far and from what, kept in one JSON file next to the data.
+    Files are identified by content hash; the hash is cached by (size, mtime) so an unchanged
+    corpus is only stat'ed. Each stage keeps, per unit of work (a source file, a fragment,
+    a list line), the fingerprint of its input plus the stage parameters and the outputs it
+    produced; a unit is re-run only when its fingerprint changed or an output is missing.
+    """
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.state = {"files": {}, "stages": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        self.seen = set()
+
+    def digest(self, path):
+        stat = os.stat(path)
+        cached = self.state["files"].get(path)
+        self.seen.add(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        self.state["files"][path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+        return sha1.hexdigest()
+
+    def units(self, stage):
+        return self.state["stages"].setdefault(stage, {})
+
+    def plan(self, stage, inputs, params):
+        """
+        :param inputs: {unit key: digest of the unit's input}
+        :return: (stale keys in sorted order, {key: fingerprint}, records of units whose input is gone)
+        """
+        units = self.units(stage)
+        params_digest = json_digest(params)
+        fingerprints = {key: json_digest([digest, params_digest]) for key, digest in inputs.items()}
+        stale = [key for key in sorted(inputs)
+                 if key not in units or units[key]["fingerprint"] != fingerprints[key]
+                 or not all(os.path.exists(path) for path in units[key]["outputs"])]
+        removed = [units.pop(key) for key in sorted(units) if key not in inputs]
+        return stale, fingerprints, removed
+
+    def record(self, stage, key, fingerprint, outputs, **data):
+        self.units(stage)[key] = {"fingerprint": fingerprint, "outputs": outputs, **data}
+
+    def forget(self, stage):
+        # --force: keep the outputs so they are cleaned up, but match no fingerprint
+        for unit in self.units(stage).values():
+            unit["fingerprint"] = None
+
+    def save(self):
+        # drop hashes of files that no stage looked at in this run, e.g. deleted sources
+        self.state["files"] = {path: value for path, value in self.state["files"].items() if path in self.seen or os.path.exists(path)}
+        tmp_path = os.path.join(os.path.dirname(os.path.abspath(self.path)), "." + os.path.basename(self.path))
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def remove_outputs(records):
+    for record in records:
+        for path in record["outputs"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def print_plan(stage, stale, inputs, removed):
+    print(f"[{stage}] {len(stale)} to run, {len(inputs) - len(stale)} up to date, {len(removed)} removed")
+
+
+def stage_cut(state, args, dry_run=False):
+    # origin/* -> fragment/<name>/, one unit per source file
+    out_dir = os.path.join(args.fragment_dir, args.fragment_name)
+    sources = audio_cut.list_audio_files(args.audio)
+    inputs = {source: state.digest(source) for source in sources}
+    params = {"max_len": args.max_len, "merge_thresh": args.merge_thresh, "min_split_len": args.min_split_len, "out_dir": out_dir}
+    stale, fingerprints, removed = state.plan("cut", inputs, params)
+    print_plan("cut", stale, inputs, removed)
+    if dry_run:
+        return
+    units = state.units("cut")
+    remove_outputs(removed + [units[key] for key in stale if key in units])
+    os.makedirs(out_dir, exist_ok=True)
+    kwargs = dict(max_len=args.max_len, merge_thresh=args.merge_thresh, min_split_len=args.min_split_len, stream=args.stream, cache_dir=args.cache_dir)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 and len(stale) > 1 else None
+    try:
+        if executor is not None:
+            futures = {executor.submit(audio_cut.process_audio_file, source, out_dir, **kwargs): source for source in stale}
+            results = ((futures[future], future.result) for future in as_completed(futures))
+        else:
+            results = ((source, functools.partial(audio_cut.process_audio_file, source, out_dir, **kwargs)) for source in stale)
+        for source, result in results:
+            try:
+                entries = result()[2]
+            except Exception as e:
+                # left unrecorded, so the next run retries it
+                print(f"{source} cut fail: {e!r}")
+                state.units("cut").pop(source, None)
+                continue
+            state.record("cut", source, fingerprints[source], [os.path.join(out_dir, entry["path"]) for entry in entries], entries=entries)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        write_manifest(out_dir, [entry for unit in state.units("cut").values() for entry in unit["entries"]])
+        state.save()
+
+
+def stage_resample(state, args, dry_run=False):
+    # fragment/<name>/*.wav -> fragment_resample/<name>/*.wav, one unit per fragment
+    out_dir = os.path.join(args.resample_dir, args.fragment_name)
+    fragments = [path for unit in state.units("cut").values() for path in unit["outputs"]]
+    inputs = {path: state.digest(path) for path in fragments if os.path.exists(path)}
+    resampler = pick_resampler(args.resampler)
+    stale, fingerprints, removed = state.plan("resample", inputs, {"sample_rate": args.sample_rate, "resampler": resampler, "out_dir": out_dir})
+    print_plan("resample", stale, inputs, removed)
+    if dry_run:
+        return
+    remove_outputs(removed)
+    os.makedirs(out_dir, exist_ok=True)
+    try:
+        with resample_executor(resampler, args.workers) as executor:
+            futures = {}
+            for path in stale:
+                target_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + ".wav")
+                futures[executor.submit(resample_one, RESAMPLERS[resampler], path, target_path, args.sample_rate)] = (path, target_path)
+            for future in as_completed(futures):
+                path, target_path = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"{path} convert fail: {e!r}")
+                    state.units("resample").pop(path, None)
+                    continue
+                info = soundfile.info(target_path)
+                state.record("resample", path, fingerprints[path], [target_path],
+                             entry=audio_entry(target_path, info.duration, info.samplerate))
+    finally:
+        write_manifest(out_dir, [unit["entry"] for unit in state.units("resample").values()])
+        state.save()
+
+
+def stage_dataset(state, args, dry_run=False):
+    # fragment_resample/<name>/*.wav -> dataset/<name>/ clips and the list, one unit per resampled fragment
+    speaker_dir = os.path.join(args.target_dir, args.fragment_name)
+    sources = [path for unit in state.units("resample").values() for path in unit["outputs"]]
+    inputs = {path: state.digest(path) for path in sources if os.path.exists(path)}
+    params = {"target_dir": args.target_dir, "sample_rate": args.sample_rate, "language": args.language, "max_seconds": args.max_seconds,
+              "multi_split": args.multi_split, "long_window": args.long_window, "long_overlap": args.long_overlap,
+              "model": ASR_MODEL, "model_revision": ASR_MODEL_REVISION}
+    stale, fingerprints, removed = state.plan("dataset", inputs, params)
+    print_plan("dataset", stale, inputs, removed)
+    if dry_run or not (stale or removed or not os.path.exists(args.output)):
+        return
+    units = state.units("dataset")
+    replaced = removed + [units[key] for key in stale if key in units]
+    remove_outputs(replaced)
+    replaced_stems = {os.path.splitext(path)[0] for unit in replaced for path in unit["outputs"]}
+    # lines of the untouched sources come from the current list, so edits made in the web UI survive
+    current = {}
+    if os.path.exists(args.output):
+        with open(args.output, "r", encoding="utf-8") as f:
+            current = {line.split("|", 1)[0]: line.rstrip("\n") for line in f if line.strip()}
+    partial_list = args.output + ".partial"
+
+    def speaker_sources(keep):
+        return prefetch_sources([source for source in stale if keep(source)], args.sample_rate, args.decode_workers, args.prefetch)
+
+    try:
+        if stale:
+            # source naming: a clip's name depends only on its own source, so untouched clips keep theirs
+            create_shard_list(None, args.target_dir, args.sample_rate, args.language, partial_list, args.max_seconds, args.multi_split,
+                              asr_batch_size=args.asr_batch_size, asr_cache=args.asr_cache, decode_workers=args.decode_workers,
+                              write_workers=args.write_workers, prefetch=args.prefetch, naming="source", asr_worker_address=args.asr_worker,
+                              long_window=args.long_window, long_overlap=args.long_overlap, long_workers=args.long_workers,
+                              speaker_sources={args.fragment_name: speaker_sources})
+    finally:
+        # also after a crash: every source the journal holds is complete and need not run again
+        fresh = set()
+        if os.path.exists(partial_list + ".journal"):
+            for record in read_journal(partial_list + ".journal")[1:]:
+                clips = [os.path.join(folder, entry["path"]) for folder, entry in record["clips"]]
+                state.record("dataset", record["source"], fingerprints[record["source"]], clips,
+                             lines=record["lines"], entries=[entry for _, entry in record["clips"]])
+                fresh.add(record["source"])
+            os.remove(partial_list + ".journal")
+        if os.path.exists(partial_list):
+            os.remove(partial_list)
+        result = []
+        for key, unit in state.units("dataset").items():
+            if key in fresh or not current:
+                result.extend(unit["lines"])
+            else:
+                result.extend(current[path] for path in unit["outputs"] if path in current)
+        # clips the web UI split off (<clip>_NN.wav, split again <clip>_NN_NN.wav) belong to no unit: they are
+        # kept unless the clip they came from was re-run, and then they are stale and go with it
+        owned = {path for unit in state.units("dataset").values() for path in unit["outputs"]}
+        split_entries = []
+        for path, line in current.items():
+            if path in owned or os.path.dirname(os.path.abspath(path)) != os.path.abspath(speaker_dir):
+                continue
+            if re.sub(r"(_\d{2})+$", "", os.path.splitext(path)[0]) in replaced_stems:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            result.append(line)
+            if os.path.exists(path):
+                info = soundfile.info(path)
+                split_entries.append(audio_entry(path, info.duration, info.samplerate))
+        result.sort(key=lambda line: line.split("|", 1)[0])
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in result)
+        if os.path.isdir(speaker_dir):
+            write_manifest(speaker_dir, [entry for unit in state.units("dataset").values() for entry in unit["entries"]] + split_entries)
+        state.save()
+
+
+def stage_txts(state, args, dry_run=False):
+    # list -> txts/*.txt, one unit per list line
+    items = list2txt.read_list(args.output) if os.path.exists(args.output) else []
+    texts = {wav_path: text for wav_path, text in items}
+    inputs = {wav_path: json_digest(text) for wav_path, text in items}
+    stale, fingerprints, removed = state.plan("txts", inputs, {"txt_dir": args.txt_dir})
+    print_plan("txts", stale, inputs, removed)
+    if dry_run:
+        return
+    remove_outputs(removed)
+    os.makedirs(args.txt_dir, exist_ok=True)
+    try:
+        for wav_path in stale:
+            entry = list2txt.write_txt(args.txt_dir, wav_path, texts[wav_path])
+            state.record("txts", wav_path, fingerprints[wav_path], [os.path.join(args.txt_dir, entry["path"])], entry=entry)
+    finally:
+        write_manifest(args.txt_dir, [unit["entry"] for unit in state.units("txts").values()])
+        state.save()
+
+
+def stage_final(state, args, dry_run=False):
+    # clips + txts -> _Final_Output/<name>/<name>_NNNN.mp3/.normalized.txt, one unit per output pair
+    out_dir = os.path.join(args.final_dir, args.fragment_name)
+    pairs = sorted((wav_path, unit["outputs"][0]) for wav_path, unit in state.units("txts").items() if os.path.exists(wav_path))
+    inputs = {}
+    sources = {}
+    for index, (wav_path, txt_path) in enumerate(pairs):
+        mp3_name, txt_name = final_names(args.fragment_name, index)
+        inputs[mp3_name] = json_digest([state.digest(wav_path), state.digest(txt_path)])
+        sources[mp3_name] = (wav_path, txt_path, txt_name)
+    if os.path.exists(args.output):
+        inputs[os.path.basename(args.output)] = state.digest(args.output)
+    stale, fingerprints, removed = state.plan("final", inputs, {"final_dir": args.final_dir})
+    print_plan("final", stale, inputs, removed)
+    if dry_run:
+        return
+    remove_outputs(removed)
+    os.makedirs(out_dir, exist_ok=True)
+    try:
+        for name in stale:
+            if name not in sources:
+                outputs = [os.path.join(args.final_dir, name)]
+                shutil.copy2(args.output, outputs[0])
+            else:
+                wav_path, txt_path, txt_name = sources[name]
+                outputs = [os.path.join(out_dir, name), os.path.join(out_dir, txt_name)]
+                # wav重命名为mp3后缀，与copy_to_final_output.py一致
+                shutil.copy2(wav_path, outputs[0])
+                shutil.copy2(txt_path, outputs[1])
+            state.record("final", name, fingerprints[name], outputs)
+    finally:
+        state.save()
+
+
+# the stages in dependency order; each one's inputs are the outputs recorded by the one before it.
+# Checking the list in subfix_webui_zh.py is a manual step between dataset and txts: saving it there
+# changes the list, so the next run rebuilds the txts and the final output of the edited lines only.
+STAGES = [
+    ("cut", stage_cut),
+    ("resample", stage_resample),
+    ("dataset", stage_dataset),
+    ("txts", stage_txts),
+    ("final", stage_final),
+]
+
+
+def make(args):
+    state = BuildState(args.state)
+    names = [name for name, _ in STAGES]
+    until = names.index(args.until) + 1 if args.until else len(names)
+    for name in args.force or []:
+        state.forget(name)
+    for name, stage in STAGES[:until]:
+        stage(state, args, args.dry_run)
+    if args.dry_run:
+        # nothing ran, so the stages after the first one with work were planned against their current inputs
+        print("dry run, nothing changed")
+    else:
+        state.save()
+
+
+if __name__ == "__main__":
+    stage_names = [name for name, _ in STAGES]
+    parser = argparse.ArgumentParser(description="Run cut -> resample -> dataset -> txts -> final, re-running only the work whose inputs or parameters changed")
+    parser.add_argument("--until", type=str, choices=stage_names, default=None, help="Stop after this stage, Default: run all stages")
+    parser.add_argument("--force", type=str, choices=stage_names, action="append", help="Re-run this stage for every input, may be repeated")
+    parser.add_argument("--dry_run", action="store_true", help="Only print how many units each stage would run")
+    parser.add_argument("--state", type=str, default=STATE_FILE, help=f"Build state file, Default: {STATE_FILE}")
+    parser.add_argument("--audio", type=str, default="./origin", help="Input audio folder or file, Default: ./origin")
+    parser.add_argument("--fragment_name", type=str, default="displace", help="Speaker (sub-folder) name, Default: displace")
+    parser.add_argument("--fragment_dir", type=str, default="fragment", help="Cut fragments folder, Default: fragment")
+    parser.add_argument("--resample_dir", type=str, default="fragment_resample", help="Resampled fragments folder, Default: fragment_resample")
+    parser.add_argument("--target_dir", type=str, default="dataset", help="Dataset clips folder, Default: dataset")
+    parser.add_argument("--txt_dir", type=str, default="txts", help="Text files folder, Default: txts")
+    parser.add_argument("--final_dir", type=str, default="_Final_Output", help="Final output folder, Default: _Final_Output")
+    parser.add_argument("--output", type=str, default="demo.list", help="List file, Default: demo.list")
+    parser.add_argument("--max_len", type=float, default=28.0, help="Max cut segment length (seconds), as audio_cut.py, Default: 28")
+    parser.add_argument("--merge_thresh", type=float, default=10.0, help="Merge threshold (seconds), as audio_cut.py, Default: 10")
+    parser.add_argument("--min_split_len", type=float, default=30.0, help="Sources up to this length (seconds) are not cut, as audio_cut.py, Default: 30")
+    parser.add_argument("--stream", action="store_true", help="Cut block by block, as audio_cut.py --stream")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Energy envelope cache folder, as audio_cut.py --cache_dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes cutting and resampling, Default: number of CPUs")
+    parser.add_argument("--sample_rate", type=int, default=48000, help="Sample rate, Default: 48000")
+    parser.add_argument("--resampler", type=str, choices=sorted(RESAMPLERS), default=None, help="Resampling backend, Default: ffmpeg if installed, otherwise inproc")
+    parser.add_argument("--language", type=str, default="ZH", help="Language, Default: ZH")
+    parser.add_argument("--max_seconds", type=int, default=15, help="Max sliced voice length(seconds), Default: 15")
+    parser.add_argument("--multi_split", action="store_true", help="是否进行多段切分，添加该参数则多段切分，否则整段输出")
+    parser.add_argument("--asr_batch_size", type=int, default=1, help="Fragments per ASR call, bucketed by duration, Default: 1 (no batching)")
+    parser.add_argument("--asr_cache", type=str, default=None,
+                        help=f"SQLite cache of raw ASR results, empty string disables it, Default: {ASR_CACHE_NAME} next to --output")
+    parser.add_argument("--asr_worker", type=str, default=asr_worker.DEFAULT_ADDRESS,
+                        help=f"Address of a running asr_worker.py, used when reachable, empty string disables it, Default: {asr_worker.DEFAULT_ADDRESS}")
+    parser.add_argument("--decode_workers", type=int, default=2, help="Threads decoding sources ahead of ASR, 0 decodes inline, Default: 2")
+    parser.add_argument("--write_workers", type=int, default=2, help="Threads writing output clips, 0 writes inline, Default: 2")
+    parser.add_argument("--prefetch", type=int, default=8, help="Max sources decoded ahead of ASR, Default: 8")
+    parser.add_argument("--long_window", type=float, default=0.0, help="As subfix_create_dataset.py --long_window, Default: 0")
+    parser.add_argument("--long_overlap", type=float, default=5.0, help="As subfix_create_dataset.py --long_overlap, Default: 5")
+    parser.add_argument("--long_workers", type=int, default=1, help="As subfix_create_dataset.py --long_workers, Default: 1")
+    args = parser.parse_args()
+    args.asr_cache = default_asr_cache(args.asr_cache, args.output)
+    make(args)
@@ -0,0 +1,158 @@
+import argparse
+import os
+import queue
+import threading
+import time
+
+import soundfile
+
+import asr_worker
+import audio_cut
+from stage_manifest import audio_entry, write_manifest
+from stage_metrics import StageMetrics
+from subfix_create_dataset import ASR_CACHE_NAME, create_shard_list, default_asr_cache, read_plan_segment, resample_array
+
+
+def cut_file(audio_file, max_len=28.0, merge_thresh=10.0, stream=False, cache_dir=None):
+    """
+    Decode one source and plan its segments exactly as audio_cut.py would.
+    :return: (plan entries, decoded audio at the source rate or None when streamed, sample rate, whether the file was kept whole)
+    """
+    y = None
+    if stream and audio_cut._stream_readable(audio_file):
+        # envelope from the cache or one block-wise pass; segments are read back one by one
+        energy, n_samples, sr = audio_cut.compute_envelope(audio_file, cache_dir=cache_dir)
+    else:
+        y, sr = audio_cut.load_audio(audio_file)
+        n_samples = len(y)
+        cache_path = audio_cut.envelope_cache_path(cache_dir, audio_file) if cache_dir else None
+        cached = audio_cut.envelope_cache_get(cache_path) if cache_path else None
+        energy = cached[0] if cached is not None else audio_cut.rms_envelope(y)
+        if cache_path and cached is None:
+            audio_cut.envelope_cache_put(cache_path, energy, n_samples, sr)
+    whole = n_samples / sr <= 30.0
+    if whole:
+        segments = [(0, n_samples)]
+    else:
+        segments = audio_cut.plan_segments(energy, n_samples, sr, max_len=max_len, merge_thresh=merge_thresh)[0]
+    entries = [{"source_path": os.path.abspath(audio_file), "start_sample": int(start), "end_sample": int(end), "sr": int(sr)}
+               for start, end in segments]
+    return entries, y, sr, whole
+
+
+def fragment_name(entry, index, whole):
+    # audio_cut.py's naming: files up to 30 s keep their name, segments get a 2-digit index
+    base_name = os.path.splitext(os.path.basename(entry["source_path"]))[0]
+    return f"{base_name}.wav" if whole else f"{base_name}{index + 1:02d}.wav"
+
+
+def cut_sources(audio_files, sample_rate, keep, max_len=28.0, merge_thresh=10.0, stream=False, cache_dir=None,
+                keep_dirs=None, metrics=None):
+    """
+    Yield (plan entry, segment at sample_rate) for every wanted segment of audio_files. Each
+    source is decoded once, cut in memory and every segment resampled once, straight from the
+    source rate to sample_rate. keep_dirs=(fragment_dir, resample_dir) also writes the
+    intermediates audio_cut.py and resample_audios would have written, for debugging.
+    """
+    kept = {folder: [] for folder in keep_dirs or ()}
+    for audio_file in audio_files:
+        t0 = time.perf_counter()
+        entries, y, sr, whole = cut_file(audio_file, max_len, merge_thresh, stream, cache_dir)
+        if metrics is not None:
+            metrics.add("cut", time.perf_counter() - t0, entries[-1]["end_sample"] / sr, path=audio_file)
+        for index, entry in enumerate(entries):
+            if not keep(entry):
+                continue
+            segment = y[entry["start_sample"]:entry["end_sample"]] if y is not None else read_plan_segment(entry)
+            data = resample_array(segment, sr, sample_rate)
+            if keep_dirs:
+                name = fragment_name(entry, index, whole)
+                for folder, audio, rate in zip(keep_dirs, (segment, data), (sr, sample_rate)):
+                    path = os.path.join(folder, name)
+                    soundfile.write(path, audio, rate)
+                    kept[folder].append(audio_entry(path, len(audio) / rate, rate))
+            yield entry, data
+    for folder, entries in kept.items():
+        write_manifest(folder, entries, update=True)
+
+
+def run_ahead(iterable, depth=8):
+    # run a generator on a background thread, at most depth items ahead of the consumer
+    items = queue.Queue(maxsize=max(1, depth))
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+        items.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def run_pipeline(audio_path, speaker_name, target_dir, sample_rate, language, output_list, max_seconds, multi_split=True,
+                 max_len=28.0, merge_thresh=10.0, stream=False, cache_dir=None, keep_intermediates=False,
+                 fragment_dir="fragment", resample_dir="fragment_resample", prefetch=8, report=None, trace=None, **options):
+    """
+    audio_cut.py -> resample_audios -> create_dataset in one pass: sources are decoded once, cut and
+    resampled in memory and recognized; only the final clips are written, unless keep_intermediates.
+    options are passed on to subfix_create_dataset.create_shard_list.
+    """
+    metrics = StageMetrics(trace)
+    audio_files = audio_cut.list_audio_files(audio_path)
+    keep_dirs = None
+    if keep_intermediates:
+        keep_dirs = (os.path.join(fragment_dir, speaker_name), os.path.join(resample_dir, speaker_name))
+        for folder in keep_dirs:
+            os.makedirs(folder, exist_ok=True)
+
+    def sources(keep):
+        return run_ahead(cut_sources(audio_files, sample_rate, keep, max_len, merge_thresh, stream, cache_dir, keep_dirs, metrics), prefetch)
+
+    create_shard_list(None, target_dir, sample_rate, language, output_list, max_seconds, multi_split, prefetch=prefetch,
+                      metrics=metrics, speaker_sources={speaker_name: sources}, **options)
+    metrics.write(report)
+    metrics.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cut, resample, recognize and write the dataset in one pass, without fragment/ and fragment_resample/")
+    parser.add_argument("--audio", type=str, default="./origin", help="Input audio folder or file, Default: ./origin")
+    parser.add_argument("--fragment_name", type=str, default="displace", help="Speaker (dataset sub-folder) name, Default: displace")
+    parser.add_argument("--target_dir", type=str, default="dataset", help="Target directory path, Default: dataset")
+    parser.add_argument("--sample_rate", type=int, default=48000, help="Sample rate, Default: 48000")
+    parser.add_argument("--language", type=str, default="ZH", help="Language, Default: ZH")
+    parser.add_argument("--output", type=str, default="demo.list", help="List file, Default: demo.list")
+    parser.add_argument("--max_seconds", type=int, default=15, help="Max sliced voice length(seconds), Default: 15")
+    parser.add_argument("--multi_split", action="store_true", help="是否进行多段切分，添加该参数则多段切分，否则整段输出")
+    parser.add_argument("--max_len", type=float, default=28.0, help="Max cut segment length (seconds), as audio_cut.py, Default: 28")
+    parser.add_argument("--merge_thresh", type=float, default=10.0, help="Merge threshold (seconds), as audio_cut.py, Default: 10")
+    parser.add_argument("--stream", action="store_true", help="Read sources block by block instead of decoding them whole, as audio_cut.py --stream")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Energy envelope cache folder shared with audio_cut.py, used with --stream")
+    parser.add_argument("--keep_intermediates", action="store_true", help="Also write fragment/<name> and fragment_resample/<name> for debugging")
+    parser.add_argument("--asr_batch_size", type=int, default=1, help="Fragments per ASR call, bucketed by duration, Default: 1 (no batching)")
+    parser.add_argument("--asr_cache", type=str, default=None,
+                        help=f"SQLite cache of raw ASR results, empty string disables it, Default: {ASR_CACHE_NAME} next to --output")
+    parser.add_argument("--asr_worker", type=str, default=asr_worker.DEFAULT_ADDRESS,
+                        help=f"Address of a running asr_worker.py, used when reachable, empty string disables it, Default: {asr_worker.DEFAULT_ADDRESS}")
+    parser.add_argument("--write_workers", type=int, default=2, help="Threads writing output clips, 0 writes inline, Default: 2")
+    parser.add_argument("--prefetch", type=int, default=8, help="Max segments cut ahead of ASR, Default: 8")
+    parser.add_argument("--resume", action="store_true", help="Continue a killed run from {output}.journal instead of starting over")
+    parser.add_argument("--report", type=str, default=None, help="Save per-stage timing as JSON")
+    parser.add_argument("--trace", type=str, default=None, help="Append one JSON line per file and stage to this file")
+    args = parser.parse_args()
+    args.asr_cache = default_asr_cache(args.asr_cache, args.output)
+    run_pipeline(args.audio, args.fragment_name, args.target_dir, args.sample_rate, args.language, args.output, args.max_seconds,
+                 args.multi_split, max_len=args.max_len, merge_thresh=args.merge_thresh, stream=args.stream, cache_dir=args.cache_dir,
+                 keep_intermediates=args.keep_intermediates, prefetch=args.prefetch, report=args.report, trace=args.trace,
+                 asr_batch_size=args.asr_batch_size, asr_cache=args.asr_cache, asr_worker_address=args.asr_worker,
+                 write_workers=args.write_workers, resume=args.resume)
@@ -9,6 +9,8 @@ import gradio as gr
 import numpy as np
 import soundfile
 
+from memory_budget import measured_call, over_budget, parse_size
+
 g_json_key_text = ""
 g_json_key_path = ""
 g_load_file = ""
@@ -21,6 +23,8 @@ g_text_list = []
 g_audio_list = []
 g_checkbox_list = []
 g_data_json = []
+# per-file memory budget in bytes, clips over it are split and merged block by block
+g_max_memory = None
 
 
 def reload_data(index, batch):
@@ -129,6 +133,61 @@ def get_next_path(filename):
     return os.path.join(base_dir, f'{str(uuid.uuid4())}.wav')
 
 
+def partial_path(path):
+    # hidden name next to path, renamed over it once written
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+
+
+def copy_blocks(f, path, start=0, stop=None, blocksize=65536):
+    # append frames [start, stop) of path to the open file f as mono, one block in memory at a time
+    for block in soundfile.blocks(path, blocksize=blocksize, start=start, stop=stop, dtype='float32', always_2d=True):
+        f.write(block[:, 0] if block.shape[1] == 1 else np.mean(block, axis=1))
+
+
+def split_audio(path, nextpath, audio_breakpoint):
+    # returns False when the breakpoint is outside the clip
+    if over_budget(path, g_max_memory):
+        info = soundfile.info(path)
+        break_frame = int(audio_breakpoint * info.samplerate)
+        if not (break_frame >= 1 and break_frame < info.frames):
+            return False
+        with soundfile.SoundFile(nextpath, 'w', samplerate=info.samplerate, channels=1) as f:
+            copy_blocks(f, path, start=break_frame)
+        with soundfile.SoundFile(partial_path(path), 'w', samplerate=info.samplerate, channels=1) as f:
+            copy_blocks(f, path, stop=break_frame)
+        os.replace(partial_path(path), path)
+        return True
+    data, sample_rate = librosa.load(path, sr=None, mono=True)
+    audio_maxframe = len(data)
+    break_frame = int(audio_breakpoint * sample_rate)
+
+    if (break_frame >= 1 and break_frame < audio_maxframe):
+        audio_first = data[0:break_frame]
+        audio_second = data[break_frame:]
+        soundfile.write(nextpath, audio_second, sample_rate)
+        soundfile.write(path, audio_first, sample_rate)
+        return True
+    return False
+
+
+def merge_audio(audios_path, interval_r):
+    # written under a hidden name and renamed over the first file, so it is never read while being rewritten
+    base_path = audios_path[0]
+    l_sample_rate = librosa.get_samplerate(base_path)
+    silence = np.zeros(int(l_sample_rate * interval_r), dtype=np.float32)
+    with soundfile.SoundFile(partial_path(base_path), 'w', samplerate=l_sample_rate, channels=1) as f:
+        for i, path in enumerate(audios_path):
+            if i > 0:
+                f.write(silence)
+            # only one clip is held in memory, and none over the budget unless it has to be resampled
+            if over_budget(path, g_max_memory, l_sample_rate) and soundfile.info(path).samplerate == l_sample_rate:
+                copy_blocks(f, path)
+            else:
+                data, _ = librosa.load(path, sr=l_sample_rate, mono=True)
+                f.write(data)
+    os.replace(partial_path(base_path), base_path)
+
+
 def b_audio_split(audio_breakpoint, *checkbox_list):
     global g_data_json , g_max_json_index
     checked_index = []
@@ -139,16 +198,11 @@ def b_audio_split(audio_breakpoint, *checkbox_list):
         index = checked_index[0]
         audio_json = copy.deepcopy(g_data_json[index])
         path = audio_json[g_json_key_path]
-        data, sample_rate = librosa.load(path, sr=None, mono=True)
-        audio_maxframe = len(data)
-        break_frame = int(audio_breakpoint * sample_rate)
-
-        if (break_frame >= 1 and break_frame < audio_maxframe):
-            audio_first = data[0:break_frame]
-            audio_second = data[break_frame:]
-            nextpath = get_next_path(path)
-            soundfile.write(nextpath, audio_second, sample_rate)
-            soundfile.write(path, audio_first, sample_rate)
+        nextpath = get_next_path(path)
+        split, seconds, peak_mb, growth_mb = measured_call(split_audio, path, nextpath, audio_breakpoint, watch_memory=bool(g_max_memory))
+        print(f"split {path}: {seconds:.2f}s" + (f", peak RSS {peak_mb:.0f} MB (+{growth_mb:.0f} MB)" if peak_mb is not None else ""))
+
+        if split:
             g_data_json.insert(index + 1, audio_json)
             g_data_json[index + 1][g_json_key_path] = nextpath
             b_save_file()
@@ -176,20 +230,9 @@ def b_merge_audio(interval_r, *checkbox_list):
         base_path = audios_path[0]
         g_data_json[base_index][g_json_key_text] = "".join(audios_text)
 
-        audio_list = []
-        l_sample_rate = None
-        for i, path in enumerate(audios_path):
-            data, sample_rate = librosa.load(path, sr=l_sample_rate, mono=True)
-            l_sample_rate = sample_rate
-            if (i > 0):
-                silence = np.zeros(int(l_sample_rate * interval_r))
-                audio_list.append(silence)
-
-            audio_list.append(data)
-
-        audio_concat = np.concatenate(audio_list)
-
-        soundfile.write(base_path, audio_concat, l_sample_rate)
+        _, seconds, peak_mb, growth_mb = measured_call(merge_audio, audios_path, interval_r, watch_memory=bool(g_max_memory))
+        print(f"merge {base_path} (+{len(audios_path) - 1}): {seconds:.2f}s"
+              + (f", peak RSS {peak_mb:.0f} MB (+{growth_mb:.0f} MB)" if peak_mb is not None else ""))
 
         b_save_file()
     
@@ -257,10 +300,11 @@ def b_load_file():
         b_load_list()
 
 
-def set_global(load_json, load_list, json_key_text, json_key_path, batch):
-    global g_json_key_text, g_json_key_path, g_load_file, g_load_format, g_batch
+def set_global(load_json, load_list, json_key_text, json_key_path, batch, max_memory=None):
+    global g_json_key_text, g_json_key_path, g_load_file, g_load_format, g_batch, g_max_memory
 
     g_batch = int(batch)
+    g_max_memory = max_memory
     
     if (load_json != "None"):
         g_load_format = "json"
@@ -285,10 +329,11 @@ if __name__ == "__main__":
     parser.add_argument('--json_key_text', default="text", help='the text key name in json, Default: text')
     parser.add_argument('--json_key_path', default="wav_path", help='the path key name in json, Default: wav_path')
     parser.add_argument('--g_batch', default=10, help='max number g_batch wav to display, Default: 10')
+    parser.add_argument('--max_memory', type=parse_size, default=None, help='per-file memory budget like 512M, larger clips are split and merged block by block, Default: no budget')
 
     args = parser.parse_args()
 
-    set_global(args.load_json, args.load_list, args.json_key_text, args.json_key_path, args.g_batch)
+    set_global(args.load_json, args.load_list, args.json_key_text, args.json_key_path, args.g_batch, args.max_memory)
     
     with gr.Blocks() as demo:
 
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+# A queue is a folder on a filesystem all workers mount (a local folder for several processes on one machine):
+#   todo/<job>.json    waiting jobs, claimed by renaming them into leases/ - only one rename can succeed
+#   leases/<job>.json  claimed jobs; the owner touches the file while it works, a lease whose mtime is older than
+#                      lease_seconds belongs to a dead worker and goes back to todo/ with one more attempt
+#   done/<job>.json    finished jobs with their result
+#   failed/<job>.json  jobs that failed max_attempts times, with the last error
+# Files are written under a hidden name and renamed into place, so nobody ever reads a partial job.
+# Lease expiry compares file mtimes with the local clock, so the hosts' clocks must roughly agree (NTP).
+# A worker that stalls past its lease may finish a job that was already handed to another worker; the
+# jobs here write deterministic outputs, so the second run only rewrites the same files.
+STATES = ("todo", "leases", "done", "failed")
+
+
+def job_prefix(kind, *keys):
+    # jobs are named <kind>.<hash of key>..., so a worker can claim e.g. only the jobs of one speaker by prefix
+    return "".join(f"{part}." for part in [kind] + [hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] for key in keys])
+
+
+def job_name(kind, *keys):
+    # every worker derives the same name for the same work, which makes adding jobs idempotent
+    return job_prefix(kind, *keys) + "json"
+
+
+class WorkQueue:
+
+    def __init__(self, root, lease_seconds=300.0, max_attempts=3):
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+        # claimed leases, renewed by the heartbeat thread
+        self.held = set()
+        self.lock = threading.Lock()
+        # per claim prefix, names seen waiting in the last listing
+        self.candidates = {}
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    def names(self, state, prefix=""):
+        return [name for name in os.listdir(os.path.join(self.root, state)) if name.startswith(prefix) and not name.startswith(".")]
+
+    def _write(self, state, name, job):
+        # hidden temp name + rename, so the job appears complete or not at all
+        tmp_path = self.path(state, f".{name}.{uuid.uuid4().hex}")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path(state, name))
+
+    def _read(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def add(self, name, job):
+        # idempotent: a job that is already queued, running, done or failed is not added again
+        if any(os.path.exists(self.path(state, name)) for state in STATES):
+            return False
+        self._write("todo", name, dict(job, attempts=0))
+        return True
+
+    def claim(self, prefix=""):
+        """
+        :return: (name, job) of a job now leased to this worker, or None if no job is waiting
+        """
+        for _ in range(2):
+            candidates = self.candidates.setdefault(prefix, [])
+            if not candidates:
+                # one listing serves many claims; shuffled so workers starting together don't all race for the same file
+                candidates.extend(self.names("todo", prefix))
+                random.shuffle(candidates)
+            while candidates:
+                name = candidates.pop()
+                lease_path = self.path("leases", name)
+                try:
+                    os.rename(self.path("todo", name), lease_path)
+                    # rename keeps the mtime of the queued file, the lease starts now
+                    os.utime(lease_path)
+                    job = self._read(lease_path)
+                except FileNotFoundError:
+                    # another worker claimed it first, or took it back as expired right after the rename
+                    continue
+                if os.path.exists(self.path("done", name)):
+                    # finished by a worker whose lease had expired
+                    self._remove(lease_path)
+                    continue
+                with self.lock:
+                    self.held.add(name)
+                self._start_heartbeat()
+                return name, job
+            # nothing waiting: take back leases of dead workers and look once more
+            if not self.reclaim(prefix):
+                return None
+        return None
+
+    def reclaim(self, prefix=""):
+        # move expired leases back to todo/ with one more attempt; returns how many were moved
+        moved = 0
+        for name in self.names("leases", prefix):
+            lease_path = self.path("leases", name)
+            try:
+                if time.time() - os.stat(lease_path).st_mtime < self.lease_seconds:
+                    continue
+                # a hidden name first, so the job is rewritten before anyone can claim it
+                hidden_path = self.path("todo", f".{name}.{uuid.uuid4().hex}")
+                os.rename(lease_path, hidden_path)
+            except FileNotFoundError:
+                continue
+            if time.time() - os.stat(hidden_path).st_mtime < self.lease_seconds:
+                # claimed and touched between the stat and the rename: give it back
+                os.rename(hidden_path, lease_path)
+                continue
+            job = self._read(hidden_path)
+            os.remove(hidden_path)
+            print(f"lease of {name} expired, attempt {job.get('attempts', 0) + 1} of {self.max_attempts}")
+            self._retry(name, job, "lease expired")
+            moved += 1
+        return moved
+
+    def _retry(self, name, job, error):
+        job = dict(job, attempts=job.get("attempts", 0) + 1, error=error)
+        if job["attempts"] >= self.max_attempts:
+            self._write("failed", name, job)
+        else:
+            self._write("todo", name, job)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _release(self, name):
+        with self.lock:
+            self.held.discard(name)
+        self._remove(self.path("leases", name))
+
+    def complete(self, name, job, result):
+        self._write("done", name, dict(job, owner=self.owner, result=result))
+        self._release(name)
+
+    def fail(self, name, job, error):
+        # back to todo/ for another try, or to failed/ after max_attempts
+        self._retry(name, dict(job, owner=self.owner), error)
+        self._release(name)
+
+    def _start_heartbeat(self):
+        if self.heartbeat is not None:
+            return
+
+        def renew():
+            while not self.stopped.wait(self.lease_seconds / 4):
+                with self.lock:
+                    held = list(self.held)
+                for name in held:
+                    try:
+                        os.utime(self.path("leases", name))
+                    except FileNotFoundError:
+                        # taken back as expired; whoever finishes first wins
+                        with self.lock:
+                            self.held.discard(name)
+
+        self.heartbeat = threading.Thread(target=renew, daemon=True)
+        self.heartbeat.start()
+
+    def drained(self, prefix=""):
+        return not self.names("todo", prefix) and not self.names("leases", prefix)
+
+    def jobs(self, prefix="", poll_seconds=5.0):
+        """
+        Claim and yield (name, job) until nothing is waiting or running anywhere. While other
+        workers still hold leases this waits, so jobs of a worker that dies are picked up here.
+        The caller finishes every job with complete() or fail().
+        """
+        while True:
+            claimed = self.claim(prefix)
+            if claimed is not None:
+                yield claimed
+                continue
+            if self.drained(prefix):
+                return
+            time.sleep(poll_seconds)
+
+    def results(self, state="done", prefix=""):
+        # {name: job} of all finished (or failed) jobs
+        return {name: self._read(self.path(state, name)) for name in sorted(self.names(state, prefix))}
+
+    def merge_lock(self, prefix=""):
+        """
+        Try to become the one worker that merges the results of the drained queue.
+        :return: a release callable, or None if another worker is merging right now
+        """
+        lock_path = os.path.join(self.root, f"merge.{prefix}lock")
+        try:
+            if time.time() - os.stat(lock_path).st_mtime > self.lease_seconds:
+                # left behind by a worker that died while merging
+                self._remove(lock_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+        return lambda: self._remove(lock_path)
+
+    def close(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()